@@ -0,0 +1,104 @@
+"""
+Micro-benchmark of parsers.py against the saved pages in benchmarks/fixtures.
+
+Each parser is first checked against a straightforward reference
+implementation (the line-by-line regexes and BeautifulSoup tree the scripts
+used before), so a parser regression fails here before it is timed.
+
+    python benchmarks/bench_parsers.py [--number N]
+"""
+import argparse
+import re
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import parsers  # noqa: E402
+
+FIXTURES = Path(__file__).resolve().parent / "fixtures"
+
+
+def reference_months(body):
+    months = []
+    for line in body.decode("utf-8").splitlines(keepends=True):
+        res = re.fullmatch(r'<a href="\./\?year=(?P<year>\d+)&amp;month=(?P<month>\d+)">\d+</a>\n', line)
+        if res is not None:
+            months.append((int(res.group("year")), int(res.group("month"))))
+    return months
+
+
+def reference_timestamps(body):
+    timestamps = []
+    for line in body.decode("utf-8").splitlines(keepends=True):
+        res = re.fullmatch(r"<a href=\"(\d{8}T\d{6}Z)/\">\d\d\d\d-\d\d-\d\d \d\d:\d\d:\d\d</a><br />\n", line)
+        if res is not None:
+            timestamps.append(res.group(1))
+    return timestamps
+
+
+def reference_readme(body):
+    debian_pattern = re.compile(
+        r"Debian\s+([\d.]+r?\d*)[^\n]*,\s+or\s+(\w+)\.\s+Access this release through\s+(\S+)",
+        re.MULTILINE | re.IGNORECASE
+    )
+    return [(match.group(2), match.group(1)) for match in debian_pattern.finditer(body.decode("utf-8"))]
+
+
+def reference_version_dirs(body):
+    try:
+        from bs4 import BeautifulSoup
+    except ImportError:
+        return None
+    versions = []
+    table = BeautifulSoup(body.decode(), "html.parser").find("table", id="indexlist")
+    for row in table.find_all("tr", class_=["even", "odd"]):
+        link = row.find("td", class_="indexcolname").find("a")
+        if link:
+            name = link.text.strip().strip("/")
+            if re.match(r"^(1[0-9]|[2-9]\d)\.\d+\.\d+$", name):
+                versions.append(name)
+    return versions
+
+
+def chunked(body, size=1460):
+    """Split a page like the segments of a response arriving over the network."""
+    return [body[i:i + size] for i in range(0, len(body), size)]
+
+
+CASES = (
+    ("months", "archive-debian.html", parsers.parse_months, reference_months),
+    ("timestamps", "month-2024-01.html", parsers.parse_timestamps, reference_timestamps),
+    ("timestamps (streaming)", "month-2024-01.html",
+     lambda body: list(parsers.iter_timestamps(chunked(body))), reference_timestamps),
+    ("readme", "README", parsers.parse_readme, reference_readme),
+    ("version dirs", "images-archive.html", parsers.parse_version_dirs, reference_version_dirs),
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the listing and README parsers.")
+    parser.add_argument("--number", type=int, default=1000, help="iterations per timing (default: 1000)")
+    args = parser.parse_args()
+
+    failed = False
+    print(f"{'parser':<24}{'items':>6}{'new (us)':>12}{'reference (us)':>16}{'speedup':>9}")
+    for name, fixture, parse, reference in CASES:
+        body = (FIXTURES / fixture).read_bytes()
+        result = parse(body)
+        expected = reference(body)
+        if expected is not None and result != expected:
+            print(f"{name}: parser output differs from the reference implementation")
+            failed = True
+            continue
+        new = min(timeit.repeat(lambda: parse(body), number=args.number, repeat=3)) / args.number
+        if expected is None:
+            print(f"{name:<24}{len(result):>6}{new * 1e6:>12.1f}{'n/a':>16}")
+            continue
+        old = min(timeit.repeat(lambda: reference(body), number=args.number, repeat=3)) / args.number
+        print(f"{name:<24}{len(result):>6}{new * 1e6:>12.1f}{old * 1e6:>16.1f}{old / new:>8.1f}x")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
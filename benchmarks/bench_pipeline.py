@@ -0,0 +1,335 @@
+"""
+End-to-end benchmark of the crawler, the downloaders and the ISO build stages.
+
+Runs against benchmarks/fake_debian.py, started as a separate process so its
+work does not count towards the measurements, or against --server. The
+phases are:
+
+    crawl     get_timestamps and crawl() of every month into a fresh store
+    recrawl   the same crawl again with --incremental over the warm cache
+    netboot   download_linux_and_initrd for the latest snapshot of each release
+    isos      queue_downloads and run_downloaders for every listed ISO
+    stages    extract, patch, repack and publish of one ISO, timed separately
+
+The fake ISOs are not ISO9660 images, so the build stages run on a
+synthetic extracted tree; extract only runs with --iso and 7z installed.
+Every phase checks its output (stored snapshots, present artifacts, ISO
+digests) and the script exits 1 if any check fails.
+
+    python benchmarks/bench_pipeline.py [--months 6] [--latency 0.02] [--error-rate 0.02]
+    python benchmarks/bench_pipeline.py --json after.json --baseline before.json
+"""
+import argparse
+import contextlib
+import gzip
+import importlib.util
+import json
+import os
+import random
+import resource
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+from checksums import Manifest, parse_checksums  # noqa: E402
+from http_cache import ConnectionPool, HttpCache, RequestScheduler  # noqa: E402
+from snapshot_index import SnapshotIndex  # noqa: E402
+from snapshot_store import SnapshotStore  # noqa: E402
+
+FILLER_SIZE = 1024 * 1024
+KERNEL_SIZE = 8 * 1024 * 1024
+
+
+def load_script(name, file_name):
+    """Import one of the hyphenated top-level scripts as a module."""
+    spec = importlib.util.spec_from_file_location(name, ROOT / file_name)
+    module = importlib.util.module_from_spec(spec)
+    # Registered so process pools can pickle its functions
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def reset_peak_rss():
+    """Reset the peak RSS of this process where Linux allows it, so each phase reports its own."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss():
+    """Return the peak RSS in bytes since the last reset_peak_rss(), or over the process lifetime."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def server_stats(url):
+    with urllib.request.urlopen(f"{url}/_stats") as response:
+        return json.load(response)
+
+
+class Phase:
+    """Measures wall time, server traffic and peak RSS of one benchmark phase."""
+
+    def __init__(self, name, url, results):
+        self.name = name
+        self.url = url
+        self.results = results
+
+    def __enter__(self):
+        reset_peak_rss()
+        self.stats = server_stats(self.url)
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.monotonic() - self.started
+        stats = server_stats(self.url)
+        faults = sum(n - self.stats["statuses"].get(status, 0) for status, n in stats["statuses"].items()
+                     if status == "429" or status.startswith("5"))
+        self.results[self.name] = {
+            "seconds": elapsed,
+            "requests": stats["requests"] - self.stats["requests"],
+            "bytes": stats["bytes"] - self.stats["bytes"],
+            "faults": faults,
+            "peak_rss": peak_rss(),
+        }
+
+
+def synthetic_tree(dl, extract_dir, pool_size, initrd_size, seed=0):
+    """
+    Build the members of an extracted netinst ISO that the build stages read.
+
+    The initrd holds the scripts patch_initrd_members looks for plus random
+    filler, and the pool is random data, as incompressible as real packages.
+    """
+    rng = random.Random(seed)
+    install_dir = extract_dir / "install.amd"
+    install_dir.mkdir(parents=True)
+    with gzip.open(install_dir / "initrd.gz", "wb", compresslevel=1) as out:
+        cpio = dl.CpioWriter(out)
+        cpio.add_data(dl.CONSOLE_SETUP, stat.S_IFREG | 0o755, b"#!/bin/sh\nset -e\n. /usr/share/debconf/confmodule\n")
+        for i in range(initrd_size // FILLER_SIZE):
+            cpio.add_data(f"lib/modules/filler-{i}.ko", stat.S_IFREG | 0o644, rng.randbytes(FILLER_SIZE))
+        cpio.close()
+    (install_dir / "vmlinuz").write_bytes(rng.randbytes(KERNEL_SIZE))
+    (extract_dir / ".disk").mkdir()
+    (extract_dir / ".disk" / "info").write_text("Debian GNU/Linux (synthetic) amd64 NETINST")
+    (extract_dir / "dists" / "stable" / "main").mkdir(parents=True)
+    (extract_dir / "dists" / "stable" / "Release").write_text("Suite: stable\n")
+    for i in range(pool_size // FILLER_SIZE):
+        package_dir = extract_dir / "pool" / "main" / f"p{i % 26:02d}" / f"package-{i}"
+        package_dir.mkdir(parents=True, exist_ok=True)
+        (package_dir / f"package-{i}_1.0_amd64.deb").write_bytes(rng.randbytes(FILLER_SIZE))
+
+
+def run_stages(dl, workdir, iso, args):
+    """
+    Run the build stages of one ISO, returning {stage: seconds or None if skipped}.
+
+    With iso (a real netinst image) and 7z available, extract runs too;
+    otherwise a synthetic extracted tree stands in for its output.
+    """
+    iso_dir = workdir / "stages" / "debian-bench"
+    iso_dir.mkdir(parents=True)
+    dl.TFTP_DIR = str(workdir / "tftp")
+    dl.tftp_blobs = dl.BlobStore(workdir / "tftp" / ".objects")
+    extract = iso is not None and shutil.which("7z") is not None
+    if extract:
+        iso_path = iso_dir / Path(iso).name
+        dl.link_or_copy(iso, iso_path)
+    else:
+        iso_path = iso_dir / "debian-bench-amd64-netinst.iso"
+        iso_path.write_bytes(b"")
+        synthetic_tree(dl, iso_dir / "extracted", args.pool_size * 1024 * 1024,
+                       args.initrd_size * 1024 * 1024)
+    times = {}
+    for stage in dl.iso_stages(str(iso_path), args.compression, None, args.compress_threads):
+        if stage.run is None:
+            continue
+        if stage.name == "extract" and not extract:
+            times[stage.name] = None
+            continue
+        started = time.monotonic()
+        stage.run()
+        times[stage.name] = time.monotonic() - started
+    return times
+
+
+def check(failures, ok, message):
+    if not ok:
+        failures.append(message)
+
+
+def run(args, url, workdir):
+    """Run every phase against the server at url; return (results, stage times, failures)."""
+    ds = load_script("debian_snapshot", "debian-snapshot.py")
+    dl = load_script("debian_downloader", "debian-downloader.py")
+    ds.SNAPSHOT_URL = url
+    results = {}
+    failures = []
+    expected = server_stats(url)["snapshots"]
+
+    scheduler = RequestScheduler(ConnectionPool(), args.rate, args.workers, args.retries)
+    client = HttpCache(scheduler, workdir / "cache")
+    store = SnapshotStore(workdir / "debian.db")
+    for name, incremental in (("crawl", False), ("recrawl", True)):
+        with Phase(name, url, results):
+            months = ds.get_timestamps(client, "debian")
+            ds.crawl(client, "debian", months, store, args.workers, incremental=incremental,
+                     bisect=args.bisect)
+        check(failures, len(store) == expected, f"{name}: {len(store)} of {expected} snapshots stored")
+
+    index = SnapshotIndex.from_store(store)
+    store.close()
+    ds.save_latest_timestamps(index, workdir)
+    stamps = index.latest_stamps()
+    with Phase("netboot", url, results):
+        ds.download_linux_and_initrd(client, workdir, workdir / "stamps.json", scheduler, args.workers)
+    present = sum((workdir / info["version_name"] / version / artifact).exists()
+                  for version, info in stamps.items() for artifact in ("linux", "initrd.gz"))
+    check(failures, present == 2 * len(stamps), f"netboot: {present} of {2 * len(stamps)} artifacts")
+
+    dl.ISO_ARCHIVE = f"{url}/images/archive"
+    dl.mirrors = dl.MirrorManager([dl.ISO_ARCHIVE])
+    dl.scheduler = RequestScheduler(ConnectionPool(), args.rate, args.threads * args.segments, args.retries)
+    dl.http_client = HttpCache(dl.scheduler, workdir / "iso-cache")
+    dest = workdir / "isos"
+    dest.mkdir()
+    manifest = Manifest(dest / "manifest.json")
+    with Phase("isos", url, results), manifest:
+        versions = dl.get_versions(f"{dl.ISO_ARCHIVE}/")
+        queue, _ = dl.queue_downloads(versions, str(dest), manifest, [])
+        dl.downloadTotal = queue.qsize()
+        dl.run_downloaders(queue, manifest, args.threads, args.per_mirror, args.segments,
+                           args.chunk_size * 1024 * 1024)
+    for iso_url in versions:
+        path = Path(dl.iso_path_for(iso_url, str(dest)))
+        with urllib.request.urlopen(iso_url.rsplit("/", 1)[0] + "/SHA512SUMS") as response:
+            sums = parse_checksums(response.read().decode())
+        ok = path.exists() and dl.hash_file(str(path), "sha512") == sums.get(path.name)
+        check(failures, ok, f"isos: {path.name} missing or corrupt")
+
+    with Phase("stages", url, results):
+        stages = run_stages(dl, workdir, args.iso, args)
+    return results, stages, failures
+
+
+def report(results, stages, baseline):
+    """Print the results, with the change in time against a baseline run if there is one."""
+    base = baseline.get("phases", {}) if baseline else {}
+    header = f"{'phase':<10}{'seconds':>9}{'requests':>10}{'req/s':>9}{'MiB':>9}{'MiB/s':>8}{'faults':>8}{'RSS MiB':>9}"
+    print(header + ("    vs base" if baseline else ""))
+    for name, r in results.items():
+        elapsed = max(r["seconds"], 1e-6)
+        line = (f"{name:<10}{r['seconds']:>9.2f}{r['requests']:>10}{r['requests'] / elapsed:>9.1f}"
+                f"{r['bytes'] / 2**20:>9.1f}{r['bytes'] / 2**20 / elapsed:>8.1f}{r['faults']:>8}"
+                f"{r['peak_rss'] / 2**20:>9.0f}")
+        if name in base:
+            line += f"{(r['seconds'] / max(base[name]['seconds'], 1e-6) - 1) * 100:>+10.0f}%"
+        print(line)
+    base_stages = baseline.get("stages", {}) if baseline else {}
+    print(f"\n{'stage':<10}{'seconds':>9}")
+    for name, seconds in stages.items():
+        if seconds is None:
+            print(f"{name:<10}{'skipped':>9}  (needs --iso and 7z)")
+            continue
+        line = f"{name:<10}{seconds:>9.2f}"
+        if base_stages.get(name):
+            line += f"{(seconds / base_stages[name] - 1) * 100:>+21.0f}%"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the crawler, downloaders and ISO pipeline offline.")
+    parser.add_argument("--server", metavar="URL", help="use a running fake_debian.py instead of starting one")
+    server = parser.add_argument_group("fake server (ignored with --server)")
+    server.add_argument("--months", type=int, default=6, help="months of snapshots (default: 6)")
+    server.add_argument("--per-day", type=int, default=4, help="snapshots per day (default: 4)")
+    server.add_argument("--isos", type=int, default=2, help="number of ISOs (default: 2)")
+    server.add_argument("--iso-size", type=int, default=64, help="ISO size in MiB (default: 64)")
+    server.add_argument("--netboot-size", type=int, default=4, help="netboot file size in MiB (default: 4)")
+    server.add_argument("--latency", type=float, default=0.0, help="seconds before each response")
+    server.add_argument("--bandwidth", type=float, default=0.0, help="MiB/s per response, 0 for unlimited")
+    server.add_argument("--error-rate", type=float, default=0.0, help="fraction of 500/502/503 responses")
+    server.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of 429 responses")
+    server.add_argument("--redirect-rate", type=float, default=0.0, help="fraction of redirected requests")
+    server.add_argument("--seed", type=int, default=0)
+    client = parser.add_argument_group("clients")
+    client.add_argument("--workers", type=int, default=8, help="crawl and netboot concurrency (default: 8)")
+    client.add_argument("--bisect", action="store_true", help="crawl with --bisect")
+    client.add_argument("--rate", type=float, default=1000.0, help="requests per second per host (default: 1000)")
+    client.add_argument("--retries", type=int, default=8)
+    client.add_argument("--threads", type=int, default=4, help="maximum concurrent ISO downloads (default: 4)")
+    client.add_argument("--per-mirror", type=int, default=32)
+    client.add_argument("--segments", type=int, default=4)
+    client.add_argument("--chunk-size", type=int, default=1, help="download chunk size in MiB (default: 1)")
+    build = parser.add_argument_group("build stages")
+    build.add_argument("--iso", help="real netinst ISO to run the extract stage on (needs 7z)")
+    build.add_argument("--pool-size", type=int, default=64, help="synthetic pool/ size in MiB (default: 64)")
+    build.add_argument("--initrd-size", type=int, default=16, help="synthetic initrd size in MiB (default: 16)")
+    build.add_argument("--compression", default="pigz")
+    build.add_argument("--compress-threads", type=int)
+    output = parser.add_argument_group("output")
+    output.add_argument("--log", default=os.devnull, help="file receiving the scripts' own output")
+    output.add_argument("--json", help="write the results to this file")
+    output.add_argument("--baseline", help="results of an earlier --json run to compare against")
+    args = parser.parse_args()
+
+    proc = None
+    url = args.server
+    if url is None:
+        proc = subprocess.Popen(
+            [sys.executable, str(Path(__file__).resolve().parent / "fake_debian.py"), "--port", "0",
+             "--months", str(args.months), "--per-day", str(args.per_day), "--isos", str(args.isos),
+             "--iso-size", str(args.iso_size), "--netboot-size", str(args.netboot_size),
+             "--latency", str(args.latency), "--bandwidth", str(args.bandwidth),
+             "--error-rate", str(args.error_rate), "--throttle-rate", str(args.throttle_rate),
+             "--redirect-rate", str(args.redirect_rate), "--seed", str(args.seed)],
+            stdout=subprocess.PIPE, text=True,
+        )
+        url = proc.stdout.readline().split()[-1]
+    url = url.rstrip("/")
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    workdir = Path(tempfile.mkdtemp(prefix="bench-pipeline-"))
+    try:
+        with open(args.log, "w") as log, contextlib.redirect_stdout(log):
+            results, stages, failures = run(args, url, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+
+    report(results, stages, baseline)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"phases": results, "stages": stages, "args": vars(args)}, f, indent=4)
+    for failure in failures:
+        print(f"FAILED {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
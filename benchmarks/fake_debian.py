@@ -0,0 +1,449 @@
+"""
+Local stand-in for snapshot.debian.org and get.debian.org.
+
+Serves a synthetic archive generated from a seed, so every run sees the same
+pages and bytes:
+
+    /archive/debian/                            month listing
+    /archive/debian/?year=Y&month=M             snapshots of a month
+    /archive/debian/<timestamp>/README          releases current at the snapshot
+    /archive/debian/<timestamp>/dists/<codename>/main/installer-amd64/current/images/
+        SHA256SUMS and netboot/debian-installer/amd64/{linux,initrd.gz}
+    /images/archive/                            indexlist of releases
+    /images/archive/<version>/amd64/iso-cd/     SHA512SUMS and debian-<version>-amd64-netinst.iso
+    /_stats                                     request and byte counters as JSON
+
+The ISOs are random bytes of the requested size, not ISO9660 images. Range
+requests, HEAD, ETag and If-None-Match are supported. Latency, per-response
+bandwidth, 429/5xx responses and redirects can be injected.
+
+    python benchmarks/fake_debian.py [--port 8080] [--latency 0.05] [--error-rate 0.01]
+"""
+import argparse
+import datetime
+import email.utils
+import functools
+import hashlib
+import http.server
+import json
+import random
+import re
+import struct
+import time
+import urllib.parse
+from collections import Counter
+from threading import Lock
+
+# (codename, major, initial release); point releases follow every POINT_RELEASE_DAYS
+# until the release after next comes out
+RELEASES = (
+    ("stretch", 9, datetime.date(2017, 6, 17)),
+    ("buster", 10, datetime.date(2019, 7, 6)),
+    ("bullseye", 11, datetime.date(2021, 8, 14)),
+    ("bookworm", 12, datetime.date(2023, 6, 10)),
+    ("trixie", 13, datetime.date(2025, 8, 9)),
+)
+POINT_RELEASE_DAYS = 91
+SUITES = ("stable", "oldstable", "oldoldstable")
+# Blobs repeat a random block, each copy stamped with its index so misplaced ranges change the digest
+BLOCK_SIZE = 1024 * 1024
+WRITE_SIZE = 64 * 1024
+RANGE = re.compile(r"bytes=(\d+)-(\d*)$")
+
+
+class Archive:
+    """
+    The synthetic content: snapshots, the releases each one lists, and blobs.
+
+    Args:
+        start (str): First month of snapshots, "YYYY-MM".
+        months (int): Number of months of snapshots.
+        per_day (int): Snapshots per day.
+        isos (int): Number of the most recent point releases listed on get.debian.org.
+        iso_size (int): Size of each ISO in bytes.
+        netboot_size (int): Size of each netboot kernel and initrd in bytes.
+        seed (int): Seed of the timestamps and blob contents.
+    """
+
+    def __init__(self, start="2023-01", months=12, per_day=4, isos=4, iso_size=64 * 1024 * 1024,
+                 netboot_size=4 * 1024 * 1024, seed=0):
+        self.iso_size = iso_size
+        self.netboot_size = netboot_size
+        self.seed = seed
+        year, month = map(int, start.split("-"))
+        rng = random.Random(seed)
+        self.months = {}
+        for _ in range(months):
+            day = datetime.datetime(year, month, 1)
+            stamps = []
+            while day.month == month:
+                for slot in range(per_day):
+                    offset = slot * 86400 // per_day + rng.randrange(86400 // per_day // 2)
+                    stamps.append((day + datetime.timedelta(seconds=offset)).strftime("%Y%m%dT%H%M%SZ"))
+                day += datetime.timedelta(days=1)
+            self.months[(year, month)] = stamps
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        end = datetime.date(year, month, 1)
+        # (date, codename, major, minor) of every point release up to the end of the archive
+        self.points = []
+        for i, (codename, major, released) in enumerate(RELEASES):
+            minor, date = 0, released
+            last = min(end, RELEASES[i + 2][2]) if i + 2 < len(RELEASES) else end
+            while date < last:
+                self.points.append((date, codename, major, minor))
+                minor, date = minor + 1, date + datetime.timedelta(days=POINT_RELEASE_DAYS)
+        self.points.sort()
+        self.isos = [f"{major}.{minor}.0" for _, _, major, minor in self.points if major >= 10][-isos:]
+        self.lock = Lock()
+        self.digests = {}
+
+    def timestamps(self):
+        return [stamp for stamps in self.months.values() for stamp in stamps]
+
+    def snapshots(self):
+        """Return how many snapshots list at least one release, i.e. what a full crawl stores."""
+        return sum(1 for stamp in self.timestamps() if self.releases_at(stamp))
+
+    def releases_at(self, timestamp):
+        """Return [(codename, "major.minor")] of the releases current at a timestamp, newest first."""
+        date = datetime.datetime.strptime(timestamp, "%Y%m%dT%H%M%SZ").date()
+        current = {}
+        for released, codename, major, minor in self.points:
+            if released <= date:
+                current[major] = (codename, f"{major}.{minor}")
+        return [current[major] for major in sorted(current, reverse=True)[:len(SUITES)]]
+
+    @functools.lru_cache(maxsize=None)
+    def readme(self, releases):
+        lines = [
+            "See https://www.debian.org/ for information about Debian GNU/Linux.",
+            "",
+            "Current Releases",
+            "================",
+            "",
+            f"{len(releases)} Debian releases are available on the main site:",
+            "",
+        ]
+        for (codename, version), suite in zip(releases, SUITES):
+            lines.append(f"Debian {version}, or {codename}.  Access this release through dists/{suite}")
+        lines += ["", "Package Pools", "=============", ""]
+        return "\n".join(lines).encode()
+
+    def month_listing(self):
+        lines = ['<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 4.01//EN">',
+                 "<html><head><title>snapshot.debian.org -- debian</title></head>",
+                 "<body>", "<h1>snapshot.debian.org: archive debian</h1>"]
+        year = None
+        for y, m in self.months:
+            if y != year:
+                lines.append(f"<h2>{y}</h2>")
+                year = y
+            lines.append(f'<a href="./?year={y}&amp;month={m}">{m}</a>')
+        lines += ["</body>", "</html>", ""]
+        return "\n".join(lines).encode()
+
+    def snapshot_listing(self, year, month):
+        if (year, month) not in self.months:
+            return None
+        lines = ['<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 4.01//EN">',
+                 f"<html><head><title>snapshot.debian.org -- debian {year}-{month:02d}</title></head>",
+                 "<body>", "<p>"]
+        for stamp in self.months[(year, month)]:
+            shown = datetime.datetime.strptime(stamp, "%Y%m%dT%H%M%SZ").strftime("%Y-%m-%d %H:%M:%S")
+            lines.append(f'<a href="{stamp}/">{shown}</a><br />')
+        lines += ["</p>", "</body>", "</html>", ""]
+        return "\n".join(lines).encode()
+
+    def iso_index(self):
+        lines = ['<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">',
+                 "<html>", " <head>", "  <title>Index of /images/archive</title>", " </head>", " <body>",
+                 "<h1>Index of /images/archive</h1>", '  <table id="indexlist">']
+        for i, version in enumerate(self.isos):
+            lines.append(
+                f'   <tr class="{"odd" if i % 2 else "even"}"><td class="indexcolicon"><a href="{version}/">'
+                f'<img src="/icons/folder.gif" alt="[DIR]"></a></td><td class="indexcolname">'
+                f'<a href="{version}/">{version}/</a></td><td class="indexcollastmod">2024-01-01 12:00  </td>'
+                f'<td class="indexcolsize">  - </td></tr>'
+            )
+        lines += ["</table>", "</body></html>", ""]
+        return "\n".join(lines).encode()
+
+    def netboot_name(self, timestamp, codename):
+        """Return the blob name of a netboot directory; it only changes with the point release."""
+        for name, version in self.releases_at(timestamp):
+            if name == codename:
+                return f"netboot-{codename}-{version}"
+        return None
+
+    @functools.lru_cache(maxsize=None)
+    def _block(self, name):
+        return random.Random(f"{self.seed}:{name}").randbytes(BLOCK_SIZE)
+
+    def blob(self, name, start, end):
+        """Yield the bytes [start, end) of a named blob."""
+        block = self._block(name)
+        while start < end:
+            index, offset = divmod(start, BLOCK_SIZE)
+            data = struct.pack(">Q", index) + block[8:]
+            chunk = data[offset:min(BLOCK_SIZE, offset + end - start)]
+            yield chunk
+            start += len(chunk)
+
+    def digest(self, name, size, algorithm):
+        with self.lock:
+            if (name, algorithm) in self.digests:
+                return self.digests[(name, algorithm)]
+        digest = hashlib.new(algorithm)
+        for chunk in self.blob(name, 0, size):
+            digest.update(chunk)
+        with self.lock:
+            self.digests[(name, algorithm)] = digest.hexdigest()
+        return digest.hexdigest()
+
+    def resolve(self, path, query):
+        """
+        Map a request to its content.
+
+        Returns:
+            tuple: ("page", bytes) or ("blob", name, size), or None for 404.
+        """
+        if path == "/archive/debian/":
+            if not query:
+                return "page", self.month_listing()
+            try:
+                body = self.snapshot_listing(int(query["year"][0]), int(query["month"][0]))
+            except (KeyError, ValueError):
+                return None
+            return None if body is None else ("page", body)
+        parts = path.strip("/").split("/")
+        if parts[:2] == ["archive", "debian"] and len(parts) > 2:
+            stamp = parts[2]
+            if not any(stamp in stamps for stamps in self.months.values()):
+                return None
+            if parts[3:] == ["README"]:
+                return "page", self.readme(tuple(self.releases_at(stamp)))
+            images = ["main", "installer-amd64", "current", "images"]
+            if len(parts) > 8 and parts[3] == "dists" and parts[5:9] == images:
+                name = self.netboot_name(stamp, parts[4])
+                if name is None:
+                    return None
+                rest = parts[9:]
+                if rest == ["SHA256SUMS"]:
+                    lines = [
+                        f"{self.digest(f'{name}/{artifact}', self.netboot_size, 'sha256')}  "
+                        f"./netboot/debian-installer/amd64/{artifact}"
+                        for artifact in ("initrd.gz", "linux")
+                    ]
+                    return "page", ("\n".join(lines) + "\n").encode()
+                if rest[:3] == ["netboot", "debian-installer", "amd64"] and rest[3:] in (["linux"], ["initrd.gz"]):
+                    return "blob", f"{name}/{rest[3]}", self.netboot_size
+            return None
+        if path == "/images/archive/":
+            return "page", self.iso_index()
+        if parts[:2] == ["images", "archive"] and len(parts) == 6 and parts[3:5] == ["amd64", "iso-cd"]:
+            version = parts[2]
+            if version not in self.isos:
+                return None
+            iso = f"debian-{version}-amd64-netinst.iso"
+            if parts[5] == "SHA512SUMS":
+                return "page", f"{self.digest(iso, self.iso_size, 'sha512')}  {iso}\n".encode()
+            if parts[5] == iso:
+                return "blob", iso, self.iso_size
+        return None
+
+
+class FakeDebianServer(http.server.ThreadingHTTPServer):
+    """
+    HTTP server for an Archive, with fault injection and counters.
+
+    Args:
+        address (tuple): (host, port) to listen on; port 0 picks a free one.
+        archive (Archive): Content to serve.
+        latency (float): Seconds before each response.
+        bandwidth (float): Bytes per second of each response body, 0 for unlimited.
+        error_rate (float): Fraction of requests answered with 500, 502 or 503.
+        throttle_rate (float): Fraction of requests answered with 429 and Retry-After.
+        redirect_rate (float): Fraction of requests redirected once with a 302.
+        seed (int): Seed of the fault injection.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, archive, latency=0.0, bandwidth=0.0, error_rate=0.0, throttle_rate=0.0,
+                 redirect_rate=0.0, seed=0):
+        super().__init__(address, FakeDebianHandler)
+        self.archive = archive
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.redirect_rate = redirect_rate
+        self.random = random.Random(seed)
+        self.lock = Lock()
+        self.statuses = Counter()
+        self.bytes = 0
+        self.snapshots = archive.snapshots()
+
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def fault(self):
+        """Pick the injected response of one request: None, "throttle", "error" or "redirect"."""
+        with self.lock:
+            roll = self.random.random()
+        for name, rate in (("throttle", self.throttle_rate), ("error", self.error_rate),
+                           ("redirect", self.redirect_rate)):
+            if roll < rate:
+                return name
+            roll -= rate
+        return None
+
+    # Both are counted before the response is written, so a client that has
+    # received it always finds it in /_stats
+    def count(self, status):
+        with self.lock:
+            self.statuses[status] += 1
+
+    def count_bytes(self, size):
+        with self.lock:
+            self.bytes += size
+
+    def stats(self):
+        with self.lock:
+            return {"snapshots": self.snapshots, "requests": sum(self.statuses.values()), "bytes": self.bytes,
+                    "statuses": {str(status): n for status, n in sorted(self.statuses.items())}}
+
+
+class FakeDebianHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "fake-debian"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.respond(body=False)
+
+    def do_GET(self):
+        self.respond(body=True)
+
+    def send_empty(self, status, headers=()):
+        self.server.count(status)
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def respond(self, body):
+        server = self.server
+        parts = urllib.parse.urlsplit(self.path)
+        if parts.path == "/_stats":
+            data = json.dumps(server.stats()).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        if server.latency:
+            time.sleep(server.latency)
+        path = parts.path
+        redirected = path.startswith("/redirected/")
+        if redirected:
+            path = path[len("/redirected"):]
+        fault = server.fault()
+        if fault == "throttle":
+            return self.send_empty(429, [("Retry-After", "1")])
+        if fault == "error":
+            return self.send_empty(server.random.choice((500, 502, 503)))
+        if fault == "redirect" and not redirected:
+            location = "/redirected" + self.path
+            return self.send_empty(302, [("Location", location)])
+
+        content = server.archive.resolve(path, urllib.parse.parse_qs(parts.query))
+        if content is None:
+            return self.send_empty(404)
+        if content[0] == "page":
+            data = content[1]
+            size, etag = len(data), '"%s"' % hashlib.md5(data).hexdigest()
+        else:
+            _, blob, size = content
+            etag = '"%s"' % hashlib.md5(f"{blob}:{size}".encode()).hexdigest()
+        headers = [("ETag", etag), ("Last-Modified", email.utils.formatdate(0, usegmt=True)),
+                   ("Accept-Ranges", "bytes")]
+        if self.headers.get("If-None-Match") == etag:
+            return self.send_empty(304, headers)
+
+        start, end, status = 0, size, 200
+        match = RANGE.match(self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            end = min(size, int(match.group(2)) + 1) if match.group(2) else size
+            if start >= end:
+                return self.send_empty(416, [("Content-Range", f"bytes */{size}")])
+            status = 206
+            headers.append(("Content-Range", f"bytes {start}-{end - 1}/{size}"))
+        server.count(status)
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(end - start))
+        self.end_headers()
+        if not body:
+            return
+        chunks = [data[start:end]] if content[0] == "page" else server.archive.blob(blob, start, end)
+        sent = 0
+        started = time.monotonic()
+        for chunk in chunks:
+            for i in range(0, len(chunk), WRITE_SIZE):
+                piece = chunk[i:i + WRITE_SIZE]
+                server.count_bytes(len(piece))
+                try:
+                    self.wfile.write(piece)
+                except OSError:
+                    server.count_bytes(-len(piece))
+                    raise
+                sent += len(piece)
+                if server.bandwidth:
+                    ahead = sent / server.bandwidth - (time.monotonic() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a synthetic snapshot.debian.org and get.debian.org.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080, help="port to listen on, 0 for any (default: 8080)")
+    parser.add_argument("--start", default="2023-01", help="first month of snapshots (default: 2023-01)")
+    parser.add_argument("--months", type=int, default=12, help="number of months of snapshots (default: 12)")
+    parser.add_argument("--per-day", type=int, default=4, help="snapshots per day (default: 4)")
+    parser.add_argument("--isos", type=int, default=4, help="number of ISOs listed (default: 4)")
+    parser.add_argument("--iso-size", type=int, default=64, help="size of each ISO in MiB (default: 64)")
+    parser.add_argument("--netboot-size", type=int, default=4,
+                        help="size of each netboot kernel and initrd in MiB (default: 4)")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before each response")
+    parser.add_argument("--bandwidth", type=float, default=0.0,
+                        help="MiB/s of each response body, 0 for unlimited")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of requests answered with 500, 502 or 503")
+    parser.add_argument("--throttle-rate", type=float, default=0.0,
+                        help="fraction of requests answered with 429")
+    parser.add_argument("--redirect-rate", type=float, default=0.0,
+                        help="fraction of requests redirected once")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the content and the faults")
+    args = parser.parse_args()
+
+    archive = Archive(args.start, args.months, args.per_day, args.isos, args.iso_size * 1024 * 1024,
+                      args.netboot_size * 1024 * 1024, args.seed)
+    server = FakeDebianServer((args.host, args.port), archive, args.latency, args.bandwidth * 1024 * 1024,
+                              args.error_rate, args.throttle_rate, args.redirect_rate, args.seed)
+    # The first line tells bench_pipeline.py where to connect
+    print(f"Serving on {server.url()}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import os
+import shutil
+import subprocess
+import threading
+from pathlib import Path
+
+
+def link_or_copy(src, dst):
+    """
+    Atomically place src at dst as a hardlink, falling back to a reflink or copy.
+
+    Hardlinks only work within one filesystem; across filesystems
+    `cp --reflink=auto` shares extents where the filesystem supports it.
+    """
+    dst = Path(dst)
+    # Unique per process and thread, as several ISOs may publish the same kernel at once
+    tmp = dst.with_name(f".{dst.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        os.link(src, tmp)
+    except OSError:
+        try:
+            subprocess.run(["cp", "--reflink=auto", str(src), str(tmp)], check=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except (OSError, subprocess.CalledProcessError):
+            shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+
+
+class BlobStore:
+    """
+    Content-addressed store of files named by their digest.
+
+    Objects live under <root>/<algorithm>/<digest[:2]>/<digest> and are
+    linked into the per-version layouts, so identical kernels and initrds
+    are stored (and downloaded) only once.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def path(self, algorithm, digest):
+        return self.root / algorithm / digest[:2] / digest
+
+    def has(self, algorithm, digest):
+        return self.path(algorithm, digest).exists()
+
+    def add(self, path, algorithm, digest, replace=True):
+        """
+        Add a verified file to the store.
+
+        With replace, a path whose content is already stored is replaced by a
+        link to the stored object, so the duplicate's blocks are freed.
+        """
+        obj = self.path(algorithm, digest)
+        if obj.exists():
+            if replace:
+                link_or_copy(obj, path)
+        else:
+            obj.parent.mkdir(parents=True, exist_ok=True)
+            link_or_copy(path, obj)
+        return obj
+
+    def link(self, algorithm, digest, dest):
+        """Link a stored object to dest."""
+        link_or_copy(self.path(algorithm, digest), dest)
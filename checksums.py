@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+import time
+from threading import Lock
+
+# Checksum files published next to Debian images, strongest first
+CHECKSUM_FILES = (("SHA512SUMS", "sha512"), ("SHA256SUMS", "sha256"), ("MD5SUMS", "md5"))
+# Manifest records are saved in batches: every FLUSH_RECORDS records or FLUSH_INTERVAL seconds
+FLUSH_RECORDS = 100
+FLUSH_INTERVAL = 30.0
+
+
+def parse_checksums(text):
+    """
+    Parse a SHA*SUMS/MD5SUMS file.
+
+    Returns:
+        dict: File name as listed (e.g. "./netboot/debian-installer/amd64/linux")
+            mapped to its lowercase hex digest.
+    """
+    checksums = {}
+    for line in text.splitlines():
+        parts = line.split(None, 1)
+        if len(parts) == 2:
+            checksums[parts[1].strip().lstrip("*")] = parts[0].lower()
+    return checksums
+
+
+def hash_file(path, algorithm, chunk_size=4 * 1024 * 1024):
+    """Hash an existing file, for files downloaded before the manifest existed."""
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """
+    JSON record of downloaded files and their verified digests.
+
+    A file whose size and mtime still match its entry is trusted without
+    being read again. Records are saved in batches and on close(); a file
+    recorded after the last save is only hashed again on the next run.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.lock = Lock()
+        self.dirty = 0
+        self.saved = time.monotonic()
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def lookup(self, path):
+        """Return the entry for path if the file is unchanged since it was recorded."""
+        path = str(path)
+        with self.lock:
+            entry = self.entries.get(path)
+        if entry is None:
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if st.st_size != entry["size"] or st.st_mtime_ns != entry["mtime_ns"]:
+            return None
+        return entry
+
+    def record(self, path, algorithm, digest, url=None):
+        """Record a verified file, saving the manifest once enough records are pending."""
+        path = str(path)
+        st = os.stat(path)
+        with self.lock:
+            self.entries[path] = {
+                "size": st.st_size,
+                "mtime_ns": st.st_mtime_ns,
+                "algorithm": algorithm,
+                "digest": digest,
+                "url": url,
+            }
+            self.dirty += 1
+            if self.dirty >= FLUSH_RECORDS or time.monotonic() - self.saved >= FLUSH_INTERVAL:
+                self._save()
+
+    def flush(self):
+        """Save the pending records, if any."""
+        with self.lock:
+            if self.dirty:
+                self._save()
+
+    def close(self):
+        self.flush()
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.dirty = 0
+        self.saved = time.monotonic()
@@ -1,89 +1,519 @@
-import requests,re,threading,os,shutil,subprocess,time,stat
-from bs4 import BeautifulSoup
-from queue import Queue
+import requests,threading,urllib.parse,http.client,os,shutil,subprocess,time,stat,json,argparse,hashlib,gzip,lzma,zlib,struct,io,collections,multiprocessing
+from checksums import CHECKSUM_FILES, Manifest, hash_file, parse_checksums
+from blob_store import BlobStore, link_or_copy
+from http_cache import (ConnectionPool, HTTPStatusError, HttpCache, RequestScheduler, default_cache_dir,
+                        fetch_with_redirect)
+from urllib3.util import Retry
+from parsers import parse_version_dirs
+from mirrors import MirrorManager
+from workspace import WORKSPACE_DIRS, Workspaces, format_size
+import metrics
+from queue import Empty, PriorityQueue
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 
 
 
 downloadTotal = 0
 downloadDone = 0
+downloadBytes = 0
 threadLock = threading.Lock()
+# Set on Ctrl-C: workers take no new jobs and running downloads stop, keeping their .part state
+cancel = threading.Event()
+
+TFTP_DIR = '/var/lib/tftpboot/debian_processed'
+# Kernels are shared between many releases, store each one once
+tftp_blobs = BlobStore(os.path.join(TFTP_DIR, '.objects'))
+
+
+CHUNK_SIZE = 4 * 1024 * 1024
+SEGMENTS = 4
+# Transfers running at once against one mirror host
+PER_MIRROR = 32
+MIN_SEGMENT_SIZE = 16 * 1024 * 1024
+STATE_SAVE_INTERVAL = 1.0
+# Seconds between pool size adjustments, and the throughput gain needed to keep growing
+TUNE_INTERVAL = 10.0
+TUNE_GAIN = 1.1
+
+# Shared connection pool for every download thread. urllib3 does not retry:
+# every failure and throttled response goes straight to the scheduler, whose
+# HostLimiter backs off on it and whose retry count decides mirror failover
+session = requests.Session()
+retry = Retry(total=0, redirect=False, raise_on_status=False)
+session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=128, max_retries=retry))
+session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=128, max_retries=retry))
+# Per-host rate limits and retries for every request, reconfigured in main()
+scheduler = RequestScheduler(ConnectionPool())
+# Cached client for index pages and checksum files, set up in main()
+http_client = None
+# Origin of the ISOs; --mirror adds equivalent trees
+ISO_ARCHIVE = 'https://get.debian.org/images/archive'
+mirrors = MirrorManager([ISO_ARCHIVE])
+
+
+class DownloadCancelled(Exception):
+    """Raised inside a download when cancel is set; not an OSError, so it is never retried."""
+
+
+class MirrorLimits:
+    """
+    Caps the number of transfers (segments or streams) running at once
+    against each mirror host, keyed on the host a transfer was sent to.
+    """
+
+    def __init__(self, per_mirror):
+        self.per_mirror = per_mirror
+        self.lock = threading.Lock()
+        self.slots = {}
+
+    def slot(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        with self.lock:
+            if host not in self.slots:
+                self.slots[host] = threading.BoundedSemaphore(self.per_mirror)
+            return self.slots[host]
+
+
+# Per-host cap for download_segment and download_stream, reconfigured in run_downloaders()
+mirror_limits = MirrorLimits(PER_MIRROR)
 
 
 class Downloader(threading.Thread):
-    def __init__(self,threadNum, queue) -> None:
+    def __init__(self,threadNum, queue, manifest, segments=SEGMENTS, chunk_size=CHUNK_SIZE) -> None:
         threading.Thread.__init__(self)
         self.threadNum = threadNum
-        self.kill_received = False
         self.queue = queue
+        self.manifest = manifest
+        self.segments = segments
+        self.chunk_size = chunk_size
 
    
 
     def run(self):
         global downloadDone
 
-        while not self.kill_received and not self.queue.empty():
-            parms = self.queue.get()
-            url, dest = parms
-            self.download_file(url, dest,  (self.threadNum % 7))
+        # The queue is filled before any worker starts, so Empty means all work is taken
+        while not cancel.is_set():
+            try:
+                _, _, _, url, dest = self.queue.get_nowait()
+            except Empty:
+                break
+            metrics.observe('queue_depth', self.queue.qsize(), metrics.COUNT_BUCKETS, queue='iso')
+            with metrics.span('download', url=url):
+                self.download_file(url, dest,  (self.threadNum % 7))
+            self.queue.task_done()
+            if cancel.is_set():
+                break
             with threadLock:
                 downloadDone += 1
-                print('\nDownload of {0} completed, {1} of {2}\n'.format(url, downloadDone, downloadTotal))
-
-            self.queue.task_done()
-        print('\nThread #{0} exiting\n'.format(self.threadNum),(self.threadNum % 7))
+                done = downloadDone
+            metrics.note('\nDownload of {0} completed, {1} of {2}\n'.format(url, done, downloadTotal))
+        metrics.note('\nThread #{0} exiting\n'.format(self.threadNum))
 
     def download_file(self,url_to_download,dest,thread_num):
         """Download the file from the URL."""
-        file_name = os.path.join(dest, url_to_download.split("/")[-1])
+        full_path = iso_path_for(url_to_download, dest)
+        version_dir = os.path.dirname(full_path)
+        if self.manifest.lookup(full_path):
+            return
+        os.makedirs(version_dir, exist_ok=True)
         try:
-            response = requests.get(url_to_download, stream=True)
-            response.raise_for_status()  # Check for HTTP errors
-            if not os.path.exists(file_name):
-                version_dir = file_name.split('-amd64')[0]
-                os.makedirs(version_dir, exist_ok=True)
-            # Write the file in chunks to avoid memory overload
-                full_path = version_dir + '/'+file_name.split('/')[-1]
-                print(full_path)
-                if os.path.exists(full_path):
+            algorithm, expected = fetch_checksum(url_to_download)
+            if os.path.exists(full_path):
+                # Downloaded before the manifest existed: verify it once
+                digest = hash_file(full_path, algorithm)
+                if expected is None or digest == expected:
+                    self.manifest.record(full_path, algorithm, digest, url_to_download)
+                    metrics.inc('downloads_total', kind='iso', result='recorded')
                     return
-            with open(full_path, "wb") as file:
-                for chunk in response.iter_content(chunk_size=8192):
-                    file.write(chunk)
-            print(f"Downloaded: {file_name}")
-        except requests.exceptions.RequestException as e:
+                print(f"Checksum mismatch for existing {full_path}, downloading again")
+                os.remove(full_path)
+            digest = download_file(url_to_download, full_path, self.segments, self.chunk_size, algorithm)
+            if expected is not None and digest != expected:
+                os.remove(full_path)
+                print(f"Checksum mismatch for {url_to_download}: expected {expected}, got {digest}")
+                metrics.inc('downloads_total', kind='iso', result='failed')
+                return
+            self.manifest.record(full_path, algorithm, digest, url_to_download)
+            metrics.inc('downloads_total', kind='iso', result='downloaded')
+            metrics.note(f"Downloaded: {full_path} ({algorithm} {'verified' if expected else 'recorded'})")
+        except DownloadCancelled:
+            metrics.inc('downloads_total', kind='iso', result='cancelled')
+            print(f"Cancelled {url_to_download}, it will resume on the next run")
+        except (requests.exceptions.RequestException, OSError, http.client.HTTPException) as e:
+            # fetch_with_redirect raises HTTPException for 5xx after retries and redirect loops
+            metrics.inc('downloads_total', kind='iso', result='failed')
             print(f"Failed to download {url_to_download}: {e}")
 
 
+def iso_path_for(url, dest):
+    """Return where an ISO URL is stored: <dest>/debian-<version>/<file name>."""
+    file_name = os.path.join(dest, url.split("/")[-1])
+    version_dir = file_name.split('-amd64')[0]
+    return version_dir + '/' + file_name.split('/')[-1]
+
+
+def fetch_checksum(url):
+    """
+    Look up the published checksum of a file in the SUMS files of its directory.
+
+    Returns:
+        tuple: (algorithm, hex digest), or ('sha256', None) when no SUMS file lists it.
+    """
+    base_url, file_name = url.rsplit('/', 1)
+    for sums_name, algorithm in CHECKSUM_FILES:
+        status, _, body = mirrors.fetch(
+            f"{base_url}/{sums_name}", lambda source: fetch_with_redirect(http_client, "GET", source)
+        )
+        if status == 404:
+            continue
+        checksums = parse_checksums(body.decode())
+        for name in (file_name, './' + file_name):
+            if name in checksums:
+                return algorithm, checksums[name]
+    return 'sha256', None
+
+
+class SegmentHasher(threading.Thread):
+    """
+    Hash a segmented download while it is being written.
+
+    Segments finish out of order, so the hasher follows the contiguous prefix
+    of the file that has been written and reads it back with os.pread while it
+    is still in the page cache, instead of re-reading the whole ISO afterwards.
+    """
+
+    def __init__(self, fd, segments, algorithm, chunk_size=CHUNK_SIZE):
+        threading.Thread.__init__(self, daemon=True)
+        self.fd = fd
+        self.segments = segments
+        self.hash = hashlib.new(algorithm)
+        self.chunk_size = chunk_size
+        self.offset = 0
+        self.finished = threading.Event()
+
+    def written(self):
+        offset = 0
+        for start, end, done in self.segments:
+            offset = start + done
+            if offset < end:
+                break
+        return offset
+
+    def run(self):
+        while True:
+            finished = self.finished.is_set()
+            written = self.written()
+            if self.offset < written:
+                data = os.pread(self.fd, min(self.chunk_size, written - self.offset), self.offset)
+                self.hash.update(data)
+                self.offset += len(data)
+            elif finished:
+                return
+            else:
+                self.finished.wait(0.05)
+
+
+def load_download_state(state_path, url, size, etag):
+    """Load the sidecar state of a partial download if it still matches the remote file."""
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get("url") != url or state.get("size") != size or state.get("etag") != etag:
+        return None
+    return state
+
+
+def save_download_state(state_path, state):
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path)
+
+
+def download_file(url, path, segments=SEGMENTS, chunk_size=CHUNK_SIZE, algorithm='sha256'):
+    """
+    Download a URL to path, in parallel HTTP Range segments when the server allows it.
+
+    Data is written to path + '.part' and renamed into place only once complete,
+    so an existing path is always a finished download. Progress of each segment
+    is kept in a '.part.json' sidecar, and an interrupted download resumes from
+    where every segment stopped. Segments are spread over the mirrors in
+    proportion to their bandwidth and fail over to the others on errors.
+
+    Returns:
+        str: Hex digest of the downloaded file, computed while it was written.
+    """
+    part_path = path + '.part'
+    state_path = part_path + '.json'
+
+    def head_from(source):
+        def send_head():
+            head = session.head(source, allow_redirects=True, timeout=60)
+            return head.status_code, head.headers, head
+
+        _, _, head = scheduler.call(source, send_head, mirrors.retries())
+        head.raise_for_status()
+        return head
+
+    head = mirrors.fetch(url, head_from)
+    size = int(head.headers.get('Content-Length', 0))
+    etag = head.headers.get('ETag') or head.headers.get('Last-Modified')
+    if size <= 0 or head.headers.get('Accept-Ranges') != 'bytes':
+        return download_stream(url, path, chunk_size, algorithm)
+
+    state = load_download_state(state_path, url, size, etag)
+    if state is None or not os.path.exists(part_path):
+        count = max(1, min(max(segments, len(mirrors)), size // MIN_SEGMENT_SIZE))
+        step = -(-size // count)
+        state = {
+            'url': url,
+            'size': size,
+            'etag': etag,
+            'segments': [[start, min(start + step, size), 0] for start in range(0, size, step)],
+        }
+        with open(part_path, 'wb') as f:
+            try:
+                os.posix_fallocate(f.fileno(), 0, size)
+            except (AttributeError, OSError):
+                f.truncate(size)
+        save_download_state(state_path, state)
+    else:
+        done = sum(segment[2] for segment in state['segments'])
+        metrics.note(f"Resuming {path} at {done} of {size} bytes")
+
+    fd = os.open(part_path, os.O_RDWR)
+    lock = threading.Lock()
+    errors = []
+    hasher = SegmentHasher(fd, state['segments'], algorithm, chunk_size)
+    hasher.start()
+    try:
+        pending = [segment for segment in state['segments'] if segment[0] + segment[2] < segment[1]]
+        workers = [
+            threading.Thread(target=download_segment,
+                             args=(url, fd, segment, chunk_size, state, state_path, lock, errors, source))
+            for segment, source in zip(pending, mirrors.spread(url, len(pending)))
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        os.fsync(fd)
+    finally:
+        hasher.finished.set()
+        hasher.join()
+        os.close(fd)
+    with lock:
+        save_download_state(state_path, state)
+    if errors:
+        raise errors[0]
+    os.replace(part_path, path)
+    os.remove(state_path)
+    return hasher.hash.hexdigest()
+
+
+def count_bytes(size):
+    global downloadBytes
+    with threadLock:
+        downloadBytes += size
+    metrics.inc('download_bytes_total', size, kind='iso')
+
+
+def download_segment(url, fd, segment, chunk_size, state, state_path, lock, errors, source=None):
+    """Fetch one byte range of a segmented download with positional writes, starting from source."""
+    start, end, _ = segment
+
+    def fetch(source):
+        def send():
+            # Retries resume where the previous attempt stopped
+            headers = {'Range': f'bytes={start + segment[2]}-{end - 1}'}
+            with session.get(source, headers=headers, stream=True, timeout=60) as response:
+                if response.status_code != 206:
+                    return response.status_code, response.headers, None
+                # A mirror that is out of sync must not contribute bytes of another file
+                total = response.headers.get('Content-Range', '').rpartition('/')[2]
+                if total.isdigit() and int(total) != state['size']:
+                    return response.status_code, response.headers, 'size mismatch'
+                last_save = time.monotonic()
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    if cancel.is_set():
+                        raise DownloadCancelled(url)
+                    os.pwrite(fd, chunk, start + segment[2])
+                    segment[2] += len(chunk)
+                    count_bytes(len(chunk))
+                    if time.monotonic() - last_save > STATE_SAVE_INTERVAL:
+                        os.fdatasync(fd)
+                        with lock:
+                            save_download_state(state_path, state)
+                        last_save = time.monotonic()
+            if start + segment[2] < end:
+                raise requests.exceptions.ChunkedEncodingError(f"Short read for {source} at {start + segment[2]}")
+            return response.status_code, response.headers, None
+
+        with mirror_limits.slot(source):
+            status, _, problem = scheduler.call(source, send, mirrors.retries())
+        if status == 200:
+            raise requests.exceptions.RequestException(f"Server ignored range request for {source}")
+        if status != 206:
+            raise HTTPStatusError(status, source)
+        if problem:
+            raise requests.exceptions.RequestException(f"{source}: {problem}")
+
+    try:
+        mirrors.fetch(url, fetch, source)
+    except (requests.exceptions.RequestException, OSError, http.client.HTTPException, DownloadCancelled) as e:
+        errors.append(e)
+
+
+def download_stream(url, path, chunk_size=CHUNK_SIZE, algorithm='sha256'):
+    """Download a URL in a single stream, for servers without range support."""
+    part_path = path + '.part'
+
+    def fetch(source):
+        def send():
+            digest = hashlib.new(algorithm)
+            with session.get(source, stream=True, timeout=60) as response:
+                if response.status_code != 200:
+                    return response.status_code, response.headers, None
+                with open(part_path, "wb") as file:
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        if cancel.is_set():
+                            raise DownloadCancelled(url)
+                        digest.update(chunk)
+                        file.write(chunk)
+                        count_bytes(len(chunk))
+            return response.status_code, response.headers, digest
+
+        with mirror_limits.slot(source):
+            status, _, digest = scheduler.call(source, send, mirrors.retries())
+        if digest is None:
+            raise HTTPStatusError(status, source)
+        return digest
+
+    digest = mirrors.fetch(url, fetch)
+    os.replace(part_path, path)
+    return digest.hexdigest()
+
+
    
 
 
 
 def get_versions(url):
-        # Send a GET request to the URL
-        response = requests.get(url)
-        response.raise_for_status()
-        # Parse the HTML content with BeautifulSoup
-        soup = BeautifulSoup(response.text, 'html.parser')
-
-        # Find the table by ID
-        table = soup.find('table', id='indexlist')
-
-        # Initialize an empty list to store Debian versions
-        debian_versions = []
-
-        # Find all rows in the table with class 'even' or 'odd' to extract version names
-        for row in table.find_all('tr', class_=['even', 'odd']):
-            # Find the link within the column that contains the version name
-            version_link = row.find('td', class_='indexcolname').find('a')
-            if version_link:
-                version_name = version_link.text.strip().strip('/')
-                if re.match(r'^(1[0-9]|[2-9]\d)\.\d+\.\d+$', version_name):
-                    debian_versions.append(f'https://get.debian.org/images/archive/{version_name}/amd64/iso-cd/debian-'+version_name+'-amd64-netinst.iso')
+        # Send a GET request to the URL, revalidating the cached listing
+        status, _, body = mirrors.fetch(url, lambda source: fetch_with_redirect(http_client, "GET", source))
+        # Any other error status was already raised by fetch_with_redirect
+        if status == 404:
+            raise requests.exceptions.HTTPError(f"HTTP 404 for {url}")
+
+        # Pull the release directories out of the index in one pass over the raw page
+        with metrics.span('parse', page='images-index'):
+            debian_versions = [
+                f'{ISO_ARCHIVE}/{version_name}/amd64/iso-cd/debian-'+version_name+'-amd64-netinst.iso'
+                for version_name in parse_version_dirs(body)
+            ]
 
         # Print or use the list of Debian versions
-        print(debian_versions)
+        metrics.note(debian_versions)
         return debian_versions
 
+def version_of(url):
+    # .../images/archive/<version>/amd64/iso-cd/<file>
+    return url.split('/')[-4]
+
+
+def job_priority(url, tags):
+    """Return the index of the first priority tag (a version or version prefix) matching url."""
+    version = version_of(url)
+    for i, tag in enumerate(tags):
+        if version == tag or version.startswith(tag + '.'):
+            return i
+    return len(tags)
+
+
+def head_size(url):
+    """Return the Content-Length of url, or 0 if the HEAD request fails."""
+    def send():
+        head = session.head(url, allow_redirects=True, timeout=60)
+        return head.status_code, head.headers, head
+
+    try:
+        _, _, head = scheduler.call(url, send)
+        return int(head.headers.get('Content-Length', 0)) if head.ok else 0
+    except (requests.exceptions.RequestException, OSError, ValueError):
+        return 0
+
+
+def queue_downloads(urls, dest, manifest, tags):
+    """
+    Build the download queue, ordered by priority tag and then largest file first.
+
+    Files already verified in the manifest are left out. Sizes come from
+    concurrent HEAD requests; starting the biggest ISOs first keeps one large
+    download from running alone at the end.
+
+    Returns:
+        tuple: (PriorityQueue of (priority, -size, seq, url, dest), total bytes).
+    """
+    urls = [url for url in urls if not manifest.lookup(iso_path_for(url, dest))]
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        sizes = list(executor.map(head_size, urls))
+    queue = PriorityQueue()
+    for seq, (url, size) in enumerate(zip(urls, sizes)):
+        queue.put((job_priority(url, tags), -size, seq, url, dest))
+    return queue, sum(sizes)
+
+
+def run_downloaders(queue, manifest, max_threads, per_mirror, segments, chunk_size):
+    """
+    Run Downloader threads until the queue is drained or the downloads are cancelled.
+
+    The pool starts with two threads and grows by one every TUNE_INTERVAL
+    seconds for as long as the measured throughput keeps improving by
+    TUNE_GAIN, up to max_threads. Ctrl-C sets cancel: running downloads stop
+    and keep their partial state, and no new ones are started.
+    """
+    global mirror_limits
+    mirror_limits = MirrorLimits(per_mirror)
+    threads = []
+
+    def start_thread():
+        worker = Downloader(len(threads), queue, manifest, segments, chunk_size)
+        worker.start()
+        threads.append(worker)
+
+    for _ in range(min(2, max_threads, queue.qsize())):
+        start_thread()
+
+    best = 0.0
+    growing = True
+    last_bytes, last_time = downloadBytes, time.monotonic()
+    while has_live_threads(threads):
+        try:
+            [t.join(1) for t in threads if t is not None and t.is_alive()]
+        except KeyboardInterrupt:
+            print('\nCancelling downloads, partial files are kept and resume on the next run....\n')
+            cancel.set()
+            continue
+        now = time.monotonic()
+        if not growing or cancel.is_set() or now - last_time < TUNE_INTERVAL:
+            continue
+        with threadLock:
+            done_bytes = downloadBytes
+        rate = (done_bytes - last_bytes) / (now - last_time)
+        last_bytes, last_time = done_bytes, now
+        live = sum(t.is_alive() for t in threads)
+        if rate > best * TUNE_GAIN and live < max_threads and not queue.empty():
+            best = rate
+            start_thread()
+            print(f"Download throughput {rate / 1024 / 1024:.1f} MiB/s with {live} threads, adding one")
+        else:
+            growing = False
+            print(f"Download throughput {rate / 1024 / 1024:.1f} MiB/s, keeping {live} threads")
+
+
 def has_live_threads(threads):
         return True in [t.is_alive() for t in threads]
 
@@ -91,158 +521,844 @@ def has_live_threads(threads):
 
 ##############################EXTRACT AND MODIFY INITRD ##############################
 
-def process_initrd(root_dir):
+CPIO_NEWC_MAGIC = b'070701'
+CPIO_TRAILER = 'TRAILER!!!'
+
+COPY_CDROM_SCRIPT = (
+    "#!/bin/sh\n"
+    "set -e\n"
+    ". /usr/share/debconf/confmodule\n\n"
+    "cp -r /cdrom  /target/media/cdrom\n"
+    "sed -i '2s/-e/-x/' /usr/lib/apt-setup/generators/50mirror\n"
+    "sed -i  '124s/use_mirror=false/use_mirror=true/g' /usr/lib/apt-setup/generators/50mirror"
+)
+DELETE_CDROM_SCRIPT = (
+    "#!/bin/sh\n"
+    "set -e\n"
+    ". /usr/share/debconf/confmodule\n\n"
+    "rm -rf /target/media/cdrom/*\n"
+)
+CONSOLE_SETUP = 'usr/lib/base-installer.d/20console-setup'
+COPY_CDROM = 'usr/lib/base-installer.d/99copy-cdrom'
+DELETE_CDROM = 'usr/lib/finish-install.d/11delete-cdrom'
+EXEC_BITS = stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
+
+
+def read_cpio_members(stream, names):
+    """
+    Read selected members of a newc cpio archive from a stream.
+
+    Every other member is skipped without being written anywhere.
+
+    Returns:
+        dict: Member name (without a leading './') mapped to (mode, data).
+    """
+    wanted = set(names)
+    members = {}
+    while wanted:
+        header = stream.read(110)
+        if len(header) < 110 or header[:6] != CPIO_NEWC_MAGIC:
+            raise ValueError("Not a newc cpio archive")
+        fields = [int(header[6 + 8 * i:14 + 8 * i], 16) for i in range(13)]
+        mode, filesize, namesize = fields[1], fields[6], fields[11]
+        name = stream.read(namesize)[:-1].decode()
+        stream.read(-(110 + namesize) % 4)
+        if name == CPIO_TRAILER:
+            break
+        if name.startswith('./'):
+            name = name[2:]
+        if name in wanted:
+            members[name] = (mode, stream.read(filesize))
+            wanted.discard(name)
+        else:
+            while filesize:
+                filesize -= len(stream.read(min(filesize, CHUNK_SIZE)))
+        stream.read(-fields[6] % 4)
+    return members
+
+
+class CpioWriter:
+    """Streaming writer for newc cpio archives."""
+
+    def __init__(self, out):
+        self.out = out
+        self.ino = 1
+        self.mtime = int(time.time())
+
+    def _header(self, name, mode, size, nlink=1):
+        encoded = name.encode() + b'\0'
+        fields = [self.ino, mode, 0, 0, nlink, self.mtime, size, 0, 0, 0, 0, len(encoded), 0]
+        self.ino += 1
+        self.out.write(CPIO_NEWC_MAGIC + ''.join('%08X' % f for f in fields).encode() + encoded)
+        self.out.write(b'\0' * (-(110 + len(encoded)) % 4))
+
+    def add_data(self, name, mode, data):
+        self._header(name, mode, len(data))
+        self.out.write(data)
+        self.out.write(b'\0' * (-len(data) % 4))
+
+    def add_dir(self, name, mode=stat.S_IFDIR | 0o755):
+        self._header(name, mode, 0, nlink=2)
+
+    def add_path(self, name, path):
+        """Add a file, directory or symlink from disk, streaming file contents."""
+        st = os.lstat(path)
+        if stat.S_ISDIR(st.st_mode):
+            self.add_dir(name, st.st_mode)
+        elif stat.S_ISLNK(st.st_mode):
+            self.add_data(name, st.st_mode, os.readlink(path).encode())
+        else:
+            self._header(name, st.st_mode, st.st_size)
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, self.out, CHUNK_SIZE)
+            self.out.write(b'\0' * (-st.st_size % 4))
+
+    def add_tree(self, prefix, root):
+        """Add a directory tree from disk under prefix."""
+        self.add_path(prefix, root)
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            rel = os.path.relpath(dirpath, root)
+            for entry in dirnames + sorted(filenames):
+                name = os.path.normpath(os.path.join(prefix, rel, entry))
+                self.add_path(name, os.path.join(dirpath, entry))
+
+    def close(self):
+        self._header(CPIO_TRAILER, 0, 0)
+        self.out.flush()
+
+
+def patch_initrd_members(initrd_gz):
+    """
+    Build the modified installer scripts from the original initrd.
+
+    Returns:
+        list: (name, mode, data) for 20console-setup, 99copy-cdrom and 11delete-cdrom.
+    """
+    with gzip.open(initrd_gz, 'rb') as stream:
+        members = read_cpio_members(stream, [CONSOLE_SETUP, COPY_CDROM, DELETE_CDROM])
+    if CONSOLE_SETUP not in members:
+        raise FileNotFoundError(f"{CONSOLE_SETUP} not found in {initrd_gz}")
+
+    # Same as `sed -i '2s/-e/-x/'`
+    mode, data = members[CONSOLE_SETUP]
+    lines = data.split(b'\n')
+    if len(lines) > 1:
+        lines[1] = lines[1].replace(b'-e', b'-x', 1)
+    patched = [(CONSOLE_SETUP, mode, b'\n'.join(lines))]
+
+    # Append to the scripts (creating them if needed) and make them executable
+    for name, script in ((COPY_CDROM, COPY_CDROM_SCRIPT), (DELETE_CDROM, DELETE_CDROM_SCRIPT)):
+        mode, data = members.get(name, (stat.S_IFREG | 0o644, b''))
+        patched.append((name, mode | EXEC_BITS, data + script.encode()))
+    return patched
+
+
+COMPRESSORS = ('gzip', 'pigz', 'xz', 'zstd')
+DEFAULT_LEVELS = {'gzip': 6, 'pigz': 6, 'xz': 6, 'zstd': 10}
+PIGZ_BLOCK_SIZE = 1024 * 1024
+DEFLATE_WINDOW = 32 * 1024
+
+
+class ParallelGzipWriter:
+    """
+    In-process equivalent of pigz.
+
+    Input is cut into blocks that are deflated on a thread pool (zlib releases
+    the GIL), each primed with the last 32 KiB of the previous block as its
+    dictionary. The raw deflate blocks are joined with sync flushes into a
+    single gzip member that any gunzip, including the kernel's, can read.
+    """
+
+    def __init__(self, out, level=6, threads=None, block_size=PIGZ_BLOCK_SIZE):
+        self.out = out
+        self.level = level
+        self.block_size = block_size
+        self.threads = threads or os.cpu_count()
+        self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        self.pending = []
+        self.buffer = bytearray()
+        self.previous = b''
+        self.crc = 0
+        self.size = 0
+        out.write(b'\x1f\x8b\x08\x00' + struct.pack('<I', int(time.time())) + b'\x00\x03')
+
+    @staticmethod
+    def _deflate(block, dictionary, level, last):
+        if dictionary:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=dictionary)
+        else:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+    def _submit(self, block, last):
+        self.crc = zlib.crc32(block, self.crc)
+        self.size += len(block)
+        self.pending.append(
+            self.executor.submit(self._deflate, block, self.previous, self.level, last))
+        self.previous = block[-DEFLATE_WINDOW:]
+        # Bound the memory held by blocks waiting to be written
+        while len(self.pending) > 2 * self.threads:
+            self.out.write(self.pending.pop(0).result())
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) > self.block_size:
+            block = bytes(self.buffer[:self.block_size])
+            del self.buffer[:self.block_size]
+            self._submit(block, last=False)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self._submit(bytes(self.buffer), last=True)
+        self.buffer = bytearray()
+        for future in self.pending:
+            self.out.write(future.result())
+        self.pending = []
+        self.executor.shutdown()
+        self.out.write(struct.pack('<II', self.crc, self.size & 0xffffffff))
+
+
+class ZstdWriter:
+    """Compress through the zstd command, which is multi-threaded with -T."""
+
+    def __init__(self, out, level=DEFAULT_LEVELS['zstd'], threads=None):
+        if shutil.which('zstd') is None:
+            raise RuntimeError("zstd compression requires the zstd command")
+        self.out = out
+        self.proc = subprocess.Popen(['zstd', '-q', '-c', f'-{level}', f'-T{threads or 0}'],
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.reader = threading.Thread(target=shutil.copyfileobj, args=(self.proc.stdout, out))
+        self.reader.start()
+
+    def write(self, data):
+        self.proc.stdin.write(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.proc.stdin.close()
+        self.reader.join()
+        if self.proc.wait() != 0:
+            raise RuntimeError("zstd failed")
+
+
+def open_compressor(out, compression='pigz', level=None, threads=None):
+    """
+    Return a writer compressing into out with the selected backend.
+
+    Closing the writer finishes the compressed stream but leaves out open.
+    xz streams use CRC32 checks, the only kind the kernel decompressor accepts.
+    """
+    level = DEFAULT_LEVELS[compression] if level is None else level
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=out, mode='wb', compresslevel=level)
+    if compression == 'pigz':
+        return ParallelGzipWriter(out, level, threads)
+    if compression == 'xz':
+        return lzma.LZMAFile(out, 'wb', format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC32, preset=level)
+    if compression == 'zstd':
+        return ZstdWriter(out, level, threads)
+    raise ValueError(f"Unknown compression {compression!r}, expected one of {COMPRESSORS}")
+
+
+def decompress(data, compression):
+    if compression in ('gzip', 'pigz'):
+        return gzip.decompress(data)
+    if compression == 'xz':
+        return lzma.decompress(data)
+    return subprocess.run(['zstd', '-q', '-d', '-c'], input=data, stdout=subprocess.PIPE, check=True).stdout
+
+
+def write_overlay(writer, extract_dir, patched):
+    """Write the overlay cpio archive: patched scripts and the cdrom/ tree."""
+    cpio = CpioWriter(writer)
+    for name, mode, data in patched:
+        cpio.add_data(name, mode, data)
+    cpio.add_dir('cdrom')
+    for src in ('.disk', 'pool', 'dists'):
+        cpio.add_tree(f'cdrom/{src}', os.path.join(extract_dir, src))
+    cpio.close()
+
+
+def benchmark_compression(path, threads=None):
+    """
+    Compare compression backends and levels on an initrd overlay.
+
+    Args:
+        path (str): An extracted ISO directory, whose overlay archive is
+            built in memory, or any uncompressed file such as a cpio archive.
+        threads (int): Threads used by the multi-threaded backends.
+    """
+    if os.path.isdir(path):
+        buffer = io.BytesIO()
+        initrd_gz = os.path.join(path, 'install.amd', 'initrd.gz')
+        write_overlay(buffer, path, patch_initrd_members(initrd_gz))
+        data = buffer.getvalue()
+    else:
+        with open(path, 'rb') as f:
+            data = f.read()
+    print(f"Input: {len(data) / 2**20:.1f} MiB")
+    print(f"{'backend':<8}{'level':>6}{'size MiB':>10}{'ratio':>8}{'compress s':>12}{'decompress s':>14}")
+    for compression in COMPRESSORS:
+        if compression == 'zstd' and shutil.which('zstd') is None:
+            print("zstd    skipped, zstd command not found")
+            continue
+        levels = {'gzip': (1, 6, 9), 'pigz': (1, 6, 9), 'xz': (0, 6), 'zstd': (3, 10, 19)}[compression]
+        for level in levels:
+            out = io.BytesIO()
+            started = time.monotonic()
+            writer = open_compressor(out, compression, level, threads)
+            writer.write(data)
+            writer.close()
+            compress_time = time.monotonic() - started
+            started = time.monotonic()
+            if decompress(out.getvalue(), compression) != data:
+                raise RuntimeError(f"{compression} -{level} round trip mismatch")
+            decompress_time = time.monotonic() - started
+            size = len(out.getvalue())
+            print(f"{compression:<8}{level:>6}{size / 2**20:>10.1f}{len(data) / max(size, 1):>8.2f}"
+                  f"{compress_time:>12.2f}{decompress_time:>14.2f}")
+
+
+class TimedWriter:
+    """Forwards writes to a compressor, adding up the time spent in it."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.seconds = 0.0
+
+    def _timed(self, func, *args):
+        started = time.monotonic()
+        try:
+            return func(*args)
+        finally:
+            self.seconds += time.monotonic() - started
+
+    def write(self, data):
+        return self._timed(self.writer.write, data)
+
+    def flush(self):
+        return self._timed(self.writer.flush)
+
+    def close(self):
+        return self._timed(self.writer.close)
+
+
+def build_initrd(extract_dir, output_path, compression='pigz', level=None, threads=None, patched=None):
+    """
+    Write the modified initrd without unpacking the original one.
+
+    The kernel accepts a concatenation of compressed cpio archives, and later
+    members replace earlier ones. The original initrd.gz is therefore copied
+    through unchanged, followed by an overlay archive holding the patched
+    scripts and the cdrom/ tree, streamed straight from the extracted ISO and
+    compressed with the selected backend. The patched scripts are built from
+    the original initrd unless given as (name, mode, data) tuples. Time spent
+    in the compressor is recorded as a separate "compress" span.
+    """
+    install_dir = os.path.join(extract_dir, 'install.amd')
+    initrd_gz = os.path.join(install_dir, 'initrd.gz')
+    if patched is None:
+        patched = patch_initrd_members(initrd_gz)
+
+    tmp_path = output_path + '.tmp'
+    with open(tmp_path, 'wb') as out:
+        with open(initrd_gz, 'rb') as original:
+            shutil.copyfileobj(original, out, CHUNK_SIZE)
+        overlay = TimedWriter(open_compressor(out, compression, level, threads))
+        write_overlay(overlay, extract_dir, patched)
+        overlay.close()
+    metrics.record('compress', overlay.seconds, compression=compression, output=output_path)
+    # Write a new file rather than truncating one that may be hardlinked into TFTP
+    os.replace(tmp_path, output_path)
+
+
+# The parts of a netinst ISO used by build_initrd and publish_iso
+ISO_MEMBERS = ('install.amd/initrd.gz', 'install.amd/vmlinuz', '.disk', 'pool', 'dists')
+
+
+def find_isos(root_dir):
+    """Return the paths of all ISOs under root_dir."""
+    isos = []
     for subdir, _, files in os.walk(root_dir):
         for file in files:
             if file.endswith(".iso"):
-                iso_path = os.path.join(subdir, file)
-                extract_dir = os.path.join(subdir, "extracted")
-                try:
+                isos.append(os.path.join(subdir, file))
+    return sorted(isos)
+
+
+def extract_iso(iso_path):
+    """
+    Extract the members of an ISO that the initrd build needs into an
+    'extracted' directory next to it.
+
+    Only ISO_MEMBERS are extracted (7z path filters), skipping boot loaders,
+    firmware, docs and the graphical installer. Anything left over from an
+    interrupted extraction is removed first.
+    """
+    extract_dir = os.path.join(os.path.dirname(iso_path), "extracted")
+    metrics.note(f"Extracting {iso_path} to {extract_dir}...")
+    shutil.rmtree(extract_dir, ignore_errors=True)
+    os.makedirs(extract_dir)
+    proc = subprocess.run(["7z", "x", "-y", iso_path, f"-o{extract_dir}", *ISO_MEMBERS],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        raise RuntimeError(f"Error extracting ISO: {proc.stderr.decode().strip()}")
+    return extract_dir
+
+
+def write_patched_members(initrd_gz, patched_dir):
+    """Write the patched installer scripts under patched_dir, keeping their modes."""
+    shutil.rmtree(patched_dir, ignore_errors=True)
+    for name, mode, data in patch_initrd_members(initrd_gz):
+        path = os.path.join(patched_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        os.chmod(path, stat.S_IMODE(mode))
+
+
+def read_patched_members(patched_dir):
+    """Read back the scripts written by write_patched_members as (name, mode, data)."""
+    patched = []
+    for dirpath, _, filenames in sorted(os.walk(patched_dir)):
+        for file in sorted(filenames):
+            path = os.path.join(dirpath, file)
+            with open(path, 'rb') as f:
+                patched.append((os.path.relpath(path, patched_dir), os.stat(path).st_mode, f.read()))
+    return patched
+
+
+def publish_iso(iso_path, extract_dir, initrd_path):
+    """Link the new initrd and the kernel into /var/lib/tftpboot/."""
+    tftp_dir = os.path.join(TFTP_DIR, iso_path.split('/')[-2])
+    os.makedirs(tftp_dir, exist_ok=True)
+    link_or_copy(initrd_path, os.path.join(tftp_dir, 'initrd-iso.gz'))
+    kernel_path = os.path.join(extract_dir, 'install.amd/vmlinuz')
+    kernel_digest = hash_file(kernel_path, 'sha256')
+    # Leave the extracted kernel alone, it is an input of the build state
+    tftp_blobs.add(kernel_path, 'sha256', kernel_digest, replace=False)
+    tftp_blobs.link('sha256', kernel_digest, os.path.join(tftp_dir, 'vmlinuz'))
 
 
-                    cdrom = os.path.join(extract_dir, 'install.amd/cdrom')
-                    # Define the source and destination directories
-                    src_dirs = [
-                        os.path.join(extract_dir, '.disk'),
-                        os.path.join(extract_dir, 'pool'),
-                        os.path.join(extract_dir, 'dists'),
-                        ]
-
-                    # Create the destination directory if it doesn't exist
-                    os.makedirs(cdrom, exist_ok=True)
-
-                    # Copy each directory from src_dirs to dest_dir
-                    for src in src_dirs:
-                        shutil.copytree(src, os.path.join(cdrom, os.path.basename(src)), dirs_exist_ok=True)
-
-                    print("Directories copied successfully.")
-
-                    
-                    # Add `sed -i '2s/-e/-x/'` command to specified file
-                    setup_script = os.path.join(extract_dir, "install.amd/usr/lib/base-installer.d/20console-setup")
-                    subprocess.run(["sed", "-i", "2s/-e/-x/", setup_script], check=True)
-
-                    # Execute ./initrd/usr/lib/base-installer.d/99copy-cdrom
-                    copy_cdrom_script = os.path.join(extract_dir, "install.amd/usr/lib/base-installer.d/99copy-cdrom")
-                    with open(copy_cdrom_script, "a") as script_file:
-                        script_file.write(
-                            "#!/bin/sh\n"
-                            "set -e\n"
-                            ". /usr/share/debconf/confmodule\n\n"
-                            "cp -r /cdrom  /target/media/cdrom\n"
-                            "sed -i '2s/-e/-x/' /usr/lib/apt-setup/generators/50mirror\n"
-                            "sed -i  '124s/use_mirror=false/use_mirror=true/g' /usr/lib/apt-setup/generators/50mirror"
-                        )
-                    os.chmod(copy_cdrom_script, os.stat(copy_cdrom_script).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
-                    # Append custom script lines to ./initrd/usr/lib/finish-install.d/11delete-cdrom
-                    finish_install_script = os.path.join(extract_dir, "install.amd/usr/lib/finish-install.d/11delete-cdrom")
-                    with open(finish_install_script, "a") as script_file:
-                        script_file.write(
-                            "#!/bin/sh\n"
-                            "set -e\n"
-                            ". /usr/share/debconf/confmodule\n\n"
-                            "rm -rf /target/media/cdrom/*\n"
-                        )
-
-                    os.chmod(finish_install_script, os.stat(finish_install_script).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
-
-
-                    # Run find command and recreate initrd file
-                    initrd_path = os.path.join(extract_dir, "install.amd/initrd-iso.gz")
-                    os.chdir(os.path.join(extract_dir,'install.amd'))
-
-                    result = subprocess.run(
-                    "find . | cpio -o -H newc | gzip > initrd-iso.gz",
-                    shell=True,
-                    stderr=subprocess.PIPE)
-
-
-                   
-
-                    # Copy the new initrd to /var/lib/tftpboot/
-                    os.makedirs(f"/var/lib/tftpboot/debian_processed/{iso_path.split('/')[-2]}",exist_ok=True)
-                    shutil.copy(initrd_path, f"/var/lib/tftpboot/debian_processed/{iso_path.split('/')[-2]}")
-                    shutil.copy(subdir+'/extracted/install.amd/vmlinuz', f"/var/lib/tftpboot/debian_processed/{iso_path.split('/')[-2]}")
-
-                    
-                    print(f"Processed and updated initrd for {iso_path}")
+Stage = collections.namedtuple('Stage', 'name inputs outputs params run')
 
+
+def fingerprint(paths, params=None):
+    """
+    Fingerprint files and directory trees from their names, sizes and mtimes.
+
+    Missing paths are part of the fingerprint, so a deleted output never
+    matches a recorded one.
+    """
+    digest = hashlib.sha256(json.dumps(params, sort_keys=True).encode())
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for file in sorted(filenames):
+                    st = os.lstat(os.path.join(dirpath, file))
+                    rel = os.path.relpath(os.path.join(dirpath, file), path)
+                    digest.update(f"{rel}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+        elif os.path.exists(path):
+            st = os.stat(path)
+            digest.update(f"{path}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+        else:
+            digest.update(f"{path}\0missing\n".encode())
+    return digest.hexdigest()
+
+
+def kept_paths(paths, evicted):
+    """Return the paths that are neither one of the evicted paths nor inside one."""
+    return [path for path in paths
+            if not any(path == root or path.startswith(root + os.sep) for root in evicted)]
+
+
+class BuildState:
+    """
+    Recorded input and output fingerprints of the pipeline stages of one ISO,
+    kept in build-state.json next to the ISO.
+    """
+
+    def __init__(self, iso_path):
+        self.path = os.path.join(os.path.dirname(iso_path), 'build-state.json')
+        try:
+            with open(self.path) as f:
+                self.stages = json.load(f)
+        except (OSError, ValueError):
+            self.stages = {}
+
+    def stale_reason(self, stage, inputs):
+        """Return why a stage has to run, or None if it is up to date."""
+        entry = self.stages.get(stage.name)
+        if entry is None:
+            return 'never run'
+        if entry['status'] == 'evicted':
+            return 'evicted'
+        if entry['status'] != 'done':
+            return 'interrupted'
+        if entry['inputs'] != inputs:
+            return 'inputs changed'
+        if entry['outputs'] != fingerprint(stage.outputs):
+            return 'outputs changed'
+        return None
+
+    def start(self, stage):
+        self.stages[stage.name] = {'status': 'running', 'inputs': None, 'outputs': None}
+        self.save()
+
+    def finish(self, stage):
+        self.stages[stage.name] = {
+            'status': 'done',
+            'inputs': fingerprint(stage.inputs, stage.params),
+            'outputs': fingerprint(stage.outputs),
+            'finished': time.time(),
+        }
+        self.save()
+
+    def evicted(self, stages):
+        """Return the outputs of the stages whose outputs were evicted."""
+        return [path for stage in stages
+                if self.stages.get(stage.name, {}).get('status') == 'evicted'
+                for path in stage.outputs]
+
+    def evict(self, stages, names):
+        """
+        Mark the outputs of the named stages as deliberately removed.
+
+        Every stage also records the fingerprint of its inputs without the
+        evicted paths, which evicted_reason() compares against later.
+        """
+        evicted = [path for stage in stages if stage.name in names for path in stage.outputs]
+        for stage in stages:
+            entry = self.stages[stage.name]
+            entry['kept_inputs'] = fingerprint(kept_paths(stage.inputs, evicted), stage.params)
+            if stage.name in names:
+                entry['status'] = 'evicted'
+        self.save()
+
+    def evicted_reason(self, stages):
+        """
+        Return why a build with evicted outputs has to run again, or None if
+        everything it published is still current without them.
+        """
+        evicted = self.evicted(stages)
+        for stage in stages:
+            entry = self.stages.get(stage.name)
+            if entry is None:
+                return f'{stage.name} never run'
+            if entry['status'] not in ('done', 'evicted'):
+                return f'{stage.name} interrupted'
+            if entry.get('kept_inputs') != fingerprint(kept_paths(stage.inputs, evicted), stage.params):
+                return f'{stage.name} inputs changed'
+            if entry['status'] == 'done' and entry['outputs'] != fingerprint(stage.outputs):
+                return f'{stage.name} outputs changed'
+        return None
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.stages, f, indent=4)
+        os.replace(tmp_path, self.path)
+
+
+def iso_stages(iso_path, compression='pigz', level=None, threads=None):
+    """
+    Return the build graph of one ISO: download, extract, patch, repack, publish.
+
+    Each stage lists the paths it reads and writes; the stage reruns when
+    the fingerprint of either differs from the one recorded after its last
+    successful run.
+    """
+    iso_dir = os.path.dirname(iso_path)
+    extract_dir = os.path.join(iso_dir, 'extracted')
+    initrd_gz = os.path.join(extract_dir, 'install.amd/initrd.gz')
+    kernel_path = os.path.join(extract_dir, 'install.amd/vmlinuz')
+    patched_dir = os.path.join(iso_dir, 'patched')
+    initrd_path = os.path.join(iso_dir, 'initrd-iso.gz')
+    tftp_dir = os.path.join(TFTP_DIR, iso_path.split('/')[-2])
+    return [
+        # Downloads are made by the Downloader threads before the build
+        Stage('download', [], [iso_path], None, None),
+        Stage('extract', [iso_path], [extract_dir], {'members': ISO_MEMBERS},
+              lambda: extract_iso(iso_path)),
+        Stage('patch', [initrd_gz], [patched_dir],
+              {'scripts': [COPY_CDROM_SCRIPT, DELETE_CDROM_SCRIPT]},
+              lambda: write_patched_members(initrd_gz, patched_dir)),
+        Stage('repack', [initrd_gz, patched_dir] + [os.path.join(extract_dir, d) for d in ('.disk', 'pool', 'dists')],
+              [initrd_path], {'compression': compression, 'level': level},
+              lambda: build_initrd(extract_dir, initrd_path, compression, level, threads,
+                                   read_patched_members(patched_dir))),
+        Stage('publish', [initrd_path, kernel_path],
+              [os.path.join(tftp_dir, 'initrd-iso.gz'), os.path.join(tftp_dir, 'vmlinuz')],
+              {'tftp_dir': tftp_dir},
+              lambda: publish_iso(iso_path, extract_dir, initrd_path)),
+    ]
+
+
+def process_iso(iso_path, compression='pigz', level=None, threads=None, dry_run=False):
+    """
+    Bring the build of one ISO up to date, running only its stale stages.
+
+    Runs in a worker process; every path is absolute so the working
+    directory is never changed. A stage is marked running in build-state.json
+    before it starts, so one that was interrupted is redone on the next run.
+    Stages whose outputs were evicted only rerun when a later stage needs
+    them again. With dry_run, nothing is run and the plan is only reported.
+
+    Returns:
+        tuple: (seconds spent, list of (stage, reason) for the stages that ran
+            or would run, the worker's metrics to merge into the parent's).
+    """
+    started = time.monotonic()
+    state = BuildState(iso_path)
+    stages = iso_stages(iso_path, compression, level, threads)
+    if state.evicted(stages) and state.evicted_reason(stages) is None:
+        # Published before its workspace was evicted, and nothing changed since
+        return time.monotonic() - started, [], metrics.drain()
+    plan = []
+    upstream_stale = False
+    for stage in stages:
+        inputs = fingerprint(stage.inputs, stage.params)
+        reason = 'upstream changed' if dry_run and upstream_stale else state.stale_reason(stage, inputs)
+        if stage.run is None:
+            if not all(os.path.exists(path) for path in stage.outputs):
+                raise RuntimeError(f"{stage.name}: outputs missing")
+            if reason is not None and not dry_run:
+                state.finish(stage)
+            continue
+        if reason is None:
+            continue
+        plan.append((stage.name, reason))
+        upstream_stale = True
+        if dry_run:
+            continue
+        state.start(stage)
+        with metrics.span(stage.name, iso=iso_path, reason=reason):
+            stage.run()
+        state.finish(stage)
+    return time.monotonic() - started, plan, metrics.drain()
+
+
+# Stages whose outputs (WORKSPACE_DIRS) are removed when a workspace is evicted
+EVICTABLE_STAGES = ('extract', 'patch')
+
+
+def workspace_need(iso_path, compression='pigz', level=None):
+    """Estimate how many bytes building an ISO adds to its workspace."""
+    if os.path.isdir(os.path.join(os.path.dirname(iso_path), WORKSPACE_DIRS[0])):
+        # Re-extracting replaces the tree in place
+        return 0
+    state = BuildState(iso_path)
+    stages = iso_stages(iso_path, compression, level)
+    if state.evicted(stages) and state.evicted_reason(stages) is None:
+        return 0
+    # The extracted members are a subset of the ISO
+    return os.path.getsize(iso_path)
+
+
+def evict_workspace(iso_path, compression='pigz', level=None):
+    """
+    Record the eviction of an ISO's workspace if everything built from it is
+    published and verified, i.e. every stage is up to date.
+
+    Returns:
+        bool: True if the workspace may be removed.
+    """
+    state = BuildState(iso_path)
+    stages = iso_stages(iso_path, compression, level)
+    if state.evicted(stages):
+        # Left behind by an interrupted eviction
+        return state.evicted_reason(stages) is None
+    for stage in stages:
+        if state.stale_reason(stage, fingerprint(stage.inputs, stage.params)) is not None:
+            return False
+    state.evict(stages, EVICTABLE_STAGES)
+    return True
+
+
+def process_isos(root_dir, workers=None, compression='pigz', level=None, threads=None, dry_run=False,
+                 budget=None, min_free=0):
+    """
+    Process every ISO under root_dir on a pool of worker processes.
+
+    Builds are admitted one at a time within the workspace disk budget: idle
+    workspaces whose outputs are published are evicted least recently used
+    first to make room for an extraction, and new builds wait for running
+    ones while there is still not enough space.
+
+    Args:
+        threads (int): Compression threads per ISO; defaults to the CPUs
+            divided between the workers.
+        budget (int): Maximum bytes of extracted trees and patched scripts,
+            None for no limit.
+        min_free (int): Bytes to keep free on the volume of root_dir.
+    """
+    isos = find_isos(root_dir)
+    workers = workers or os.cpu_count()
+    # Share the CPUs between the ISOs built at once rather than giving each all of them
+    threads = threads or max(1, os.cpu_count() // workers)
+    workspaces = None if dry_run else Workspaces(root_dir, budget, min_free)
+    iso_by_dir = {os.path.dirname(iso_path): iso_path for iso_path in isos}
+
+    def evict(iso_dir):
+        # Nothing can be rebuilt from the workspace of an ISO that is gone
+        return iso_dir not in iso_by_dir or evict_workspace(iso_by_dir[iso_dir], compression, level)
+
+    failed = 0
+    done = 0
+    pending = collections.deque(isos)
+    paused = None
+    # Workers come from a fork server rather than this process: forking while a
+    # metrics exporter thread holds the registry lock would deadlock the child
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver'),
+                             initializer=metrics.init_worker, initargs=metrics.settings()) as pool:
+        futures = {}
+        while pending or futures:
+            while pending and len(futures) < workers:
+                iso_path = pending[0]
+                if workspaces is not None:
+                    iso_dir = os.path.dirname(iso_path)
+                    need = workspace_need(iso_path, compression, level)
+                    if not workspaces.make_room(iso_dir, need, evict):
+                        if futures:
+                            if paused != iso_path:
+                                paused = iso_path
+                                metrics.note(f"Pausing extractions: {iso_path} needs "
+                                             f"{format_size(need)}, {workspaces.summary()}")
+                                metrics.inc("workspace_pauses_total")
+                            break
+                        print(f"Not enough space for {iso_path} even with every idle workspace "
+                              f"evicted ({workspaces.summary()}), building it alone")
+                        workspaces.reserve(iso_dir, need)
+                pending.popleft()
+                futures[pool.submit(process_iso, iso_path, compression, level, threads, dry_run)] = iso_path
+            finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in finished:
+                iso_path = futures.pop(future)
+                done += 1
+                if workspaces is not None:
+                    workspaces.release(os.path.dirname(iso_path))
+                try:
+                    elapsed, plan, worker_metrics = future.result()
+                    metrics.merge(worker_metrics)
+                    stages = ', '.join(f"{name} ({reason})" for name, reason in plan) or 'up to date'
+                    if dry_run:
+                        print(f"[{done}/{len(isos)}] {iso_path}: {stages}")
+                    else:
+                        print(f"[{done}/{len(isos)}] {iso_path}: {stages} in {elapsed:.1f}s")
                 except Exception as e:
-                    print(f"Error processing {iso_path}: {e}")
-                finally:
-                    # Cleanup extracted directory
-                    #shutil.rmtree(extract_dir, ignore_errors=True)
-                    pass
-
-def process_debian_isos(root_dir):
-    # Iterate over each subdirectory in the root directory
-    for subdir, _, files in os.walk(root_dir):
-        for file in files:
-            if file.endswith(".iso"):
-                iso_path = os.path.join(subdir, file)
-                extract_dir = os.path.join(subdir, "extracted")
-                
-                # Step 1: Extract ISO using 7z
-                print(f"Extracting {iso_path} to {extract_dir}...")
-                os.makedirs(extract_dir, exist_ok=True)
-                if not len(os.listdir(extract_dir)) > 0 : 
-
-                    # Ensure the extraction completes before moving on
-                    with subprocess.Popen(["7z", "x", iso_path, f"-o{extract_dir}"],
-                                            stdout=subprocess.PIPE, stderr=subprocess.PIPE) as proc:
-                            stdout, stderr = proc.communicate()
-                            if proc.returncode != 0:
-                                print(f"Error extracting ISO: {stderr.decode().strip()}")
-                                return
-                            else:
-                                print(f"Extraction successful:\n{stdout.decode().strip()}")
-                    print(f"{extract_dir}/install.amd/initrd.gz")
-
-                    # Change to the directory where initrd.gz is located
-                    os.chdir(os.path.dirname(f"{extract_dir}/install.amd/"))
-                    with subprocess.Popen(f"zcat initrd.gz | cpio -i ", shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as proc:
-                        stdout, stderr = proc.communicate()
-                        
-                        # Check for errors
-                        if proc.returncode != 0:
-                            print(f"Error extracting initrd: {stderr.decode().strip()}")
-                            return
-                        else:
-                            print(f"Extraction successful:\n{stdout.decode().strip()}")
+                    failed += 1
+                    print(f"[{done}/{len(isos)}] Error processing {iso_path}: {e}")
+    print(f"Processed {len(isos) - failed} of {len(isos)} ISOs, {failed} failed")
+    if workspaces is not None:
+        print(f"Workspaces: {workspaces.summary()}")
                 
 
 ################################# END OF INITRD SECTION #########################3
 
 
 def main():
-    threads = []
-    q = Queue(maxsize=0)
+    parser = argparse.ArgumentParser(description="Download and process Debian netinst ISOs.")
+    parser.add_argument("--threads", type=int, default=20,
+                        help="maximum number of files downloaded at once; the pool grows "
+                             "up to this while throughput improves (default: 20)")
+    parser.add_argument("--mirror", action="append", metavar="URL",
+                        help=f"base URL of another copy of {ISO_ARCHIVE}, e.g. a local mirror; "
+                             "segments are spread over all mirrors by measured bandwidth")
+    parser.add_argument("--per-mirror", type=int, default=PER_MIRROR,
+                        help="maximum number of transfers (range segments or whole-file streams) "
+                             f"running at once against one mirror host (default: {PER_MIRROR})")
+    parser.add_argument("--priority", action="append", metavar="VERSION",
+                        help="download releases matching this version or prefix (e.g. 12 or "
+                             "11.9) first; repeat for more tags (default: newest major release)")
+    parser.add_argument("--segments", type=int, default=SEGMENTS,
+                        help="number of parallel range requests per file")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE // (1024 * 1024),
+                        help="download chunk size in MiB")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="number of ISOs processed at once (default: number of CPUs)")
+    parser.add_argument("--compression", choices=COMPRESSORS, default='pigz',
+                        help="compression of the rebuilt initrd overlay (default: pigz, "
+                             "parallel gzip; xz and zstd need kernel support)")
+    parser.add_argument("--level", type=int, help="compression level (default depends on --compression)")
+    parser.add_argument("--compress-threads", type=int,
+                        help="threads per ISO for pigz and zstd (default: number of CPUs "
+                             "divided by --workers)")
+    parser.add_argument("--cache-dir", default=default_cache_dir(),
+                        help="directory of the persistent HTTP cache for index pages and checksums")
+    parser.add_argument("--cache-size", type=int, default=1024,
+                        help="maximum size of the HTTP cache in MiB (default: 1024)")
+    parser.add_argument("--rate", type=float, default=10.0,
+                        help="maximum requests per second to each host; halved whenever the "
+                             "server answers 429 or 503 (default: 10)")
+    parser.add_argument("--workspace-budget", type=float, metavar="GIB",
+                        help="maximum size of the extracted ISO trees kept for rebuilds; the least "
+                             "recently used ones are evicted once published (default: no limit)")
+    parser.add_argument("--min-free", type=float, default=2.0, metavar="GIB",
+                        help="free space to keep on the image volume; extractions pause below it "
+                             "(default: 2)")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="print which ISOs are missing and which build stages would run, "
+                             "without downloading or building anything")
+    parser.add_argument("--benchmark-compression", metavar="PATH",
+                        help="compare compression backends on an extracted ISO directory "
+                             "or an uncompressed file, then exit")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    metrics.setup(args)
 
-    versions = get_versions('https://get.debian.org/images/archive/')
-    for dlParm in versions[:]:
-        dl = dlParm,'/images/debian-versions'
-        q.put(dl)
+    global http_client, scheduler, mirrors
+    mirrors = MirrorManager([ISO_ARCHIVE] + (args.mirror or []))
+    scheduler = RequestScheduler(ConnectionPool(), args.rate, args.threads * args.segments)
+    http_client = HttpCache(scheduler, args.cache_dir, args.cache_size * 1024 * 1024)
 
-  
+    if args.benchmark_compression:
+        benchmark_compression(args.benchmark_compression, args.compress_threads)
+        return
 
-    for i in range(20):
-        worker = Downloader(i, q)
-        worker.start()
-        threads.append(worker)
+    global downloadTotal
+    os.makedirs('/images/debian-versions', exist_ok=True)
+    manifest = Manifest('/images/debian-versions/manifest.json')
 
-    while has_live_threads(threads):
-        try:
-            [t.join(1) for t in threads if t is not None and t.is_alive()]
-        except KeyboardInterrupt:
-            print('\nSending kill to threads, you will need to wait for the remaining downloads to finish (the impatient will need to kill from console)....\n')
-            for t in threads:
-                t.kill_received = True
+    versions = get_versions(f'{ISO_ARCHIVE}/')
+    if args.dry_run:
+        for url in versions:
+            if not os.path.exists(iso_path_for(url, '/images/debian-versions')):
+                print(f"download: {url}")
+        process_isos('/images/debian-versions', args.workers, args.compression, args.level,
+                     args.compress_threads, dry_run=True)
+        return
+
+    # Newest release first unless told otherwise
+    tags = args.priority or sorted({version_of(url).split('.')[0] for url in versions}, key=int)[-1:]
+    q, total_size = queue_downloads(versions, '/images/debian-versions', manifest, tags)
+    downloadTotal = q.qsize()
+    if len(mirrors) > 1 and not q.empty():
+        mirrors.probe(q.queue[0][3])
+    print(f"{downloadTotal} ISOs to download ({total_size / 1024 / 1024 / 1024:.1f} GiB), "
+          f"priority {', '.join(tags) or 'none'}")
+    with metrics.span('downloads'), manifest:
+        run_downloaders(q, manifest, args.threads, args.per_mirror, args.segments, args.chunk_size * 1024 * 1024)
+    if cancel.is_set():
+        metrics.finish(args.metrics_file)
+        return
 
     print('All items downloaded\n\n')
 
     # Specify the directory where the ISO files are located
     iso_directory = "/images/debian-versions"
-    process_debian_isos(iso_directory)
-    process_initrd(iso_directory)
+    with metrics.span('build'):
+        process_isos(iso_directory, args.workers, args.compression, args.level, args.compress_threads,
+                     budget=None if args.workspace_budget is None else int(args.workspace_budget * 1024 ** 3),
+                     min_free=int(args.min_free * 1024 ** 3))
+    metrics.finish(args.metrics_file)
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -1,98 +1,260 @@
-import urllib.request
-import urllib.error
 import http.client
-import re
+import argparse
+import hashlib
+import time
 from pathlib import Path
-from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_fixed
 import json
-from threading import Thread, Lock
-
-# Thread-safe lock for shared resources
-data_lock = Lock()
-
-@retry(
-    retry=(
-        retry_if_exception_type(urllib.error.HTTPError) |
-        retry_if_exception_type(http.client.HTTPException)
-    ),
-    wait=wait_fixed(5),
-    stop=stop_after_attempt(100),
-)
-def get_timestamps(archive):
-    """Fetches the timestamps for all available Debian snapshots for a given archive."""
-    months = []
-    with urllib.request.urlopen(f"https://snapshot.debian.org/archive/{archive}/") as f:
-        for line in f:
-            res = re.fullmatch(
-                r'<a href="\./\?year=(?P<year>\d+)&amp;month=(?P<month>\d+)">\d+</a>\n',
-                line.decode("utf-8"),
-            )
-            if res is None:
-                continue
-            months.append((int(res.group("year")), int(res.group("month"))))
+import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from queue import Queue
+from threading import Event, Lock, Thread
+from snapshot_store import SnapshotStore
+from snapshot_index import SnapshotIndex
+from preseed import MIRROR_HOST, load_overrides, render_preseeds
+from checksums import CHECKSUM_FILES, Manifest, hash_file, parse_checksums
+from blob_store import BlobStore
+from parsers import parse_months, parse_readme, parse_timestamps
+from http_cache import (ConnectionPool, HTTPStatusError, HttpCache, RequestScheduler, default_cache_dir,
+                        fetch_with_redirect, open_with_redirect)
+from mirrors import MirrorManager
+import metrics
+
+SNAPSHOT_URL = "https://snapshot.debian.org"
+CHUNK_SIZE = 1024 * 1024
+
+
+def get_timestamps(client, archive):
+    """
+    Fetches the timestamps for all available Debian snapshots for a given archive.
+
+    Throttling and server errors are retried by the client's RequestScheduler.
+    """
+    url = f"{SNAPSHOT_URL}/archive/{archive}/"
+    status, _, body = fetch_with_redirect(client, "GET", url)
+    if status != 200:
+        raise http.client.HTTPException(f"HTTP {status} for {url}")
+    months = parse_months(body)
     assert len(months) > 0
     return months
 
-def fetch_timestamp_data(archive, year, month, existing_timestamps, outdir):
-    """Fetches timestamp data for each Debian snapshot release."""
-    url = f"https://snapshot.debian.org/archive/{archive}/?year={year}&month={month}"
-    with urllib.request.urlopen(url) as f:
-        for line in f:
-            res = re.fullmatch(
-                r"<a href=\"(\d{8}T\d{6}Z)/\">\d\d\d\d-\d\d-\d\d \d\d:\d\d:\d\d</a><br />\n",
-                line.decode("utf-8"),
-            )
-            if res is None:
-                continue
-
-            timestamp = res.group(1)
-            if timestamp in existing_timestamps:
-                print(f"Skipping already processed timestamp: {timestamp}")
-                continue
-
-            releases_list = fetch_with_redirect(
-                f"https://snapshot.debian.org/archive/{archive}/{timestamp}/README", timestamp
-            )
-            if releases_list:
-                with data_lock:  # Lock access to shared resources
-                    # Add new data without overwriting existing entries
-                    existing_data = load_existing_data(outdir / "debian.json")
-                    if timestamp not in existing_data:
-                        existing_data[timestamp] = releases_list
-                    save_data_to_file(existing_data, outdir / "debian.json")
-                    print(f"Saved data for timestamp: {timestamp}")
-
-def fetch_with_redirect(url, timestamp, max_redirects=10):
-    """Handles URL redirection and fetches the content."""
-    redirects = 0
-    while redirects < max_redirects:
-        try:
-            with urllib.request.urlopen(url) as response:
-                return extract_debian_versions(response.read().decode('utf-8'), timestamp)
-        except urllib.error.HTTPError as e:
-            if e.code == 404:
-                return None  # Skip this URL
-            if e.code in (301, 302, 303, 307, 308):
-                url = e.headers.get('Location')
-                redirects += 1
+class MonthProgress:
+    """Tracks the outstanding README fetches of one month listing."""
+
+    def __init__(self, store, year, month, etag, last_modified):
+        self.store = store
+        self.year = year
+        self.month = month
+        self.etag = etag
+        self.last_modified = last_modified
+        self.pending = 1  # The listing itself
+        self.failed = False
+        self.lock = Lock()
+
+    def add(self):
+        with self.lock:
+            self.pending += 1
+
+    def done(self, ok=True):
+        """Mark one job finished; checkpoint the month once every job succeeded."""
+        with self.lock:
+            self.pending -= 1
+            self.failed |= not ok
+            finished = self.pending == 0 and not self.failed
+        if finished:
+            self.store.set_month(self.year, self.month, self.etag, self.last_modified, True)
+
+class ReadmeResolver:
+    """
+    Resolves snapshot READMEs while downloading as few of them as possible.
+
+    The README only changes when a point release happens, so each timestamp
+    is first probed with a HEAD request and the parsed releases are reused
+    whenever its ETag (or size and Last-Modified) has been seen before.
+    """
+
+    def __init__(self, client, archive):
+        self.client = client
+        self.archive = archive
+        self.parsed = {}  # Fingerprint -> parsed releases, None for a missing README
+        self.fingerprints = {}  # Timestamp -> fingerprint
+        self.lock = Lock()
+        self.downloads = 0
+        self.reused = 0
+
+    def fingerprint(self, timestamp):
+        """Return an identifier of the README content at a timestamp."""
+        with self.lock:
+            if timestamp in self.fingerprints:
+                return self.fingerprints[timestamp]
+        url = f"{SNAPSHOT_URL}/archive/{self.archive}/{timestamp}/README"
+        status, headers, _ = fetch_with_redirect(self.client, "HEAD", url)
+        fingerprint = readme_validator(status, headers)
+        with self.lock:
+            cached = fingerprint is not None and fingerprint in self.parsed
+        if not cached:
+            status, headers, body = fetch_with_redirect(self.client, "GET", url)
+            if status == 200:
+                fingerprint = (fingerprint or readme_validator(status, headers)
+                               or "sha256:" + hashlib.sha256(body).hexdigest())
+                with metrics.span("parse", page="readme", timestamp=timestamp):
+                    parsed = parse_readme(body)
+            else:
+                fingerprint, parsed = "missing", None
+            with self.lock:
+                self.parsed[fingerprint] = parsed
+                self.downloads += 1
+            metrics.inc("readmes_total", result="downloaded")
+        else:
+            with self.lock:
+                self.reused += 1
+            metrics.inc("readmes_total", result="reused")
+        with self.lock:
+            self.fingerprints[timestamp] = fingerprint
+        return fingerprint
+
+    def releases(self, timestamp, fingerprint=None):
+        """
+        Return the releases listed at a timestamp in the extract_debian_versions layout.
+
+        Args:
+            timestamp (str): Snapshot timestamp.
+            fingerprint (str): Known fingerprint of the README, to skip probing it.
+        """
+        if fingerprint is None:
+            fingerprint = self.fingerprint(timestamp)
+        with self.lock:
+            parsed = self.parsed.get(fingerprint)
+        if parsed is None:
+            return None
+        return releases_at(parsed, timestamp)
+
+    def summary(self):
+        with self.lock:
+            return f"{self.downloads} READMEs downloaded, {self.reused} reused from cache"
+
+def readme_validator(status, headers):
+    """Build a cache key for a README from its response headers, if they allow one."""
+    if status == 404:
+        return "missing"
+    if status != 200:
+        return None
+    if headers.get("ETag"):
+        return "etag:" + headers["ETag"]
+    if headers.get("Content-Length") and headers.get("Last-Modified"):
+        return f"size:{headers['Content-Length']}:{headers['Last-Modified']}"
     return None
 
-def extract_debian_versions(text, timestamp):
-    """Extracts the Debian versions from the README content."""
-    results = {}
-    debian_pattern = re.compile(
-        r"Debian\s+([\d.]+r?\d*)[^\n]*,\s+or\s+(\w+)\.\s+Access this release through\s+(\S+)",
-        re.MULTILINE | re.IGNORECASE
+def store_releases(store, timestamp, releases_list):
+    if not releases_list:
+        return
+    with metrics.span("persist", timestamp=timestamp) as fields:
+        fields["added"] = store.add(timestamp, releases_list)
+    if fields["added"]:
+        metrics.inc("snapshots_total", result="stored")
+        metrics.note(f"Saved data for timestamp: {timestamp}")
+
+def fetch_timestamp_data(resolver, jobs, year, month, store, conditional=False, bisect=False):
+    """
+    Fetches a month listing and queues README lookups for each new timestamp.
+
+    With conditional set, the listing is requested with the ETag and
+    Last-Modified recorded for the month, and skipped if it is unchanged.
+    With bisect set, the new timestamps of the month are resolved as one
+    range by resolve_range instead of one README at a time.
+    """
+    metrics.note(f"Processing year {year}, month {month}")
+    url = f"{SNAPSHOT_URL}/archive/{resolver.archive}/?year={year}&month={month}"
+    headers = {}
+    if conditional:
+        state = store.get_month(year, month)
+        if state["etag"]:
+            headers["If-None-Match"] = state["etag"]
+        if state["last_modified"]:
+            headers["If-Modified-Since"] = state["last_modified"]
+    status, response_headers, body = resolver.client.request("GET", url, headers)
+    if status == 304:
+        metrics.inc("listings_total", result="unchanged")
+        metrics.note(f"Listing for {year}-{month:02d} unchanged, skipping")
+        return
+    if status != 200:
+        metrics.inc("listings_total", result="failed")
+        print(f"Failed to fetch listing for {year}-{month:02d}: HTTP {status}")
+        return
+    metrics.inc("listings_total", result="fetched")
+
+    progress = MonthProgress(
+        store, year, month, response_headers.get("ETag"), response_headers.get("Last-Modified")
     )
+    new_timestamps = []
+    with metrics.span("parse", page="listing", year=year, month=month):
+        timestamps = parse_timestamps(body)
+    for timestamp in timestamps:
+        if timestamp in store:
+            metrics.inc("snapshots_total", result="skipped")
+            metrics.note(f"Skipping already processed timestamp: {timestamp}")
+            continue
+        new_timestamps.append(timestamp)
+
+    if bisect and new_timestamps:
+        progress.add()
+        jobs.put((resolve_range, (resolver, jobs, sorted(new_timestamps), store, progress)))
+    else:
+        for timestamp in new_timestamps:
+            progress.add()
+            jobs.put((fetch_readme, (resolver, timestamp, store, progress)))
+    progress.done()
+
+def fetch_readme(resolver, timestamp, store, progress):
+    """Fetches the README of one snapshot and stores the releases it lists."""
+    ok = False
+    try:
+        store_releases(store, timestamp, resolver.releases(timestamp))
+        ok = True
+    finally:
+        progress.done(ok)
+
+def resolve_range(resolver, jobs, timestamps, store, progress):
+    """
+    Resolve a sorted run of timestamps by bisection.
 
-    for match in debian_pattern.finditer(text):
-        version = match.group(1)
-        version_name = match.group(2)
+    If the READMEs at both ends of the run are identical, every snapshot in
+    between is assumed to list the same releases and none of them is fetched.
+    Otherwise the run is split in half and both halves are queued, so only
+    the READMEs around a release change are ever downloaded.
+    """
+    ok = False
+    try:
+        first, last = timestamps[0], timestamps[-1]
+        first_fingerprint = resolver.fingerprint(first)
+        if first_fingerprint == resolver.fingerprint(last):
+            for timestamp in timestamps:
+                store_releases(store, timestamp, resolver.releases(timestamp, first_fingerprint))
+        elif len(timestamps) > 2:
+            middle = len(timestamps) // 2
+            for half in (timestamps[:middle + 1], timestamps[middle:]):
+                progress.add()
+                jobs.put((resolve_range, (resolver, jobs, half, store, progress)))
+        else:
+            for timestamp in timestamps:
+                store_releases(store, timestamp, resolver.releases(timestamp))
+        ok = True
+    finally:
+        progress.done(ok)
+
+def releases_at(parsed, timestamp):
+    """Expands parsed README releases into the per-timestamp layout stored in debian.json."""
+    results = {}
+    for version_name, version in parsed:
         if version_name not in results:
             results[version_name] = []
         results[version_name].append({"version": version, "timestamp": timestamp})
     return results
 
+def extract_debian_versions(text, timestamp):
+    """Extracts the Debian versions from the README content."""
+    return releases_at(parse_readme(text), timestamp)
+
 def load_existing_data(file_name):
     """Load existing data from a JSON file."""
     if Path(file_name).exists():
@@ -101,305 +263,376 @@ def load_existing_data(file_name):
     return {}
 
 def save_data_to_file(data, file_name):
-    """Save the fetched data to a JSON file."""
+    """Save the fetched data to a JSON file, replacing it atomically."""
+    tmp_name = f"{file_name}.tmp"
     try:
-        with open(file_name, "w") as file:
+        with open(tmp_name, "w") as file:
             json.dump(data, file, indent=4)
+        os.replace(tmp_name, file_name)
     except Exception as e:
         print(f"Error saving data to file: {e}")
 
-def save_latest_timestamps(data, outdir):
+def save_latest_timestamps(index, outdir):
     """
     Save the latest timestamp for each Debian version.
 
     Args:
-        data (dict): The JSON data containing Debian releases.
+        index (SnapshotIndex): Index over the stored Debian releases.
         outdir (Path): The output directory where the stamps.json file will be saved.
     """
-    latest_timestamps = {}
-    
-    # Iterate over all timestamps and their corresponding releases
-    for timestamp, releases in data.items():
-        for version_name, versions in releases.items():
-            # Handle both lists and dictionaries for versions
-            if isinstance(versions, list):
-                for version_data in versions:
-                    version = version_data["version"]
-                    # Update with the latest timestamp for each version
-                    if version not in latest_timestamps or timestamp > latest_timestamps[version]["timestamp"]:
-                        latest_timestamps[version] = {
-                            "version_name": version_name,
-                            "timestamp": timestamp
-                        }
-            elif isinstance(versions, dict):
-                version = versions["version"]
-                # Update with the latest timestamp for each version
-                if version not in latest_timestamps or timestamp > latest_timestamps[version]["timestamp"]:
-                    latest_timestamps[version] = {
-                        "version_name": version_name,
-                        "timestamp": timestamp
-                    }
-    
-    # Save the final result to the JSON file
     stamps_file = outdir / "stamps.json"
-    save_data_to_file(latest_timestamps, stamps_file)
+    save_data_to_file(index.latest_stamps(), stamps_file)
     print(f"Latest timestamps for each version saved to {stamps_file}")
 
 
 
-def download_file(url, output_path):
-    """Download a file from a URL to the specified output path."""
+def fetch_installer_checksums(client, images_url):
+    """
+    Fetch the checksums published for the installer images of a release.
+
+    Returns:
+        tuple: (algorithm, dict of "./netboot/..." paths to hex digests). The
+            dict is empty if the release publishes no checksum file.
+    """
+    for sums_name, algorithm in CHECKSUM_FILES:
+        status, _, body = fetch_with_redirect(client, "GET", f"{images_url}/{sums_name}")
+        if status == 200:
+            return algorithm, parse_checksums(body.decode("utf-8"))
+    return "sha256", {}
+
+def download_file(url, output_path, algorithm="sha256", expected=None, manifest=None, blobs=None,
+                  scheduler=None, mirrors=None):
+    """
+    Download a file from a URL to the specified output path.
+
+    The file is streamed to a ".part" file, hashed in the same pass, checked
+    against the Content-Length and the expected digest, and only then renamed
+    into place, so an existing output path is always complete. Verified files
+    are recorded in the manifest, and a file already in the manifest is
+    skipped without being read again. With a blob store, a file whose
+    expected digest is already stored is linked instead of downloaded, and
+    new downloads are added to the store. With a scheduler, the download is
+    rate limited and retried like other requests. With mirrors, the file is
+    fetched from the mirror spread() picks and the others are tried in turn
+    if it fails; url stays the origin URL in the manifest.
+
+    Returns:
+        tuple: (result, bytes downloaded), where result is one of "verified",
+            "linked", "recorded", "downloaded" or "failed".
+    """
+    with metrics.span("download", url=url) as fields:
+        result, size = _download_file(url, output_path, algorithm, expected, manifest, blobs, scheduler, mirrors)
+        fields["result"], fields["bytes"] = result, size
+    metrics.inc("downloads_total", kind="netboot", result=result)
+    metrics.inc("download_bytes_total", size, kind="netboot")
+    return result, size
+
+
+def _download_file(url, output_path, algorithm, expected, manifest, blobs, scheduler, mirrors):
+    if manifest is not None and manifest.lookup(output_path):
+        return "verified", 0
+    if blobs is not None and expected is not None and blobs.has(algorithm, expected):
+        blobs.link(algorithm, expected, output_path)
+        if manifest is not None:
+            manifest.record(output_path, algorithm, expected, url)
+        return "linked", 0
     if output_path.exists():
-        print(f"File already exists: {output_path}, skipping download.")
-        return
+        if manifest is None:
+            return "verified", 0
+        digest = hash_file(output_path, algorithm)
+        if expected is None or digest == expected:
+            manifest.record(output_path, algorithm, digest, url)
+            return "recorded", 0
+        print(f"Checksum mismatch for existing {output_path}, downloading again.")
+        output_path.unlink()
+    part_path = output_path.with_name(output_path.name + ".part")
+    # Downloads share the keep-alive connections of the scheduler's pool
+    pool = scheduler.pool if scheduler is not None else ConnectionPool()
     try:
-        print(f"Downloading: {url}")
-        with urllib.request.urlopen(url) as response:
-            with open(output_path, "wb") as out_file:
-                out_file.write(response.read())
-        print(f"File saved to: {output_path}")
+        def fetch(source):
+            def send():
+                status, headers, response = open_with_redirect(pool, source)
+                if status != 200:
+                    return status, headers, None
+                digest = hashlib.new(algorithm)
+                size = 0
+                with response, open(part_path, "wb") as out_file:
+                    for chunk in iter(lambda: response.read(CHUNK_SIZE), b""):
+                        digest.update(chunk)
+                        out_file.write(chunk)
+                        size += len(chunk)
+                length = headers.get("Content-Length")
+                if length is not None and size != int(length):
+                    raise http.client.IncompleteRead(b"", int(length) - size)
+                return status, headers, (digest, size)
+
+            if scheduler is None:
+                status, _, result = send()
+            else:
+                status, _, result = scheduler.call(source, send, None if mirrors is None else mirrors.retries())
+            if result is None:
+                raise HTTPStatusError(status, source)
+            return result
+
+        if mirrors is None:
+            digest, size = fetch(url)
+        else:
+            digest, size = mirrors.fetch(url, fetch, mirrors.spread(url, 1)[0])
+        if expected is not None and digest.hexdigest() != expected:
+            part_path.unlink()
+            print(f"Checksum mismatch for {url}: expected {expected}, got {digest.hexdigest()}")
+            return "failed", size
+        os.replace(part_path, output_path)
+        if blobs is not None:
+            blobs.add(output_path, algorithm, digest.hexdigest())
+        if manifest is not None:
+            manifest.record(output_path, algorithm, digest.hexdigest(), url)
+        return "downloaded", size
     except Exception as e:
         print(f"Failed to download {url}: {e}")
+        if part_path.exists():
+            part_path.unlink()
+        return "failed", 0
 
-def create_preseed_file(base_dir, stamps_file):
+def create_preseed_file(base_dir, stamps_file, workers=8, mirror_host=MIRROR_HOST, overrides=None):
     """
     Create a preseed file for each version and save it in the respective directory.
 
+    Preseeds are re-rendered on every run and only rewritten when their
+    content changed, so template or timestamp changes reach every version.
+
     Args:
         base_dir (Path): The base directory where the JSON file is located.
         stamps_file (Path): Path to the stamps.json file containing version names and timestamps.
+        workers (int): Number of preseeds rendered at once.
+        mirror_host (str): host[:port] the installers fetch packages from.
+        overrides (dict): Per-codename preseed fields, see load_overrides().
     """
     # Load the stamps.json data
     stamps_data = load_existing_data(stamps_file)
-
-    # Define the preseed template
-    preseed_template = """### Localization Settings
-d-i debian-installer/language string en
-d-i debian-installer/country string US
-d-i debian-installer/locale string en_US
-
-### Keyboard Settings
-d-i console-keymaps-at/keymap select us
-d-i keyboard-configuration/xkb-keymap select us
-
-### Network Configuration
-d-i netcfg/choose_interface select auto
-d-i netcfg/get_hostname string unassigned-hostname
-d-i netcfg/get_domain string unassigned-domain
-
-### Firmware Loading
-d-i hw-detect/load_firmware boolean true
-
-### Mirror Configuration
-d-i mirror/protocol string http
-d-i mirror/http/hostname string snapshot.debian.org
-d-i mirror/http/directory string /archive/debian/{timestamp}
-d-i mirror/http/proxy string
-d-i mirror/country string manual
-d-i apt-setup/use_mirror boolean false
-d-i apt-setup/services-select multiselect
-
-### Static sources.list
-d-i preseed/late_command string \\
-echo "deb http://snapshot.debian.org/archive/debian/{timestamp} stable main" > /target/etc/apt/sources.list; \\
-echo "deb http://snapshot.debian.org/archive/debian-security/{timestamp} stable/updates main" >> /target/etc/apt/sources.list; \\
-export DEBIAN_FRONTEND=noninteractive; \\
-apt-get update || true;
-
-### Security Repository
-d-i apt-setup/security_host string snapshot.debian.org
-d-i apt-setup/security_path string /archive/debian-security/{timestamp}
-
-##########################################################################
-#####                       Partitioning                             #####
-##########################################################################
-d-i partman-auto/disk string /dev/hda /dev/sda /dev/vda /dev/cciss/c0d0
-d-i partman-auto/method string regular
-d-i partman-auto/expert_recipe string \\
-      boot-root :: \\
-              1000 1000 1024 ext3 \\
-                      $primary{{ }} $bootable{{ }} \\
-                      method{{ format }} format{{ }} \\
-                      use_filesystem{{ }} filesystem{{ ext3 }} \\
-                      mountpoint{{ /boot }} \\
-              . \\
-              16000 30128 32256 ext3 \\
-                      $primary{{ }} label {{ }} \\
-                      method{{ format }} format{{ }} \\
-                      use_filesystem{{ }} filesystem{{ ext3 }} \\
-                      mountpoint{{ / }} \\
-              . \\
-              2950 3 4096 linux-swap \\
-                      label {{ SWAP }} \\
-                      method{{ swap }} format{{ }} \\
-              . \\
-              1 1 1 ext3 method {{ keep }} .
-
-d-i partman-lvm/device_remove_lvm boolean true
-d-i partman-md/device_remove_md boolean true
-d-i partman-crypto/confirm_nochanges boolean true
-d-i partman-crypto/confirm_nooverwrite boolean true
-d-i partman-lvm/confirm boolean true
-
-d-i partman/confirm_write_new_label boolean true
-d-i partman-partitioning/confirm_write_new_label boolean true
-d-i partman/choose_partition select Finish partitioning and write changes to disk
-d-i partman/confirm boolean true
-d-i partman/confirm_nochanges boolean true
-d-i partman/confirm_nooverwrite boolean true
-
-##########################################################################
-# NIS domain
-d-i nis/domain string lab.mtl.com
-nis nis/domain string lab.mtl.com
-
-### Clock and time zone setup
-d-i clock-setup/utc boolean false
-d-i time/zone string Asia/Jerusalem
-d-i clock-setup/ntp boolean true
-d-i clock-setup/ntp-server string ntp
-
-### Additional repositories
-d-i apt-setup/backports boolean false
-d-i apt-setup/contrib boolean false
-d-i apt-setup/multiverse boolean false
-d-i apt-setup/non-free boolean false
-d-i apt-setup/proposed boolean false
-d-i apt-setup/universe boolean false
-d-i apt-setup/updates boolean false
-
-### To create a normal user account.
-d-i passwd/root-login boolean true
-d-i passwd/username string herod
-d-i passwd/root-password-crypted password $1$9rUl0.QT$aGM9nv26a6IlvyGPhl.Fu/
-d-i passwd/make-user boolean false
-
-### Grub installation
-d-i grub-installer/bootdev string default
-d-i grub-installer/with_other_os boolean true
-
-### Package selection
-tasksel tasksel/first multiselect standard
-d-i pkgsel/include string openssh-server,xinit,nfs-kernel-server,debconf-utils,autofs,nis,ethtool,rsync,openipmi,ipmitool,mailutils,vim,lsb-release,mc,curl,lynx,strace,parted
-d-i pkgsel/update-policy select none
-d-i pkgsel/upgrade select none
-
-### Finishing up the first stage install
-d-i finish-install/reboot_in_progress note
-
-
-###Postinstall
-d-i preseed/late_command string \\
-echo "***************** Executing Post install scripts *******************";\\
-cp /var/log/partman /target/root/partman.log; cp /var/log/syslog /target/root/inst_syslog.log; mkdir /target/mnt/tmp;\\
-apt-install apt-file; in-target /usr/bin/apt-file update; in-target apt-get -y remove mpt-status; \\
-printf "domain lab.mtl.com server nis" >> /etc/yp.conf; \\
-cp /etc/yp.conf /target/etc/yp.conf; \\
-echo -e '3tango:3tango' | passwd root --stdin ;\\
-printf "#!/bin/bash -x\\ncat /etc/resolv.conf >> /root/post2.log" >> /target/root/mount.script.sh ;\\
-printf "\\nnslookup site-labfs01 >> /root/post2.log" >> /target/root/mount.script.sh ;\\
-printf "\\ncat /etc/resolv.conf >> /root/post2.log" >> /target/root/mount.script.sh ;\\
-printf "\\nnslookup site-labfs01 >> /root/post2.log" >> /target/root/mount.script.sh ;\\
-chmod +x /target/root/mount.script.sh ;\\
-printf "#!/bin/bash\\n/etc/init.d/rpcbind start\\n/etc/init.d/nfs-common start\\n/root/mount.script.sh >> /root/post1.log 2>&1\\nmount -o nolock site-labfs01:/vol/GL""IT /mnt/tmp >> /root/mount_post.log 2>&1\\n/bin/bash -x /mnt/tmp/autoinstall/postinstall_rs.sh 'multi-new nogrub' >> /root/postinstall.stdout  2>&1\\necho \"\" > /etc/rc.local" > /target/etc/rc.local ;\\
-chmod +x /target/etc/rc.local 
-
-d-i finish-install/reboot_in_progress note
-
-
-
-
-"""
-
-    # Iterate through the stamps data and create preseed files
-    for version, version_info in stamps_data.items():
-        version_name = version_info["version_name"]
-        timestamp = version_info["timestamp"]
-
-        print(f"Creating preseed file for version: {version} ({version_name}) with timestamp: {timestamp}")
-        
-        # Generate preseed content with the timestamp replaced
-        preseed_content = preseed_template.format(timestamp=timestamp)
-        
-        # Save the preseed file in the appropriate directory
-        version_dir = base_dir / version_name / version
-        version_dir.mkdir(parents=True, exist_ok=True)
-        preseed_file = version_dir / "preseed.cfg"
-
-        # Write the preseed file
-        if not preseed_file.exists():
-            with open(preseed_file, "w") as file:
-                file.write(preseed_content)
-            print(f"Preseed file created: {preseed_file}")
-        else:
-            print(f"Preseed file already exists: {preseed_file}, skipping.")
+    written, unchanged = render_preseeds(base_dir, stamps_data, workers=workers, mirror_host=mirror_host,
+                                         overrides=overrides)
+    print(f"Preseed files: {written} written, {unchanged} unchanged")
 
 
-def download_linux_and_initrd(base_dir, stamps_file):
+def download_linux_and_initrd(client, base_dir, stamps_file, scheduler=None, workers=8, mirrors=None):
     """
     Download the `linux` and `initrd.gz` files for the latest timestamp of each version.
 
+    The installer checksums of every version are fetched first, then all
+    (version, artifact) pairs are downloaded on one bounded pool.
+
     Args:
         base_dir (Path): The base directory where the JSON file is located.
         stamps_file (Path): Path to the stamps.json file containing version names and timestamps.
+        scheduler (RequestScheduler): Rate limiter shared with the client, if any.
+        workers (int): Maximum number of concurrent downloads.
+        mirrors (MirrorManager): Copies of snapshot.debian.org to spread the
+            artifacts over, if any.
     """
     # Load the stamps.json data
     stamps_data = load_existing_data(stamps_file)
+    manifest = Manifest(base_dir / "manifest.json")
+    blobs = BlobStore(base_dir / "objects")
+
+    def images_url(version_info):
+        return (f"{SNAPSHOT_URL}/archive/debian/{version_info['timestamp']}/dists/"
+                f"{version_info['version_name']}/main/installer-amd64/current/images")
+
+    def checksums_of(item):
+        version, version_info = item
+        try:
+            return fetch_installer_checksums(client, images_url(version_info))
+        except Exception as e:
+            print(f"Failed to fetch checksums for {version}: {e}")
+            return "sha256", {}
 
-    for version, version_info in stamps_data.items():
-        version_name = version_info["version_name"]
-        timestamp = version_info["timestamp"]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        all_checksums = list(executor.map(checksums_of, stamps_data.items()))
 
-        print(f"Processing version: {version} ({version_name}) with timestamp: {timestamp}")
-        
+    jobs = []
+    for (version, version_info), (algorithm, checksums) in zip(stamps_data.items(), all_checksums):
         # Create a directory for this version name and timestamp
-        version_dir = base_dir / version_name / version
+        version_dir = base_dir / version_info["version_name"] / version
         version_dir.mkdir(parents=True, exist_ok=True)
-        
-        # Generate URLs for `linux` and `initrd.gz`
-        base_url = f"https://snapshot.debian.org/archive/debian/{timestamp}/dists/{version_name}/main/installer-amd64/current/images/netboot/debian-installer/amd64"
-        linux_url = f"{base_url}/linux"
-        initrd_url = f"{base_url}/initrd.gz"
+        base_url = f"{images_url(version_info)}/netboot/debian-installer/amd64"
+        for artifact in ("linux", "initrd.gz"):
+            jobs.append((
+                f"{base_url}/{artifact}", version_dir / artifact, algorithm,
+                checksums.get(f"./netboot/debian-installer/amd64/{artifact}"),
+            ))
+
+    if mirrors is not None and len(mirrors) > 1 and jobs:
+        mirrors.probe(jobs[0][0])
+
+    results = Counter()
+    total_bytes = 0
+    started = time.monotonic()
+    with manifest, ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(download_file, url, path, algorithm, expected, manifest, blobs, scheduler,
+                            mirrors): path
+            for url, path, algorithm, expected in jobs
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            result, size = future.result()
+            results[result] += 1
+            total_bytes += size
+            metrics.note(f"[{done}/{len(jobs)}] {result}: {futures[future]}")
+
+    elapsed = max(time.monotonic() - started, 1e-6)
+    print(f"Netboot artifacts: {results['downloaded']} downloaded "
+          f"({total_bytes / 1024 / 1024:.1f} MiB at {total_bytes / elapsed / 1024 / 1024:.1f} MiB/s), "
+          f"{results['linked']} linked, {results['verified'] + results['recorded']} already present, "
+          f"{results['failed']} failed")
+
+
+def crawl(client, archive, months, store, workers, incremental=False, trailing_months=2, bisect=False,
+          report_interval=30):
+    """
+    Crawl the month listings and READMEs with a bounded pool of workers.
 
-        # Download the files
-        download_file(linux_url, version_dir / "linux")
-        download_file(initrd_url, version_dir / "initrd.gz")
+    Month listings and README fetches share one work queue, so the
+    concurrency limit applies to the whole crawl and connections to
+    snapshot.debian.org are reused across months.
+
+    Args:
+        client (HttpCache): HTTP client shared by every worker.
+        archive (str): Snapshot archive name, e.g. "debian".
+        months (list): (year, month) tuples as returned by get_timestamps.
+        store (SnapshotStore): Where new timestamps are recorded.
+        workers (int): Maximum number of concurrent requests.
+        incremental (bool): Use conditional requests for fully-processed
+            months outside the trailing window.
+        trailing_months (int): Number of most recent months that are always
+            fetched in full.
+        bisect (bool): Resolve each month's new timestamps by bisection
+            instead of probing every README.
+        report_interval (float): Seconds between throughput reports.
+    """
+    resolver = ReadmeResolver(client, archive)
+    jobs = Queue()
+    recent = set(sorted(months)[-trailing_months:]) if trailing_months > 0 else set()
+    if incremental:
+        print(f"Incremental crawl from checkpoint {store.checkpoint()}")
+    for year, month in months:
+        state = store.get_month(year, month)
+        conditional = (
+            incremental and (year, month) not in recent
+            and state is not None and state["complete"]
+        )
+        jobs.put((fetch_timestamp_data, (resolver, jobs, year, month, store, conditional, bisect)))
+
+    def worker():
+        while True:
+            job = jobs.get()
+            if job is None:
+                # Sent once the crawl is finished
+                jobs.task_done()
+                return
+            func, args = job
+            metrics.observe("queue_depth", jobs.qsize(), metrics.COUNT_BUCKETS, queue="crawl")
+            try:
+                func(*args)
+            except Exception as e:
+                print(f"Error in {func.__name__}: {e}")
+            finally:
+                jobs.task_done()
+
+    threads = [Thread(target=worker, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
 
+    done = Event()
 
-def process_month(archive, year, month, existing_timestamps, outdir):
-    """Threaded function to process a specific month."""
-    print(f"Processing year {year}, month {month}")
-    fetch_timestamp_data(archive, year, month, existing_timestamps, outdir)
+    def reporter():
+        while not done.wait(report_interval):
+            metrics.gauge("queue_size", jobs.qsize(), queue="crawl")
+            print(f"Crawl progress: {client.throughput()}, {jobs.qsize()} jobs queued")
+
+    Thread(target=reporter, daemon=True).start()
+    # Jobs queue follow-up jobs, so the workers only stop once the queue is drained
+    jobs.join()
+    done.set()
+    for _ in threads:
+        jobs.put(None)
+    for thread in threads:
+        thread.join()
+    print(f"Crawl finished: {client.throughput()}, {resolver.summary()}")
 
 def main():
+    parser = argparse.ArgumentParser(description="Index Debian releases on snapshot.debian.org.")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="maximum number of concurrent requests to snapshot.debian.org")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only fully re-fetch months after the last checkpoint and the "
+                             "trailing months, using conditional requests for the rest")
+    parser.add_argument("--trailing-months", type=int, default=2,
+                        help="number of most recent months always fetched in full (default: 2)")
+    parser.add_argument("--bisect", action="store_true",
+                        help="only download the READMEs around release changes within each "
+                             "month, assuming identical READMEs at both ends of a run of "
+                             "snapshots means nothing changed in between")
+    parser.add_argument("--cache-dir", type=Path, default=default_cache_dir(),
+                        help="directory of the persistent HTTP cache")
+    parser.add_argument("--cache-size", type=int, default=1024,
+                        help="maximum size of the HTTP cache in MiB (default: 1024)")
+    parser.add_argument("--rate", type=float, default=10.0,
+                        help="maximum requests per second to each host; halved whenever the "
+                             "server answers 429 or 503 (default: 10)")
+    parser.add_argument("--retries", type=int, default=8,
+                        help="retries for failed, throttled and 5xx requests (default: 8)")
+    parser.add_argument("--mirror", action="append", default=[], metavar="URL",
+                        help=f"base URL of another copy of {SNAPSHOT_URL} to download netboot "
+                             "artifacts from; may be repeated")
+    parser.add_argument("--preseed-mirror", default=MIRROR_HOST, metavar="HOST[:PORT]",
+                        help="host the generated preseeds install packages from, e.g. a "
+                             f"snapshot-proxy.py cache such as pxe-server:3142 (default: {MIRROR_HOST})")
+    parser.add_argument("--preseed-overrides", metavar="FILE",
+                        help="JSON file of preseed fields to override per codename, e.g. "
+                             '{"stretch": {"security_suite": "stretch/updates"}}')
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    metrics.setup(args)
+    overrides = load_overrides(args.preseed_overrides) if args.preseed_overrides else None
+    scheduler = RequestScheduler(ConnectionPool(), args.rate, args.workers, args.retries)
+    client = HttpCache(scheduler, args.cache_dir, args.cache_size * 1024 * 1024)
+
     outdir = Path("/snapshot/by-timestamp")
     outdir.mkdir(exist_ok=True)
 
-    # Load existing data
+    # Open the snapshot store, migrating an existing debian.json on first use
     data_file = outdir / "debian.json"
-    existing_data = load_existing_data(data_file)
-    existing_timestamps = set(existing_data.keys())
-
-    # Fetch timestamps and process them in threads
-    timestamps = get_timestamps('debian')
-    threads = []
-    for year, month in timestamps[:]:  # Process all timestamps
-        thread = Thread(target=process_month, args=('debian', year, month, existing_timestamps, outdir))
-        thread.start()
-        threads.append(thread)
-
-    # Wait for all threads to complete
-    for thread in threads:
-        thread.join()
+    store = SnapshotStore(outdir / "debian.db")
+    store.import_json(data_file)
+
+    # Fetch the month listings and READMEs with a bounded worker pool
+    timestamps = get_timestamps(client, 'debian')
+    with metrics.span("crawl"):
+        crawl(client, 'debian', timestamps, store, args.workers,
+              incremental=args.incremental, trailing_months=args.trailing_months, bisect=args.bisect)
+
+    # Export debian.json once for existing consumers, and the index for queries
+    with metrics.span("persist", output="debian.json"):
+        store.export_json(data_file)
+    with metrics.span("persist", output="debian.index"):
+        index = SnapshotIndex.from_store(store)
+        store.close()
+        index.save(outdir / "debian.index")
 
     # Save the latest timestamps for each version
-    save_latest_timestamps(existing_data, outdir)
+    save_latest_timestamps(index, outdir)
 
     # Download linux and initrd.gz files
-    download_linux_and_initrd(outdir, outdir / "stamps.json")
+    mirrors = MirrorManager([SNAPSHOT_URL] + args.mirror)
+    with metrics.span("netboot"):
+        download_linux_and_initrd(client, outdir, outdir / "stamps.json", scheduler, args.workers, mirrors)
 
      # Create preseed files for each version
-    create_preseed_file(outdir, outdir / "stamps.json")
+    with metrics.span("preseed"):
+        create_preseed_file(outdir, outdir / "stamps.json", mirror_host=args.preseed_mirror,
+                            overrides=overrides)
+    metrics.finish(args.metrics_file)
     print("All tasks completed.")
 
 
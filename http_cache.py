@@ -0,0 +1,516 @@
+import email.utils
+import hashlib
+import http.client
+import json
+import os
+import random
+import re
+import time
+import urllib.parse
+from collections import OrderedDict
+from pathlib import Path
+from threading import Condition, Lock
+
+import metrics
+
+# URLs whose content never changes once published: snapshot.debian.org
+# /archive/<name>/<timestamp>/... and archived releases on get.debian.org
+IMMUTABLE_URLS = (
+    re.compile(r"^https?://[^/]+/archive/[^/?]+/\d{8}T\d{6}Z/"),
+    re.compile(r"^https?://[^/]+/images/archive/\d[^/]*/"),
+)
+# Status codes cached for immutable URLs; mutable URLs only cache 200 with validators
+IMMUTABLE_STATUSES = (200, 301, 302, 404)
+CACHED_HEADERS = ("ETag", "Last-Modified", "Content-Type", "Content-Length", "Location")
+# Responses retried by RequestScheduler; the throttling ones also shrink the host's limits
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+THROTTLE_STATUSES = (429, 503)
+MAX_RETRY_AFTER = 600
+
+
+def default_cache_dir():
+    return Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "debian-snapshot-http"
+
+
+def is_immutable(url):
+    return any(pattern.match(url) for pattern in IMMUTABLE_URLS)
+
+
+class ConnectionPool:
+    """
+    Keep-alive HTTP connections, shared by every thread.
+
+    A connection is taken out of the pool for one request and goes back
+    once its response body has been read to the end, so each host gets as
+    many connections as it has requests in flight.
+    """
+
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+        self.idle = {}
+        self.lock = Lock()
+        self.requests = 0
+        self.bytes = 0
+        self.started = time.monotonic()
+
+    def _checkout(self, scheme, host):
+        """Return (connection, reused), reusing an idle connection to the host if there is one."""
+        with self.lock:
+            idle = self.idle.get((scheme, host))
+            if idle:
+                return idle.pop(), True
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, timeout=self.timeout), False
+        return http.client.HTTPConnection(host, timeout=self.timeout), False
+
+    def _checkin(self, scheme, host, conn):
+        with self.lock:
+            self.idle.setdefault((scheme, host), []).append(conn)
+
+    def _received(self, host, size):
+        with self.lock:
+            self.bytes += size
+        metrics.inc("http_response_bytes_total", size, host=host)
+
+    def open(self, method, url, headers=None):
+        """
+        Send a request and return the response with its body unread.
+
+        Returns:
+            tuple: (status, headers, PooledResponse). Redirects are not followed.
+        """
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        while True:
+            conn, reused = self._checkout(parts.scheme, parts.netloc)
+            try:
+                conn.request(method, path, headers=headers or {})
+                response = conn.getresponse()
+                break
+            except Exception as e:
+                conn.close()
+                # The server may have closed an idle keep-alive connection; retry on another one
+                if not reused or not isinstance(e, (http.client.HTTPException, ConnectionError)):
+                    raise
+        with self.lock:
+            self.requests += 1
+        metrics.inc("http_requests_total", host=parts.netloc, status=response.status)
+        return response.status, response.headers, PooledResponse(self, parts.scheme, parts.netloc, conn, response)
+
+    def request(self, method, url, headers=None):
+        """
+        Send a request and read the whole response.
+
+        Returns:
+            tuple: (status, headers, body). Redirects are not followed.
+        """
+        with metrics.span("fetch", method=method, url=url) as fields:
+            status, response_headers, response = self.open(method, url, headers)
+            with response:
+                body = response.read()
+            fields["status"] = status
+            fields["bytes"] = len(body)
+        return status, response_headers, body
+
+    def throughput(self):
+        """Return a one-line summary of requests and bytes per second so far."""
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        with self.lock:
+            requests, size = self.requests, self.bytes
+        return (f"{requests} requests in {elapsed:.1f}s "
+                f"({requests / elapsed:.1f} req/s, {size / elapsed / 1024:.1f} KiB/s)")
+
+
+class PooledResponse:
+    """
+    A response from ConnectionPool.open(), read like http.client.HTTPResponse.
+
+    The connection goes back to the pool as soon as the body has been read
+    to the end. Closing the response before then closes the connection,
+    which is left in the middle of the body.
+    """
+
+    def __init__(self, pool, scheme, host, conn, response):
+        self.pool = pool
+        self.scheme = scheme
+        self.host = host
+        self.conn = conn
+        self.response = response
+
+    def read(self, amt=None):
+        data = self.response.read(amt)
+        self.pool._received(self.host, len(data))
+        if self.response.isclosed():
+            self.close()
+        return data
+
+    def close(self):
+        if self.conn is None:
+            return
+        conn, self.conn = self.conn, None
+        response = self.response
+        # A body cut short by the server leaves length bytes unread
+        if response.isclosed() and not response.will_close and not response.length:
+            self.pool._checkin(self.scheme, self.host, conn)
+        else:
+            conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def parse_retry_after(value):
+    """Return the delay in seconds requested by a Retry-After header, or None."""
+    if not value:
+        return None
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            delay = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(delay, 0.0), MAX_RETRY_AFTER)
+
+
+class HTTPStatusError(http.client.HTTPException):
+    """A response with a status the caller cannot use, kept in status."""
+
+    def __init__(self, status, url):
+        super().__init__(f"HTTP {status} for {url}")
+        self.status = status
+
+
+class HostLimiter:
+    """
+    Token bucket and AIMD concurrency limit for one host.
+
+    Successful responses raise the concurrency limit and request rate
+    additively; 429 and 503 halve both, at most once per second so a burst
+    of throttled requests that were already in flight counts once.
+    A Retry-After pauses every request to the host until it has passed.
+    """
+
+    def __init__(self, rate, concurrency):
+        self.max_rate = rate
+        self.max_concurrency = concurrency
+        self.rate = rate
+        self.limit = float(concurrency)
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.active = 0
+        self.blocked_until = 0.0
+        self.decreased_at = 0.0
+        self.cond = Condition()
+
+    def acquire(self):
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now < self.blocked_until:
+                    self.cond.wait(self.blocked_until - now)
+                elif self.active >= int(self.limit):
+                    self.cond.wait()
+                elif self.tokens < 1:
+                    self.cond.wait((1 - self.tokens) / self.rate)
+                else:
+                    self.tokens -= 1
+                    self.active += 1
+                    return
+
+    def release(self, status, retry_after=None):
+        """Return a slot, adjusting the limits to the response status (None for errors)."""
+        with self.cond:
+            self.active -= 1
+            now = time.monotonic()
+            if status in THROTTLE_STATUSES:
+                if now - self.decreased_at >= 1.0:
+                    self.limit = max(1.0, self.limit / 2)
+                    self.rate = max(self.max_rate / 64, self.rate / 2)
+                    self.decreased_at = now
+                if retry_after:
+                    self.blocked_until = max(self.blocked_until, now + retry_after)
+            elif status is not None and status < 500:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+            self.cond.notify_all()
+
+
+class RequestScheduler:
+    """
+    Rate limiter and retry loop in front of a ConnectionPool, with the same request() interface.
+
+    Each host gets a HostLimiter. Connection errors and 429/5xx responses
+    are retried with jittered exponential backoff, or after the server's
+    Retry-After, up to retries times; the last response is then returned.
+    """
+
+    def __init__(self, pool, rate=10.0, concurrency=8, retries=8, backoff=1.0, max_backoff=60.0):
+        self.pool = pool
+        self.rate = rate
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = Lock()
+        self.hosts = {}
+        self.retried = 0
+        self.throttled = 0
+
+    def host(self, url):
+        netloc = urllib.parse.urlsplit(url).netloc
+        with self.lock:
+            if netloc not in self.hosts:
+                self.hosts[netloc] = HostLimiter(self.rate, self.concurrency)
+            return self.hosts[netloc]
+
+    def call(self, url, send, retries=None):
+        """
+        Run send() under the limits of the URL's host, retrying failures.
+
+        Args:
+            url (str): URL whose host is rate limited.
+            send (callable): Performs the request and returns (status, headers, result).
+                It is called again on every retry, so it must be restartable.
+            retries (int): Overrides the scheduler's retry count, e.g. to fail
+                over to another mirror quickly.
+
+        Returns:
+            tuple: (status, headers, result) of the last attempt.
+        """
+        host = self.host(url)
+        retries = self.retries if retries is None else retries
+        for attempt in range(retries + 1):
+            host.acquire()
+            status = retry_after = None
+            try:
+                status, headers, result = send()
+                retry_after = parse_retry_after(headers.get("Retry-After"))
+            except (http.client.HTTPException, OSError) as e:
+                if attempt == retries:
+                    raise
+                metrics.note(f"Retrying {url} after error: {e}")
+                metrics.inc("http_retries_total", host=urllib.parse.urlsplit(url).netloc, reason="error")
+            finally:
+                # The slot goes back whatever send() raised; only a response adjusts the limits
+                host.release(status, retry_after)
+            if status is not None:
+                if status not in RETRY_STATUSES or attempt == retries:
+                    return status, headers, result
+                metrics.note(f"Retrying {url} after HTTP {status}")
+                metrics.inc("http_retries_total", host=urllib.parse.urlsplit(url).netloc, reason=status)
+                if status in THROTTLE_STATUSES:
+                    with self.lock:
+                        self.throttled += 1
+            with self.lock:
+                self.retried += 1
+            # A Retry-After blocks the whole host in acquire(); otherwise back off with full jitter
+            if not retry_after:
+                time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+
+    def request(self, method, url, headers=None):
+        return self.call(url, lambda: self.pool.request(method, url, headers))
+
+    def throughput(self):
+        with self.lock:
+            retried, throttled = self.retried, self.throttled
+            limits = ", ".join(f"{netloc} x{int(host.limit)} at {host.rate:.1f}/s"
+                               for netloc, host in self.hosts.items())
+        return f"{self.pool.throughput()}, {retried} retries, {throttled} throttled ({limits})"
+
+
+class HttpCache:
+    """
+    On-disk HTTP cache in front of a ConnectionPool or RequestScheduler,
+    with the same request() interface.
+
+    Immutable URLs are served from the cache without touching the network.
+    Other responses are stored with their ETag/Last-Modified and revalidated
+    with a conditional request. The cache is capped at max_size bytes and
+    evicts the least recently used entries; file mtimes record the last use,
+    so the LRU order survives between runs.
+    """
+
+    def __init__(self, pool, cache_dir=None, max_size=1024 * 1024 * 1024):
+        self.pool = pool
+        self.cache_dir = Path(cache_dir or default_cache_dir())
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.lock = Lock()
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.size = 0
+        bodies = sorted(self.cache_dir.glob("*/*.body"), key=lambda path: path.stat().st_mtime)
+        for body_path in bodies:
+            size = body_path.stat().st_size
+            self.entries[body_path.stem] = size
+            self.size += size
+
+    def _paths(self, key):
+        directory = self.cache_dir / key[:2]
+        return directory / f"{key}.json", directory / f"{key}.body"
+
+    def _load(self, key):
+        meta_path, body_path = self._paths(key)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            body = body_path.read_bytes()
+        except (OSError, ValueError):
+            return None
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+        os.utime(body_path)
+        return meta, body
+
+    def _store(self, key, url, status, headers, body):
+        if len(body) > self.max_size // 8:
+            return
+        meta_path, body_path = self._paths(key)
+        meta_path.parent.mkdir(exist_ok=True)
+        meta = {
+            "url": url,
+            "status": status,
+            "headers": {name: headers[name] for name in CACHED_HEADERS if headers.get(name)},
+        }
+        suffix = f".{os.getpid()}.{id(body)}.tmp"
+        body_tmp = body_path.with_name(body_path.name + suffix)
+        meta_tmp = meta_path.with_name(meta_path.name + suffix)
+        body_tmp.write_bytes(body)
+        meta_tmp.write_text(json.dumps(meta))
+        os.replace(body_tmp, body_path)
+        os.replace(meta_tmp, meta_path)
+        with self.lock:
+            self.size += len(body) - self.entries.pop(key, 0)
+            self.entries[key] = len(body)
+            evicted = []
+            while self.size > self.max_size and self.entries:
+                old_key, old_size = self.entries.popitem(last=False)
+                self.size -= old_size
+                evicted.append(old_key)
+        for old_key in evicted:
+            for path in self._paths(old_key):
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+
+    def request(self, method, url, headers=None):
+        """
+        Like ConnectionPool.request, answering GET and HEAD from the cache when possible.
+
+        Requests that carry their own conditional headers are passed through,
+        so callers doing their own revalidation still see 304 responses.
+        """
+        headers = dict(headers or {})
+        if method not in ("GET", "HEAD") or "If-None-Match" in headers or "If-Modified-Since" in headers:
+            status, response_headers, body = self.pool.request(method, url, headers)
+            if method == "GET" and status == 200:
+                self._store(self._key(url), url, status, response_headers, body)
+            return status, response_headers, body
+
+        key = self._key(url)
+        cached = self._load(key)
+        immutable = is_immutable(url)
+        if cached is not None:
+            meta, body = cached
+            if immutable:
+                with self.lock:
+                    self.hits += 1
+                metrics.inc("http_cache_total", result="hit")
+                return self._response(meta, body, method)
+            validators = dict(headers)
+            if meta["headers"].get("ETag"):
+                validators["If-None-Match"] = meta["headers"]["ETag"]
+            if meta["headers"].get("Last-Modified"):
+                validators["If-Modified-Since"] = meta["headers"]["Last-Modified"]
+            status, response_headers, response_body = self.pool.request(method, url, validators)
+            if status == 304:
+                with self.lock:
+                    self.revalidated += 1
+                metrics.inc("http_cache_total", result="revalidated")
+                return self._response(meta, body, method)
+        else:
+            status, response_headers, response_body = self.pool.request(method, url, headers)
+        with self.lock:
+            self.misses += 1
+        metrics.inc("http_cache_total", result="miss")
+        if method == "GET":
+            cacheable = status in IMMUTABLE_STATUSES if immutable else (
+                status == 200 and (response_headers.get("ETag") or response_headers.get("Last-Modified"))
+            )
+            if cacheable:
+                self._store(key, url, status, response_headers, response_body)
+        return status, response_headers, response_body
+
+    @staticmethod
+    def _key(url):
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    @staticmethod
+    def _response(meta, body, method):
+        headers = http.client.HTTPMessage()
+        for name, value in meta["headers"].items():
+            headers[name] = value
+        if "Content-Length" not in headers:
+            headers["Content-Length"] = str(len(body))
+        return meta["status"], headers, body if method == "GET" else b""
+
+    def throughput(self):
+        with self.lock:
+            hits, revalidated, misses = self.hits, self.revalidated, self.misses
+        return (f"{self.pool.throughput()}, {hits} cache hits, "
+                f"{revalidated} revalidated, {misses} misses")
+
+
+def fetch_with_redirect(client, method, url, max_redirects=10):
+    """
+    Handles URL redirection and fetches the content.
+
+    Returns:
+        tuple: (status, headers, body) of the final response, where status is
+            200 or 404. Other statuses raise HTTPStatusError.
+    """
+    for _ in range(max_redirects):
+        status, headers, body = client.request(method, url)
+        if status in (301, 302, 303, 307, 308):
+            url = urllib.parse.urljoin(url, headers.get("Location"))
+            continue
+        if status not in (200, 404):
+            raise HTTPStatusError(status, url)
+        return status, headers, body
+    raise http.client.HTTPException(f"Too many redirects for {url}")
+
+
+def open_with_redirect(pool, url, headers=None, max_redirects=10):
+    """
+    Send a GET over the pool, following redirects, and leave a 200 body unread for streaming.
+
+    Other responses are read in full, so their connection is free again
+    when a caller such as RequestScheduler.call() retries them.
+
+    Returns:
+        tuple: (status, headers, body) of the final response, where body is
+            a PooledResponse for 200 and bytes otherwise.
+    """
+    for _ in range(max_redirects):
+        status, response_headers, response = pool.open("GET", url, headers)
+        if status == 200:
+            return status, response_headers, response
+        with response:
+            body = response.read()
+        if status in (301, 302, 303, 307, 308) and response_headers.get("Location"):
+            url = urllib.parse.urljoin(url, response_headers["Location"])
+            continue
+        return status, response_headers, body
+    raise http.client.HTTPException(f"Too many redirects for {url}")
@@ -0,0 +1,310 @@
+import contextlib
+import http.server
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+
+# Prefix of every exported metric name
+PREFIX = "debian_"
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000, 10000)
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus layout."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, buckets, counts, total, count):
+        if tuple(buckets) != self.buckets:
+            raise ValueError("Cannot merge histograms with different buckets")
+        self.counts = [a + b for a, b in zip(self.counts, counts)]
+        self.sum += total
+        self.count += count
+
+
+class Registry:
+    """
+    Counters, gauges and histograms of one process, plus the trace and quiet settings.
+
+    Metrics are keyed by name and a sorted tuple of label pairs. Labels
+    should have few values (a host, a result); per-item details such as
+    URLs belong in span fields, which only go to the trace.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.trace_path = None
+        self.trace_fd = None
+        self.quiet = False
+
+    def inc(self, name, value=1, labels=()):
+        with self.lock:
+            self.counters[(name, labels)] = self.counters.get((name, labels), 0) + value
+
+    def set(self, name, value, labels=()):
+        with self.lock:
+            self.gauges[(name, labels)] = value
+
+    def observe(self, name, value, buckets, labels=()):
+        with self.lock:
+            if (name, labels) not in self.histograms:
+                self.histograms[(name, labels)] = Histogram(buckets)
+            self.histograms[(name, labels)].observe(value)
+
+    def emit(self, record):
+        # One write per line on an O_APPEND descriptor, so lines from threads and worker processes never interleave
+        if self.trace_fd is not None:
+            os.write(self.trace_fd, (json.dumps(record, default=str) + "\n").encode())
+
+    def drain(self):
+        """Return the counters and histograms as plain data and reset them, e.g. to send them to a parent process."""
+        with self.lock:
+            state = {
+                "counters": list(self.counters.items()),
+                "histograms": [(key, (h.buckets, h.counts, h.sum, h.count)) for key, h in self.histograms.items()],
+            }
+            self.counters.clear()
+            self.histograms.clear()
+        return state
+
+    def merge(self, state):
+        """Add the output of drain() in another process to this registry."""
+        for (name, labels), value in state["counters"]:
+            self.inc(name, value, labels)
+        with self.lock:
+            for key, (buckets, counts, total, count) in state["histograms"]:
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram(buckets)
+                self.histograms[key].merge(buckets, counts, total, count)
+
+    def exposition(self):
+        """Render every metric in the Prometheus text format."""
+        def render(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+            return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+        lines = []
+        with self.lock:
+            for kind, values in (("counter", self.counters), ("gauge", self.gauges)):
+                for name in sorted({name for name, _ in values}):
+                    lines.append(f"# TYPE {PREFIX}{name} {kind}")
+                    for (metric, labels), value in sorted(values.items()):
+                        if metric == name:
+                            lines.append(f"{PREFIX}{name}{render(labels)} {value}")
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {PREFIX}{name} histogram")
+                for (metric, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                        cumulative += count
+                        lines.append(f"{PREFIX}{name}_bucket{render(labels, [('le', bound)])} {cumulative}")
+                    lines.append(f"{PREFIX}{name}_sum{render(labels)} {histogram.sum}")
+                    lines.append(f"{PREFIX}{name}_count{render(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+# The registry of this process, used by the module-level functions
+REGISTRY = Registry()
+
+
+def _labels(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def configure(trace=None, quiet=False):
+    """
+    Set up the trace and quiet mode of this process.
+
+    Args:
+        trace (str): Path of a JSON-lines file receiving one record per
+            span, appended to if it exists.
+        quiet (bool): Silence note() messages.
+    """
+    if REGISTRY.trace_fd is not None:
+        os.close(REGISTRY.trace_fd)
+        REGISTRY.trace_fd = None
+    REGISTRY.trace_path = trace
+    REGISTRY.quiet = quiet
+    if trace:
+        REGISTRY.trace_fd = os.open(trace, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+
+def settings():
+    """Return the arguments of configure() in effect, e.g. as a process pool initializer's initargs."""
+    return REGISTRY.trace_path, REGISTRY.quiet
+
+
+def init_worker(trace=None, quiet=False):
+    """
+    Process pool initializer: start from empty metrics and reopen the trace.
+
+    A forked worker inherits the parent's counters, which would be counted
+    twice once its drain() is merged back.
+    """
+    REGISTRY.drain()
+    with REGISTRY.lock:
+        REGISTRY.gauges.clear()
+    configure(trace, quiet)
+
+
+def note(message):
+    """Print a per-item progress message unless quiet mode is on."""
+    if not REGISTRY.quiet:
+        print(message)
+
+
+def inc(name, value=1, **labels):
+    """Add value to a counter."""
+    REGISTRY.inc(name, value, _labels(labels))
+
+
+def gauge(name, value, **labels):
+    """Set a gauge to value."""
+    REGISTRY.set(name, value, _labels(labels))
+
+
+def observe(name, value, buckets=SECONDS_BUCKETS, **labels):
+    """Add an observation to a histogram."""
+    REGISTRY.observe(name, value, buckets, _labels(labels))
+
+
+def record(name, seconds, start=None, **fields):
+    """
+    Record a finished span: a span_seconds observation and a trace line.
+
+    Args:
+        name (str): Span name such as "fetch", "download" or "repack"; the
+            only label of the histogram.
+        seconds (float): Duration of the span.
+        start (float): Wall-clock start time, defaults to now minus seconds.
+        fields: Details written to the trace only.
+    """
+    REGISTRY.observe("span_seconds", seconds, SECONDS_BUCKETS, (("span", name),))
+    REGISTRY.emit({
+        "ts": round(time.time() - seconds if start is None else start, 6),
+        "span": name,
+        "seconds": round(seconds, 6),
+        "pid": os.getpid(),
+        "thread": threading.current_thread().name,
+        **fields,
+    })
+
+
+@contextlib.contextmanager
+def span(name, **fields):
+    """
+    Time the enclosed block and record() it.
+
+    Yields the fields dict, so the block can add details it only learns
+    along the way, such as a status or a size. A span left by an exception
+    is recorded with error set to the exception.
+    """
+    start = time.time()
+    started = time.monotonic()
+    try:
+        yield fields
+    except BaseException as e:
+        fields["error"] = repr(e)
+        raise
+    finally:
+        record(name, time.monotonic() - started, start, **fields)
+
+
+def drain():
+    return REGISTRY.drain()
+
+
+def merge(state):
+    REGISTRY.merge(state)
+
+
+def write_textfile(path):
+    """Write the metrics to path atomically, for node_exporter's textfile collector."""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(REGISTRY.exposition())
+    os.replace(tmp_path, path)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.exposition().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_export(textfile=None, port=None, interval=15.0):
+    """
+    Export the metrics while the run is going.
+
+    Args:
+        textfile (str): Rewritten every interval seconds and by finish().
+        port (int): Serve /metrics on localhost:port.
+    """
+    if port:
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    if textfile:
+        def writer():
+            while True:
+                time.sleep(interval)
+                write_textfile(textfile)
+
+        threading.Thread(target=writer, daemon=True).start()
+
+
+def finish(textfile=None):
+    """Write the final textfile, if any, and close the trace."""
+    if textfile:
+        write_textfile(textfile)
+    configure(None, REGISTRY.quiet)
+
+
+def add_arguments(parser):
+    """Add the instrumentation options shared by the scripts to an argparse parser."""
+    group = parser.add_argument_group("instrumentation")
+    group.add_argument("--trace", metavar="FILE",
+                       help="append a JSON-lines record of every timed span (fetch, parse, persist, "
+                            "download, extract, patch, repack, compress, publish) to FILE")
+    group.add_argument("--metrics-file", metavar="FILE",
+                       help="write Prometheus metrics to FILE every 15s and at exit, e.g. for "
+                            "node_exporter's textfile collector")
+    group.add_argument("--metrics-port", type=int, metavar="PORT",
+                       help="serve Prometheus metrics on http://127.0.0.1:PORT/metrics")
+    group.add_argument("--quiet", action="store_true",
+                       help="only print summaries and errors, not a line per item")
+
+
+def setup(args):
+    """Apply the options added by add_arguments()."""
+    configure(args.trace, args.quiet)
+    start_export(args.metrics_file, args.metrics_port)
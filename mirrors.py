@@ -0,0 +1,215 @@
+import http.client
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+# Bytes fetched from each mirror to estimate its bandwidth
+PROBE_BYTES = 1024 * 1024
+# A failing mirror is skipped for FAILURE_BACKOFF * 2**(failures - 1) seconds, up to MAX_BACKOFF
+FAILURE_BACKOFF = 5.0
+MAX_BACKOFF = 300.0
+
+
+def sample(url, size, timeout=30, max_redirects=5):
+    """
+    Time a ranged GET of the first size bytes of url.
+
+    Only size bytes are read even if the server ignores the range.
+
+    Returns:
+        tuple: (seconds to the response headers, seconds to the last byte, bytes read).
+    """
+    for _ in range(max_redirects):
+        parts = urllib.parse.urlsplit(url)
+        connection_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+        conn = connection_class(parts.netloc, timeout=timeout)
+        try:
+            start = time.monotonic()
+            path = parts.path + ("?" + parts.query if parts.query else "")
+            conn.request("GET", path, headers={"Range": f"bytes=0-{size - 1}"})
+            response = conn.getresponse()
+            latency = time.monotonic() - start
+            if response.status in (301, 302, 303, 307, 308):
+                url = urllib.parse.urljoin(url, response.getheader("Location"))
+                continue
+            if response.status not in (200, 206):
+                raise http.client.HTTPException(f"HTTP {response.status} for {url}")
+            data = response.read(size)
+            return latency, time.monotonic() - start, len(data)
+        finally:
+            conn.close()
+    raise http.client.HTTPException(f"Too many redirects for {url}")
+
+
+def error_status(error):
+    """Return the HTTP status a request failed with, from http_cache or requests errors, or None."""
+    response = getattr(error, "response", None)
+    return getattr(error, "status", None) or getattr(response, "status_code", None)
+
+
+class Mirror:
+    def __init__(self, base):
+        self.base = base.rstrip("/")
+        self.latency = None
+        self.bandwidth = None
+        self.failures = 0
+        self.down_until = 0.0
+        # Smooth weighted round-robin state
+        self.current = 0.0
+
+    def weight(self):
+        return self.bandwidth or 1.0
+
+    def __repr__(self):
+        if self.bandwidth is None:
+            return self.base
+        return f"{self.base} ({self.latency * 1000:.0f} ms, {self.bandwidth / 1024 / 1024:.1f} MiB/s)"
+
+
+class MirrorManager:
+    """
+    A set of base URLs serving the same tree, the first one being the origin.
+
+    URLs are always named by their origin form, and translated to each
+    mirror when fetched. probe() measures latency and bandwidth, which
+    order the candidates and weight how work is spread between mirrors.
+    Mirrors that fail are skipped for an exponentially growing time.
+    """
+
+    def __init__(self, bases):
+        if not bases:
+            raise ValueError("At least one base URL is required")
+        self.mirrors = [Mirror(base) for base in bases]
+        self.origin = self.mirrors[0]
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.mirrors)
+
+    def translate(self, url, mirror):
+        """Return url under the mirror's base; URLs outside the origin are returned unchanged."""
+        if url.startswith(self.origin.base + "/"):
+            return mirror.base + url[len(self.origin.base):]
+        return url
+
+    def _mirror_of(self, url):
+        matches = [mirror for mirror in self.mirrors if url.startswith(mirror.base + "/")]
+        return max(matches, key=lambda mirror: len(mirror.base), default=None)
+
+    def probe(self, url, sample_size=PROBE_BYTES):
+        """
+        Measure every mirror on one file: time to first response, then bandwidth over a sample range.
+
+        Mirrors that cannot serve the file are marked as failed.
+        """
+        def measure(mirror):
+            source = self.translate(url, mirror)
+            try:
+                latency, elapsed, size = sample(source, sample_size)
+            except Exception as e:
+                print(f"Mirror probe failed for {mirror.base}: {e}")
+                self.failed(source)
+                return
+            with self.lock:
+                mirror.latency = latency
+                mirror.bandwidth = size / max(elapsed - latency, 1e-6)
+
+        with ThreadPoolExecutor(max_workers=len(self.mirrors)) as executor:
+            list(executor.map(measure, self.mirrors))
+        print("Mirrors: " + ", ".join(repr(mirror) for mirror in self.ranked()))
+
+    def ranked(self):
+        """Return the mirrors that are up, fastest first, followed by the ones backing off."""
+        now = time.monotonic()
+        with self.lock:
+            up = [mirror for mirror in self.mirrors if mirror.down_until <= now]
+            down = sorted((mirror for mirror in self.mirrors if mirror.down_until > now),
+                          key=lambda mirror: mirror.down_until)
+        up.sort(key=lambda mirror: -mirror.weight())
+        return up + down
+
+    def candidates(self, url, first=None):
+        """
+        Return url translated to every mirror, in the order they should be tried.
+
+        Args:
+            first (str): A translated URL to try before the others, e.g. the
+                one spread() assigned.
+        """
+        urls = [self.translate(url, mirror) for mirror in self.ranked()]
+        if first is not None and first in urls:
+            urls.remove(first)
+            urls.insert(0, first)
+        return urls
+
+    def spread(self, url, count):
+        """
+        Assign count pieces of work on url to mirrors in proportion to their bandwidth.
+
+        Uses smooth weighted round-robin across calls, so small files
+        fetched one at a time are spread as well as the segments of one file.
+        """
+        now = time.monotonic()
+        urls = []
+        with self.lock:
+            up = [mirror for mirror in self.mirrors if mirror.down_until <= now] or self.mirrors
+            total = sum(mirror.weight() for mirror in up)
+            for _ in range(count):
+                for mirror in up:
+                    mirror.current += mirror.weight()
+                chosen = max(up, key=lambda mirror: mirror.current)
+                chosen.current -= total
+                urls.append(self.translate(url, chosen))
+        return urls
+
+    def failed(self, url):
+        """Record a failure of the mirror serving url and take it out of rotation for a while."""
+        mirror = self._mirror_of(url)
+        if mirror is None:
+            return
+        with self.lock:
+            mirror.failures += 1
+            backoff = min(MAX_BACKOFF, FAILURE_BACKOFF * 2 ** (mirror.failures - 1))
+            mirror.down_until = time.monotonic() + backoff
+        if len(self.mirrors) > 1:
+            print(f"Mirror {mirror.base} failed, skipping it for {backoff:.0f}s")
+
+    def succeeded(self, url):
+        mirror = self._mirror_of(url)
+        if mirror is not None:
+            with self.lock:
+                mirror.failures = 0
+                mirror.down_until = 0.0
+
+    def retries(self):
+        """Retries per mirror: with other mirrors to fall back on, give up on one quickly."""
+        return None if len(self.mirrors) == 1 else 1
+
+    def fetch(self, url, fetch, first=None):
+        """
+        Call fetch(source) with url translated to each mirror in turn until one succeeds.
+
+        Args:
+            url (str): URL under the origin, or any other URL (tried as is).
+            fetch (callable): Takes the translated URL and returns a result,
+                raising OSError or http.client.HTTPException on failure.
+            first (str): Translated URL to try first.
+
+        Returns:
+            The result of the first successful fetch. The last error is raised
+            if every mirror failed.
+        """
+        last_error = None
+        for source in self.candidates(url, first):
+            try:
+                result = fetch(source)
+            except (OSError, http.client.HTTPException) as e:
+                # A missing file says nothing about the health of the mirror
+                if error_status(e) != 404:
+                    self.failed(source)
+                last_error = e
+                continue
+            self.succeeded(source)
+            return result
+        raise last_error
@@ -0,0 +1,65 @@
+import re
+
+# snapshot.debian.org /archive/<name>/: one link per month
+MONTH_LINK = re.compile(rb'^<a href="\./\?year=(\d+)&amp;month=(\d+)">\d+</a>$', re.MULTILINE)
+# snapshot.debian.org /archive/<name>/?year=&month=: one link per snapshot
+TIMESTAMP_LINK = re.compile(
+    rb'^<a href="(\d{8}T\d{6}Z)/">\d\d\d\d-\d\d-\d\d \d\d:\d\d:\d\d</a><br />$', re.MULTILINE
+)
+# README at the root of each snapshot: "Debian 12.4, or bookworm.  Access this release through dists/stable"
+README_RELEASE = re.compile(
+    rb"Debian\s+([\d.]+r?\d*)[^\n]*,\s+or\s+(\w+)\.\s+Access this release through\s+(\S+)",
+    re.MULTILINE | re.IGNORECASE,
+)
+# Apache index of get.debian.org/images/archive/: release directories from 10.0.0 on
+VERSION_DIR = re.compile(rb'<td class="indexcolname"><a href="((?:1\d|[2-9]\d)\.\d+\.\d+)/">')
+
+
+def _as_bytes(data):
+    return data.encode("utf-8") if isinstance(data, str) else data
+
+
+def iter_line_matches(pattern, chunks):
+    """
+    Yield the matches of a line-anchored pattern over a stream of byte chunks.
+
+    Only complete lines are scanned, so a match split between two chunks is
+    found once the rest of its line arrives.
+    """
+    tail = b""
+    for chunk in chunks:
+        buf = tail + chunk
+        end = buf.rfind(b"\n") + 1
+        yield from pattern.finditer(buf, 0, end)
+        tail = buf[end:]
+    if tail:
+        yield from pattern.finditer(tail)
+
+
+def parse_months(body):
+    """Return the (year, month) tuples linked from an archive's top-level listing."""
+    return [(int(year), int(month)) for year, month in MONTH_LINK.findall(_as_bytes(body))]
+
+
+def iter_timestamps(chunks):
+    """Yield the snapshot timestamps of a month listing as its chunks arrive."""
+    for match in iter_line_matches(TIMESTAMP_LINK, chunks):
+        yield match.group(1).decode("ascii")
+
+
+def parse_timestamps(body):
+    """Return the snapshot timestamps of a month listing, in page order."""
+    return [timestamp.decode("ascii") for timestamp in TIMESTAMP_LINK.findall(_as_bytes(body))]
+
+
+def parse_readme(body):
+    """Parses the README content into a list of (version_name, version) tuples."""
+    return [
+        (name.decode("ascii"), version.decode("ascii"))
+        for version, name, _ in README_RELEASE.findall(_as_bytes(body))
+    ]
+
+
+def parse_version_dirs(body):
+    """Return the release versions (e.g. "12.4.0") listed in an images/archive/ index."""
+    return [version.decode("ascii") for version in VERSION_DIR.findall(_as_bytes(body))]
@@ -0,0 +1,272 @@
+import hashlib
+import json
+import os
+import string
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import metrics
+from checksums import Manifest
+from snapshot_index import version_key
+
+# Fields: mirror_host, timestamp, suite, security_suite
+PRESEED_TEMPLATE = """### Localization Settings
+d-i debian-installer/language string en
+d-i debian-installer/country string US
+d-i debian-installer/locale string en_US
+
+### Keyboard Settings
+d-i console-keymaps-at/keymap select us
+d-i keyboard-configuration/xkb-keymap select us
+
+### Network Configuration
+d-i netcfg/choose_interface select auto
+d-i netcfg/get_hostname string unassigned-hostname
+d-i netcfg/get_domain string unassigned-domain
+
+### Firmware Loading
+d-i hw-detect/load_firmware boolean true
+
+### Mirror Configuration
+d-i mirror/protocol string http
+d-i mirror/http/hostname string {mirror_host}
+d-i mirror/http/directory string /archive/debian/{timestamp}
+d-i mirror/http/proxy string
+d-i mirror/country string manual
+d-i apt-setup/use_mirror boolean false
+d-i apt-setup/services-select multiselect
+
+### Static sources.list
+d-i preseed/late_command string \\
+echo "deb http://{mirror_host}/archive/debian/{timestamp} {suite} main" > /target/etc/apt/sources.list; \\
+echo "deb http://{mirror_host}/archive/debian-security/{timestamp} {security_suite} main" >> /target/etc/apt/sources.list; \\
+export DEBIAN_FRONTEND=noninteractive; \\
+apt-get update || true;
+
+### Security Repository
+d-i apt-setup/security_host string {mirror_host}
+d-i apt-setup/security_path string /archive/debian-security/{timestamp}
+
+##########################################################################
+#####                       Partitioning                             #####
+##########################################################################
+d-i partman-auto/disk string /dev/hda /dev/sda /dev/vda /dev/cciss/c0d0
+d-i partman-auto/method string regular
+d-i partman-auto/expert_recipe string \\
+      boot-root :: \\
+              1000 1000 1024 ext3 \\
+                      $primary{{ }} $bootable{{ }} \\
+                      method{{ format }} format{{ }} \\
+                      use_filesystem{{ }} filesystem{{ ext3 }} \\
+                      mountpoint{{ /boot }} \\
+              . \\
+              16000 30128 32256 ext3 \\
+                      $primary{{ }} label {{ }} \\
+                      method{{ format }} format{{ }} \\
+                      use_filesystem{{ }} filesystem{{ ext3 }} \\
+                      mountpoint{{ / }} \\
+              . \\
+              2950 3 4096 linux-swap \\
+                      label {{ SWAP }} \\
+                      method{{ swap }} format{{ }} \\
+              . \\
+              1 1 1 ext3 method {{ keep }} .
+
+d-i partman-lvm/device_remove_lvm boolean true
+d-i partman-md/device_remove_md boolean true
+d-i partman-crypto/confirm_nochanges boolean true
+d-i partman-crypto/confirm_nooverwrite boolean true
+d-i partman-lvm/confirm boolean true
+
+d-i partman/confirm_write_new_label boolean true
+d-i partman-partitioning/confirm_write_new_label boolean true
+d-i partman/choose_partition select Finish partitioning and write changes to disk
+d-i partman/confirm boolean true
+d-i partman/confirm_nochanges boolean true
+d-i partman/confirm_nooverwrite boolean true
+
+##########################################################################
+# NIS domain
+d-i nis/domain string lab.mtl.com
+nis nis/domain string lab.mtl.com
+
+### Clock and time zone setup
+d-i clock-setup/utc boolean false
+d-i time/zone string Asia/Jerusalem
+d-i clock-setup/ntp boolean true
+d-i clock-setup/ntp-server string ntp
+
+### Additional repositories
+d-i apt-setup/backports boolean false
+d-i apt-setup/contrib boolean false
+d-i apt-setup/multiverse boolean false
+d-i apt-setup/non-free boolean false
+d-i apt-setup/proposed boolean false
+d-i apt-setup/universe boolean false
+d-i apt-setup/updates boolean false
+
+### To create a normal user account.
+d-i passwd/root-login boolean true
+d-i passwd/username string herod
+d-i passwd/root-password-crypted password $1$9rUl0.QT$aGM9nv26a6IlvyGPhl.Fu/
+d-i passwd/make-user boolean false
+
+### Grub installation
+d-i grub-installer/bootdev string default
+d-i grub-installer/with_other_os boolean true
+
+### Package selection
+tasksel tasksel/first multiselect standard
+d-i pkgsel/include string openssh-server,xinit,nfs-kernel-server,debconf-utils,autofs,nis,ethtool,rsync,openipmi,ipmitool,mailutils,vim,lsb-release,mc,curl,lynx,strace,parted
+d-i pkgsel/update-policy select none
+d-i pkgsel/upgrade select none
+
+### Finishing up the first stage install
+d-i finish-install/reboot_in_progress note
+
+
+###Postinstall
+d-i preseed/late_command string \\
+echo "***************** Executing Post install scripts *******************";\\
+cp /var/log/partman /target/root/partman.log; cp /var/log/syslog /target/root/inst_syslog.log; mkdir /target/mnt/tmp;\\
+apt-install apt-file; in-target /usr/bin/apt-file update; in-target apt-get -y remove mpt-status; \\
+printf "domain lab.mtl.com server nis" >> /etc/yp.conf; \\
+cp /etc/yp.conf /target/etc/yp.conf; \\
+echo -e '3tango:3tango' | passwd root --stdin ;\\
+printf "#!/bin/bash -x\\ncat /etc/resolv.conf >> /root/post2.log" >> /target/root/mount.script.sh ;\\
+printf "\\nnslookup site-labfs01 >> /root/post2.log" >> /target/root/mount.script.sh ;\\
+printf "\\ncat /etc/resolv.conf >> /root/post2.log" >> /target/root/mount.script.sh ;\\
+printf "\\nnslookup site-labfs01 >> /root/post2.log" >> /target/root/mount.script.sh ;\\
+chmod +x /target/root/mount.script.sh ;\\
+printf "#!/bin/bash\\n/etc/init.d/rpcbind start\\n/etc/init.d/nfs-common start\\n/root/mount.script.sh >> /root/post1.log 2>&1\\nmount -o nolock site-labfs01:/vol/GL""IT /mnt/tmp >> /root/mount_post.log 2>&1\\n/bin/bash -x /mnt/tmp/autoinstall/postinstall_rs.sh 'multi-new nogrub' >> /root/postinstall.stdout  2>&1\\necho \"\" > /etc/rc.local" > /target/etc/rc.local ;\\
+chmod +x /target/etc/rc.local 
+
+d-i finish-install/reboot_in_progress note
+
+
+
+
+"""
+
+# Security updates moved from <codename>/updates to <codename>-security in bullseye (11)
+SECURITY_SUITE_RENAMED_IN = 11
+# Host the installer fetches packages from; point it at snapshot-proxy.py to cache them locally
+MIRROR_HOST = "snapshot.debian.org"
+
+
+class PreseedTemplate:
+    """
+    A str.format-style template parsed once into literal text and field names.
+
+    Rendering joins the pre-split pieces instead of re-parsing the template
+    for every version.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        self.parts = []
+        literal = ""
+        for text_part, field, spec, conversion in string.Formatter().parse(text):
+            if spec or conversion:
+                raise ValueError(f"Format specs are not supported in preseed templates: {{{field}}}")
+            # Escaped braces split the literal text; keep it in one piece
+            literal += text_part
+            if field is not None:
+                self.parts.append((literal, field))
+                literal = ""
+        self.tail = literal
+
+    def render(self, fields):
+        return "".join([literal + str(fields[field]) for literal, field in self.parts] + [self.tail])
+
+
+def load_overrides(path):
+    """
+    Load per-codename field overrides from a JSON file.
+
+    The file maps codenames to the fields replacing the defaults of
+    preseed_fields(), e.g. {"stretch": {"security_suite": "stretch/updates"}}.
+    """
+    with open(path) as f:
+        overrides = json.load(f)
+    if not isinstance(overrides, dict) or not all(isinstance(fields, dict) for fields in overrides.values()):
+        raise ValueError(f"{path}: expected an object mapping codenames to objects of fields")
+    return overrides
+
+
+def preseed_fields(version, version_name, timestamp, mirror_host=MIRROR_HOST, overrides=None):
+    """Return the template fields of one version, including any overrides for its codename."""
+    major = (version_key(version) or (0,))[0]
+    fields = {
+        "mirror_host": mirror_host,
+        "timestamp": timestamp,
+        "suite": version_name,
+        "security_suite": (
+            f"{version_name}-security" if major >= SECURITY_SUITE_RENAMED_IN
+            else f"{version_name}/updates"
+        ),
+    }
+    if overrides:
+        fields.update(overrides.get(version_name, {}))
+    return fields
+
+
+def write_if_changed(path, content, manifest):
+    """
+    Atomically write content to path unless the recorded digest already matches.
+
+    Returns:
+        bool: True if the file was written.
+    """
+    data = content.encode("utf-8")
+    digest = hashlib.sha256(data).hexdigest()
+    entry = manifest.lookup(path)
+    if entry is not None and entry["digest"] == digest:
+        return False
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    manifest.record(path, "sha256", digest)
+    return True
+
+
+def render_preseeds(base_dir, stamps_data, template=None, workers=8, mirror_host=MIRROR_HOST, overrides=None):
+    """
+    Render preseed.cfg for every version and write the ones that changed.
+
+    Args:
+        base_dir (Path): Directory holding the <version_name>/<version> trees.
+        stamps_data (dict): stamps.json layout, version to version_name and timestamp.
+        template (PreseedTemplate): Defaults to PRESEED_TEMPLATE.
+        workers (int): Number of versions rendered at once.
+        mirror_host (str): host[:port] the installer fetches packages from,
+            such as a snapshot-proxy.py instance.
+        overrides (dict): Codename to the fields replacing its defaults, as
+            returned by load_overrides().
+
+    Returns:
+        tuple: (written, unchanged) counts.
+    """
+    base_dir = Path(base_dir)
+    template = template or PreseedTemplate(PRESEED_TEMPLATE)
+    manifest = Manifest(base_dir / "preseed-manifest.json")
+
+    def render(item):
+        version, version_info = item
+        version_name = version_info["version_name"]
+        version_dir = base_dir / version_name / version
+        version_dir.mkdir(parents=True, exist_ok=True)
+        content = template.render(preseed_fields(version, version_name, version_info["timestamp"],
+                                                 mirror_host, overrides))
+        preseed_file = version_dir / "preseed.cfg"
+        if write_if_changed(preseed_file, content, manifest):
+            metrics.note(f"Preseed file written: {preseed_file}")
+            return True
+        return False
+
+    with manifest, ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(render, stamps_data.items()))
+    written = sum(results)
+    return written, len(results) - written
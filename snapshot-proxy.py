@@ -0,0 +1,414 @@
+import argparse
+import hashlib
+import http.client
+import http.server
+import json
+import os
+import re
+import shutil
+import signal
+import sys
+import threading
+import time
+import urllib.parse
+from collections import OrderedDict
+from pathlib import Path
+
+import metrics
+from http_cache import ConnectionPool, RequestScheduler, default_cache_dir, is_immutable, open_with_redirect
+
+UPSTREAM = "https://snapshot.debian.org"
+# apt-cacher-ng's port, which installers and apt setups commonly expect a cache on
+DEFAULT_PORT = 3142
+CHUNK_SIZE = 1024 * 1024
+MAX_REDIRECTS = 5
+# Headers kept with cached files and relayed to clients
+KEPT_HEADERS = ("Content-Type", "ETag", "Last-Modified")
+RANGE = re.compile(r"bytes=(\d+)-(\d*)$")
+
+
+class ProxyCache:
+    """
+    On-disk store of immutable snapshot files, bounded to max_size bytes.
+
+    Each file is kept as <key>.body with its status and headers in
+    <key>.json. Like HttpCache, the least recently used files are evicted
+    first and body mtimes record the last use, so the order survives
+    restarts. Callers serialize lookup() and commit() with their own lock.
+    """
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size
+        self.tmp_dir = self.cache_dir / "tmp"
+        # Partial downloads of a previous run cannot be resumed by a client; drop them
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        self.tmp_dir.mkdir(parents=True)
+        self.entries = OrderedDict()
+        self.size = 0
+        bodies = sorted(self.cache_dir.glob("*/*.body"), key=lambda path: path.stat().st_mtime)
+        for body_path in bodies:
+            if body_path.with_suffix(".json").exists():
+                size = body_path.stat().st_size
+                self.entries[body_path.stem] = size
+                self.size += size
+
+    def _paths(self, key):
+        directory = self.cache_dir / key[:2]
+        return directory / f"{key}.json", directory / f"{key}.body"
+
+    def lookup(self, key):
+        """Return (meta, open body file) for a cached key, or None."""
+        if key not in self.entries:
+            return None
+        meta_path, body_path = self._paths(key)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            body = open(body_path, "rb")
+        except (OSError, ValueError):
+            self.size -= self.entries.pop(key)
+            return None
+        self.entries.move_to_end(key)
+        os.utime(body_path)
+        return meta, body
+
+    def commit(self, key, part_path, meta):
+        """
+        Move a complete download into the cache, evicting old files to make room.
+
+        Returns:
+            bool: False if the file is too big to cache; part_path is left alone.
+        """
+        size = os.path.getsize(part_path)
+        if size > self.max_size:
+            return False
+        meta_path, body_path = self._paths(key)
+        meta_path.parent.mkdir(exist_ok=True)
+        meta_tmp = meta_path.with_name(meta_path.name + ".tmp")
+        meta_tmp.write_text(json.dumps(meta))
+        # Clients still streaming from the part file keep reading the same inode
+        os.replace(part_path, body_path)
+        os.replace(meta_tmp, meta_path)
+        self.size += size - self.entries.pop(key, 0)
+        self.entries[key] = size
+        while self.size > self.max_size and self.entries:
+            old_key, old_size = self.entries.popitem(last=False)
+            self.size -= old_size
+            for path in self._paths(old_key):
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+        return True
+
+
+class Fetch:
+    """
+    One upstream download, shared by every client asking for the same path.
+
+    The body is written to part_path as it arrives; clients stream it from
+    there with sendfile, following written, so a file is only fetched once
+    however many machines request it at the same time.
+    """
+
+    def __init__(self, path, part_path):
+        self.path = path
+        self.part_path = part_path
+        self.cond = threading.Condition()
+        self.status = None
+        self.headers = {}
+        self.length = None
+        self.written = 0
+        self.done = False
+        self.error = None
+
+    def start(self, status, headers, length):
+        with self.cond:
+            self.status, self.headers, self.length = status, headers, length
+            self.cond.notify_all()
+
+    def advance(self, size):
+        with self.cond:
+            self.written += size
+            self.cond.notify_all()
+
+    def finish(self, error=None):
+        with self.cond:
+            self.done = True
+            self.error = error
+            self.cond.notify_all()
+
+    def wait_started(self):
+        """Wait for the upstream response headers; return False if the fetch failed first."""
+        with self.cond:
+            while self.status is None and not self.done:
+                self.cond.wait()
+            return self.status is not None
+
+    def wait_beyond(self, offset):
+        """Wait until more than offset bytes are written or the fetch ends; return (written, done, error)."""
+        with self.cond:
+            while self.written <= offset and not self.done:
+                self.cond.wait()
+            return self.written, self.done, self.error
+
+
+class SnapshotProxy:
+    """
+    Caching proxy for snapshot.debian.org.
+
+    Immutable paths (/archive/<name>/<timestamp>/...) are cached forever,
+    subject to the size bound; anything else under /archive/ is relayed
+    without being stored. Concurrent requests for one path share a Fetch.
+    """
+
+    def __init__(self, upstream, cache, scheduler, concurrency=8):
+        self.upstream = upstream.rstrip("/")
+        self.cache = cache
+        self.scheduler = scheduler
+        self.transfers = threading.BoundedSemaphore(concurrency)
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.ids = 0
+
+    @staticmethod
+    def key(path):
+        return hashlib.sha256(path.encode()).hexdigest()
+
+    def open(self, path):
+        """
+        Return what serves path: ("hit", meta, body file) or ("fetch", Fetch, part file, joined).
+
+        The cache lookup and joining an in-flight fetch happen under one lock,
+        so a fetch being committed is always found in one or the other.
+        """
+        key = self.key(path)
+        with self.lock:
+            hit = self.cache.lookup(key)
+            if hit is not None:
+                return ("hit",) + hit
+            fetch = self.inflight.get(key)
+            joined = fetch is not None
+            if not joined:
+                self.ids += 1
+                fetch = Fetch(path, self.cache.tmp_dir / f"{key}.{self.ids}.part")
+                fetch.part_path.touch()
+                self.inflight[key] = fetch
+                threading.Thread(target=self.run, args=(key, fetch), daemon=True).start()
+            return "fetch", fetch, open(fetch.part_path, "rb"), joined
+
+    def request(self, url):
+        """
+        Send a GET upstream through the scheduler's connection pool, following redirects.
+
+        Returns:
+            tuple: (status, headers, body), where body is a PooledResponse to
+                stream for 200 and bytes otherwise.
+        """
+        return self.scheduler.call(
+            url, lambda: open_with_redirect(self.scheduler.pool, url, max_redirects=MAX_REDIRECTS)
+        )
+
+    def run(self, key, fetch):
+        """Download one path upstream into its part file, then cache it if it is immutable."""
+        url = self.upstream + fetch.path
+        response = None
+        committed = False
+        try:
+            # Held until the body is in the cache: the scheduler's own slot is
+            # returned as soon as the response headers arrive
+            with self.transfers:
+                with metrics.span("upstream", url=url) as fields:
+                    status, headers, body = self.request(url)
+                    kept = {name: headers[name] for name in KEPT_HEADERS if headers.get(name)}
+                    fields["status"] = status
+                    with open(fetch.part_path, "wb", buffering=0) as out:
+                        if status != 200:
+                            # Error responses are relayed as they are
+                            out.write(body)
+                            fetch.start(status, kept, len(body))
+                            fetch.advance(len(body))
+                        else:
+                            # The connection goes back to the pool once the body is read
+                            response = body
+                            length = headers.get("Content-Length")
+                            fetch.start(status, kept, int(length) if length is not None else None)
+                            for chunk in iter(lambda: response.read(CHUNK_SIZE), b""):
+                                out.write(chunk)
+                                fetch.advance(len(chunk))
+                                metrics.inc("proxy_bytes_total", len(chunk), source="upstream")
+                            if fetch.length is not None and fetch.written != fetch.length:
+                                raise http.client.IncompleteRead(b"", fetch.length - fetch.written)
+                    fields["bytes"] = fetch.written
+                with self.lock:
+                    if status == 200 and is_immutable(url):
+                        committed = self.cache.commit(key, fetch.part_path, {"status": status, "headers": kept})
+                    del self.inflight[key]
+            fetch.finish()
+        except Exception as e:
+            print(f"Failed to fetch {url}: {e}")
+            with self.lock:
+                self.inflight.pop(key, None)
+            fetch.finish(e)
+        finally:
+            if response is not None:
+                response.close()
+            if not committed:
+                # Clients still streaming hold the file open
+                try:
+                    fetch.part_path.unlink()
+                except OSError:
+                    pass
+
+
+class ProxyHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "snapshot-proxy"
+
+    def log_message(self, format, *args):
+        metrics.note(f"{self.address_string()} {format % args}")
+
+    def do_GET(self):
+        self.serve(body=True)
+
+    def do_HEAD(self):
+        self.serve(body=False)
+
+    def send_status(self, status, message):
+        data = message.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def serve(self, body):
+        path = urllib.parse.urlsplit(self.path).path
+        if not path.startswith("/archive/") or "/../" in path or path.endswith("/.."):
+            self.send_status(404, "Only /archive/ paths are proxied\n")
+            return
+        source = self.server.proxy.open(path)
+        if source[0] == "hit":
+            _, meta, f = source
+            metrics.inc("proxy_requests_total", result="hit")
+            with f:
+                self.send_cached(meta, f, body)
+        else:
+            _, fetch, f, joined = source
+            metrics.inc("proxy_requests_total", result="coalesced" if joined else "miss")
+            with f:
+                self.send_fetch(fetch, f, body)
+
+    def send_cached(self, meta, f, body):
+        headers = meta["headers"]
+        if ((headers.get("ETag") and self.headers.get("If-None-Match") == headers["ETag"])
+                or (headers.get("Last-Modified") and self.headers.get("If-Modified-Since") == headers["Last-Modified"])):
+            self.send_response(304)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            return
+        size = os.fstat(f.fileno()).st_size
+        start, end, status = 0, size, meta["status"]
+        match = RANGE.match(self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            end = min(size, int(match.group(2)) + 1) if match.group(2) else size
+            if start >= end:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            status = 206
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{size}")
+        self.send_header("Content-Length", str(end - start))
+        self.end_headers()
+        if body:
+            sent = self.connection.sendfile(f, start, end - start)
+            metrics.inc("proxy_bytes_total", sent, source="cache")
+
+    def send_fetch(self, fetch, f, body):
+        if not fetch.wait_started():
+            self.send_status(502, f"Upstream request failed: {fetch.error}\n")
+            return
+        self.send_response(fetch.status)
+        for name, value in fetch.headers.items():
+            self.send_header(name, value)
+        if fetch.length is not None:
+            self.send_header("Content-Length", str(fetch.length))
+        else:
+            # Without a length the end of the body is the end of the connection
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        self.end_headers()
+        if not body:
+            return
+        sent = 0
+        while True:
+            written, done, error = fetch.wait_beyond(sent)
+            if written > sent:
+                sent += self.connection.sendfile(f, sent, written - sent)
+            elif error is not None:
+                # Too late for an error status; a short body tells the client
+                self.close_connection = True
+                return
+            elif done:
+                return
+
+
+class ProxyServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, proxy):
+        super().__init__(address, ProxyHandler)
+        self.proxy = proxy
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Caching proxy for snapshot.debian.org, for installs from the generated preseeds."
+    )
+    parser.add_argument("--bind", default="0.0.0.0", help="address to listen on (default: 0.0.0.0)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"port to listen on (default: {DEFAULT_PORT})")
+    parser.add_argument("--upstream", default=UPSTREAM, help=f"archive to proxy (default: {UPSTREAM})")
+    parser.add_argument("--cache-dir", type=Path, default=default_cache_dir().with_name("debian-snapshot-proxy"),
+                        help="directory of the package cache")
+    parser.add_argument("--cache-size", type=int, default=50,
+                        help="maximum size of the package cache in GiB (default: 50)")
+    parser.add_argument("--rate", type=float, default=10.0,
+                        help="maximum new requests per second to the upstream; halved whenever it "
+                             "answers 429 or 503 (default: 10)")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="maximum concurrent upstream downloads (default: 8)")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    metrics.setup(args)
+
+    cache = ProxyCache(args.cache_dir, args.cache_size * 1024 ** 3)
+    scheduler = RequestScheduler(ConnectionPool(), args.rate, args.concurrency)
+    server = ProxyServer((args.bind, args.port), SnapshotProxy(args.upstream, cache, scheduler, args.concurrency))
+    print(f"Proxying {args.upstream} on port {args.port}, {len(cache.entries)} files "
+          f"({cache.size / 1024 ** 3:.1f} GiB) cached in {args.cache_dir}")
+    started = time.monotonic()
+    # Stop cleanly under a service manager too, so the final metrics get written
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        metrics.finish(args.metrics_file)
+        print(f"Stopped after {time.monotonic() - started:.0f}s, "
+              f"{cache.size / 1024 ** 3:.1f} GiB cached")
+
+
+if __name__ == "__main__":
+    main()
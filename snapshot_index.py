@@ -0,0 +1,353 @@
+import argparse
+import calendar
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+import time
+from array import array
+from bisect import bisect_right
+from collections import namedtuple
+from pathlib import Path
+
+from snapshot_store import SnapshotStore
+
+DEFAULT_DB = Path("/snapshot/by-timestamp/debian.db")
+DEFAULT_INDEX = Path("/snapshot/by-timestamp/debian.index")
+
+# File layout, little-endian, every section starting on an 8-byte boundary:
+#   header
+#   int64 epochs[timestamps]           sorted snapshot times, memory-mapped
+#   uint32 run_starts[runs]            first timestamp of each run of identical release sets
+#   uint32 run_sets[runs]              release set of each run
+#   uint32 set_offsets[sets + 1]       slices of set_members
+#   uint32 set_members[members]        release ids
+#   (uint32 version_name, uint32 version)[releases]
+#   (uint32 version, uint32 version_name, int64 earliest, int64 latest)[spans]
+#   uint32 string_offsets[strings + 1] slices of the UTF-8 string blob
+#   string blob
+MAGIC = b"DSIX"
+INDEX_FORMAT = 2
+HEADER = struct.Struct("<4sIIIIIIIII")
+RELEASE = struct.Struct("<II")
+SPAN = struct.Struct("<IIqq")
+
+Release = namedtuple("Release", "version_name version")
+VersionSpan = namedtuple("VersionSpan", "version version_name earliest latest")
+
+
+def version_key(version):
+    """Sort key for Debian point releases: "3.1r8" < "3.1r10" < "10.13"."""
+    return tuple(int(part) for part in re.findall(r"\d+", version))
+
+
+def to_epoch(timestamp):
+    """
+    Convert a snapshot timestamp (20240101T000000Z) to epoch seconds.
+
+    Truncated timestamps such as "2024" or "20240315" mean the start of that period.
+    """
+    if len(timestamp) != 16:
+        digits = re.sub(r"\D", "", timestamp)
+        digits += "00000101000000"[len(digits):]
+        timestamp = f"{digits[:8]}T{digits[8:14]}Z"
+    return calendar.timegm((
+        int(timestamp[0:4]), int(timestamp[4:6]), int(timestamp[6:8]),
+        int(timestamp[9:11]), int(timestamp[11:13]), int(timestamp[13:15]),
+    ))
+
+
+def from_epoch(epoch):
+    return time.strftime("%Y%m%dT%H%M%SZ", time.gmtime(epoch))
+
+
+def _pad(size):
+    return -size % 8
+
+
+def _uint32s(values):
+    data = array("I", values)
+    if sys.byteorder != "little":
+        data.byteswap()
+    return data.tobytes()
+
+
+def _view(buffer, offset, count, typecode):
+    """Return count items of a little-endian array at offset, without copying where possible."""
+    size = count * array(typecode).itemsize
+    if sys.byteorder == "little":
+        return memoryview(buffer)[offset:offset + size].cast(typecode), offset + size + _pad(size)
+    data = array(typecode, buffer[offset:offset + size])
+    data.byteswap()
+    return data, offset + size + _pad(size)
+
+
+class SnapshotIndex:
+    """
+    Read-only index of the timestamp -> releases data.
+
+    Snapshot times are a sorted array of epoch seconds. Consecutive
+    snapshots listing the same releases form one run pointing to an
+    interned release set, and each version keeps the span of snapshots it
+    appears in. The current releases at any time are found by bisecting the
+    times, then the run starts.
+
+    Saved indexes are memory-mapped: the time and run arrays are read in
+    place, and only the small release and string tables are decoded on load.
+    """
+
+    def __init__(self, epochs, run_starts, run_sets, release_sets, versions):
+        self.epochs = epochs
+        self.run_starts = run_starts
+        self.run_sets = run_sets
+        self.release_sets = release_sets
+        self.versions = versions
+        self.codenames = {}
+        for span in versions.values():
+            self.codenames.setdefault(span.version_name, []).append(span.version)
+        for codename_versions in self.codenames.values():
+            codename_versions.sort(key=version_key)
+        self.mmap = None
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Build the index from SnapshotStore.rows() output, sorted by timestamp."""
+        epochs = array("q")
+        run_starts = array("I")
+        run_sets = array("I")
+        release_sets = []
+        interned = {}
+        versions = {}
+        current = None
+        releases = []
+
+        def finish():
+            release_set = tuple(releases)
+            if release_set not in interned:
+                interned[release_set] = len(release_sets)
+                release_sets.append(release_set)
+            set_id = interned[release_set]
+            if not run_sets or run_sets[-1] != set_id:
+                run_starts.append(len(epochs))
+                run_sets.append(set_id)
+            epochs.append(to_epoch(current))
+            for release in release_set:
+                span = versions.get(release.version)
+                if span is None:
+                    versions[release.version] = VersionSpan(
+                        release.version, release.version_name, current, current
+                    )
+                elif current > span.latest:
+                    versions[release.version] = span._replace(
+                        version_name=release.version_name, latest=current
+                    )
+
+        for timestamp, version_name, version in rows:
+            if timestamp != current:
+                if current is not None:
+                    finish()
+                current = timestamp
+                releases = []
+            if version_name is not None:
+                releases.append(Release(version_name, version))
+        if current is not None:
+            finish()
+        return cls(epochs, run_starts, run_sets, release_sets, versions)
+
+    @classmethod
+    def from_store(cls, store):
+        return cls.from_rows(store.rows())
+
+    @classmethod
+    def load(cls, path):
+        """Memory-map a saved index."""
+        with open(path, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(buffer) < HEADER.size or buffer[:4] != MAGIC:
+            buffer.close()
+            raise ValueError(f"Not a snapshot index: {path}")
+        (_, format_version, n_epochs, n_runs, n_sets, n_members, n_releases, n_spans, n_strings,
+         strings_size) = HEADER.unpack_from(buffer)
+        if format_version != INDEX_FORMAT:
+            buffer.close()
+            raise ValueError(f"Unsupported index format {format_version} in {path}")
+        offset = HEADER.size + _pad(HEADER.size)
+        epochs, offset = _view(buffer, offset, n_epochs, "q")
+        run_starts, offset = _view(buffer, offset, n_runs, "I")
+        run_sets, offset = _view(buffer, offset, n_runs, "I")
+        set_offsets, offset = _view(buffer, offset, n_sets + 1, "I")
+        set_members, offset = _view(buffer, offset, n_members, "I")
+        release_table = list(RELEASE.iter_unpack(buffer[offset:offset + n_releases * RELEASE.size]))
+        offset += n_releases * RELEASE.size + _pad(n_releases * RELEASE.size)
+        span_table = list(SPAN.iter_unpack(buffer[offset:offset + n_spans * SPAN.size]))
+        offset += n_spans * SPAN.size + _pad(n_spans * SPAN.size)
+        string_offsets, offset = _view(buffer, offset, n_strings + 1, "I")
+        blob = bytes(buffer[offset:offset + strings_size])
+        strings = [blob[string_offsets[i]:string_offsets[i + 1]].decode("utf-8") for i in range(n_strings)]
+
+        releases = [Release(strings[name], strings[version]) for name, version in release_table]
+        release_sets = [
+            tuple(releases[member] for member in set_members[set_offsets[i]:set_offsets[i + 1]])
+            for i in range(n_sets)
+        ]
+        versions = {
+            strings[version]: VersionSpan(strings[version], strings[name], from_epoch(earliest), from_epoch(latest))
+            for version, name, earliest, latest in span_table
+        }
+        del set_offsets, set_members, string_offsets
+        index = cls(epochs, run_starts, run_sets, release_sets, versions)
+        index.mmap = buffer
+        return index
+
+    def save(self, path):
+        """Atomically write the index in the binary layout described above."""
+        strings = {}
+
+        def intern(value):
+            return strings.setdefault(value, len(strings))
+
+        releases = {}
+        set_offsets = [0]
+        set_members = []
+        for release_set in self.release_sets:
+            for release in release_set:
+                if release not in releases:
+                    releases[release] = len(releases)
+                set_members.append(releases[release])
+            set_offsets.append(len(set_members))
+        release_table = b"".join(
+            RELEASE.pack(intern(release.version_name), intern(release.version)) for release in releases
+        )
+        span_table = b"".join(
+            SPAN.pack(intern(span.version), intern(span.version_name),
+                      to_epoch(span.earliest), to_epoch(span.latest))
+            for span in self.versions.values()
+        )
+        encoded = [value.encode("utf-8") for value in strings]
+        string_offsets = [0]
+        for value in encoded:
+            string_offsets.append(string_offsets[-1] + len(value))
+        blob = b"".join(encoded)
+
+        epochs = array("q", self.epochs)
+        if sys.byteorder != "little":
+            epochs.byteswap()
+        header = HEADER.pack(
+            MAGIC, INDEX_FORMAT, len(self.epochs), len(self.run_starts), len(self.release_sets),
+            len(set_members), len(releases), len(self.versions), len(encoded), len(blob),
+        )
+        sections = [
+            header, epochs.tobytes(), _uint32s(self.run_starts), _uint32s(self.run_sets),
+            _uint32s(set_offsets), _uint32s(set_members), release_table, span_table,
+            _uint32s(string_offsets), blob,
+        ]
+
+        path = Path(path)
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, "wb") as f:
+            for section in sections:
+                f.write(section)
+                f.write(b"\0" * _pad(len(section)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def close(self):
+        if self.mmap is not None:
+            # Views into the map must go before it can be closed
+            self.epochs = self.run_starts = self.run_sets = ()
+            self.mmap.close()
+            self.mmap = None
+
+    def __len__(self):
+        return len(self.epochs)
+
+    def timestamps(self):
+        """Return every snapshot timestamp, oldest first."""
+        return [from_epoch(epoch) for epoch in self.epochs]
+
+    def latest(self, version):
+        """Return the last snapshot listing a version, or None."""
+        span = self.versions.get(version)
+        return span.latest if span else None
+
+    def earliest(self, version):
+        """Return the first snapshot listing a version, or None."""
+        span = self.versions.get(version)
+        return span.earliest if span else None
+
+    def current_at(self, timestamp):
+        """
+        Return the releases current at a point in time.
+
+        Args:
+            timestamp (str): Any time in snapshot format, e.g. 20240101T000000Z
+                or a prefix of one such as 20240101.
+
+        Returns:
+            tuple: Releases listed by the last snapshot at or before timestamp,
+                empty if it predates the first snapshot.
+        """
+        i = bisect_right(self.epochs, to_epoch(timestamp))
+        if not i:
+            return ()
+        run = bisect_right(self.run_starts, i - 1) - 1
+        return self.release_sets[self.run_sets[run]]
+
+    def releases_of(self, version_name):
+        """Return the VersionSpan of every point release of a codename, oldest first."""
+        return [self.versions[version] for version in self.codenames.get(version_name, [])]
+
+    def latest_stamps(self):
+        """Return the latest timestamp of each version in the stamps.json layout."""
+        return {
+            version: {"version_name": span.version_name, "timestamp": span.latest}
+            for version, span in self.versions.items()
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the index of Debian releases on snapshot.debian.org.")
+    parser.add_argument("--index", type=Path, default=DEFAULT_INDEX,
+                        help=f"index file (default: {DEFAULT_INDEX})")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="build the index from the snapshot database")
+    build.add_argument("db", type=Path, nargs="?", default=DEFAULT_DB,
+                       help=f"snapshot database (default: {DEFAULT_DB})")
+    commands.add_parser("latest", help="last snapshot listing a version").add_argument("version")
+    commands.add_parser("earliest", help="first snapshot listing a version").add_argument("version")
+    commands.add_parser("at", help="releases current at a timestamp").add_argument("timestamp")
+    commands.add_parser("releases", help="point releases of a codename").add_argument("version_name")
+    commands.add_parser("stamps", help="latest timestamp of every version")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        store = SnapshotStore(args.db)
+        index = SnapshotIndex.from_store(store)
+        store.close()
+        index.save(args.index)
+        print(f"Indexed {len(index)} timestamps in {len(index.run_starts)} runs and "
+              f"{len(index.versions)} versions into {args.index} ({args.index.stat().st_size} bytes)")
+        return
+
+    index = SnapshotIndex.load(args.index)
+    if args.command in ("latest", "earliest"):
+        timestamp = getattr(index, args.command)(args.version)
+        if timestamp is None:
+            sys.exit(f"Unknown version: {args.version}")
+        print(timestamp)
+    elif args.command == "at":
+        result = [release._asdict() for release in index.current_at(args.timestamp)]
+        print(json.dumps(result, indent=4))
+    elif args.command == "releases":
+        result = [span._asdict() for span in index.releases_of(args.version_name)]
+        print(json.dumps(result, indent=4))
+    elif args.command == "stamps":
+        print(json.dumps(index.latest_stamps(), indent=4))
+    index.close()
+
+
+if __name__ == "__main__":
+    main()
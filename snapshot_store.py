@@ -0,0 +1,154 @@
+import json
+import os
+import sqlite3
+from pathlib import Path
+from threading import Lock
+
+
+class SnapshotStore:
+    """
+    SQLite-backed store for the timestamp -> releases map.
+
+    Every timestamp is committed in its own transaction, so an interrupted
+    crawl never leaves a half-written file behind, and the set of known
+    timestamps is kept in memory for cheap membership checks.
+    """
+
+    def __init__(self, db_file):
+        self.db_file = Path(db_file)
+        self.lock = Lock()
+        self.conn = sqlite3.connect(self.db_file, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS timestamps (timestamp TEXT PRIMARY KEY)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS releases ("
+                "timestamp TEXT NOT NULL, version_name TEXT NOT NULL, version TEXT NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS releases_timestamp ON releases (timestamp)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS months ("
+                "year INTEGER NOT NULL, month INTEGER NOT NULL, etag TEXT, last_modified TEXT, "
+                "complete INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (year, month))"
+            )
+        self.timestamps = {row[0] for row in self.conn.execute("SELECT timestamp FROM timestamps")}
+
+    def __contains__(self, timestamp):
+        return timestamp in self.timestamps
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def add(self, timestamp, releases):
+        """
+        Insert the releases found at a timestamp.
+
+        Args:
+            timestamp (str): Snapshot timestamp, e.g. 20240101T000000Z.
+            releases (dict): Mapping of version name to a list of
+                {"version", "timestamp"} dicts, as returned by extract_debian_versions.
+
+        Returns:
+            bool: False if the timestamp was already stored.
+        """
+        rows = [
+            (timestamp, version_name, entry["version"])
+            for version_name, versions in releases.items()
+            for entry in (versions if isinstance(versions, list) else [versions])
+        ]
+        with self.lock:
+            if timestamp in self.timestamps:
+                return False
+            with self.conn:
+                self.conn.execute("INSERT INTO timestamps (timestamp) VALUES (?)", (timestamp,))
+                self.conn.executemany(
+                    "INSERT INTO releases (timestamp, version_name, version) VALUES (?, ?, ?)", rows
+                )
+            self.timestamps.add(timestamp)
+        return True
+
+    def get_month(self, year, month):
+        """Return the recorded state of a month listing, or None if never processed."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT etag, last_modified, complete FROM months WHERE year = ? AND month = ?",
+                (year, month),
+            ).fetchone()
+        if row is None:
+            return None
+        return {"etag": row[0], "last_modified": row[1], "complete": bool(row[2])}
+
+    def set_month(self, year, month, etag, last_modified, complete):
+        """Record the listing validators of a month and whether all of its READMEs were stored."""
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO months (year, month, etag, last_modified, complete) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (year, month, etag, last_modified, int(complete)),
+            )
+
+    def checkpoint(self):
+        """Return the last fully-processed (year, month), or None."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT year, month FROM months WHERE complete = 1 "
+                "ORDER BY year DESC, month DESC LIMIT 1"
+            ).fetchone()
+        return tuple(row) if row else None
+
+    def rows(self):
+        """
+        Return every stored release in timestamp order.
+
+        Returns:
+            list: (timestamp, version_name, version) tuples; a timestamp
+                without releases appears once with None for both names.
+        """
+        with self.lock:
+            return self.conn.execute(
+                "SELECT t.timestamp, r.version_name, r.version FROM timestamps t "
+                "LEFT JOIN releases r ON r.timestamp = t.timestamp "
+                "ORDER BY t.timestamp, r.rowid"
+            ).fetchall()
+
+    def to_dict(self):
+        """Return the stored data in the debian.json layout."""
+        data = {}
+        for timestamp, version_name, version in self.rows():
+            releases = data.setdefault(timestamp, {})
+            if version_name is not None:
+                releases.setdefault(version_name, []).append(
+                    {"version": version, "timestamp": timestamp}
+                )
+        return data
+
+    def import_json(self, json_file):
+        """One-time migration of an existing debian.json into an empty store."""
+        json_file = Path(json_file)
+        if self.timestamps or not json_file.exists():
+            return 0
+        with open(json_file, "r") as file:
+            data = json.load(file)
+        for timestamp, releases in data.items():
+            self.add(timestamp, releases)
+        print(f"Imported {len(data)} timestamps from {json_file}")
+        return len(data)
+
+    def export_json(self, json_file):
+        """Atomically write the stored data as debian.json for existing consumers."""
+        json_file = Path(json_file)
+        tmp_file = json_file.with_name(json_file.name + ".tmp")
+        with open(tmp_file, "w") as file:
+            json.dump(self.to_dict(), file, indent=4)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_file, json_file)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,150 @@
+import json
+import os
+import shutil
+import time
+
+import metrics
+
+# Per-ISO scratch directories that can be rebuilt from the ISO, largest first
+WORKSPACE_DIRS = ("extracted", "patched")
+
+
+def format_size(size):
+    """Format a byte count in MiB or GiB."""
+    if size < 1024 ** 3:
+        return f"{size / 1024 ** 2:.0f} MiB"
+    return f"{size / 1024 ** 3:.1f} GiB"
+
+
+def tree_size(path):
+    """Return the disk usage of a directory tree in bytes, 0 if it does not exist."""
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            st = os.lstat(os.path.join(dirpath, name))
+            total += st.st_blocks * 512
+    return total
+
+
+class Workspaces:
+    """
+    Disk budget of the per-ISO build workspaces on the scratch volume.
+
+    The size and last use of every workspace (the WORKSPACE_DIRS next to an
+    ISO) are kept in workspaces.json under root_dir. Builds reserve the space
+    they are expected to need before they start; make_room() evicts the
+    least recently used idle workspaces to stay within the budget and above
+    min_free, and admits the build once the space is there.
+    """
+
+    def __init__(self, root_dir, budget=None, min_free=0):
+        self.root_dir = str(root_dir)
+        self.path = os.path.join(self.root_dir, "workspaces.json")
+        self.budget = budget
+        self.min_free = min_free
+        self.reserved = {}
+        try:
+            with open(self.path) as f:
+                recorded = json.load(f)
+        except (OSError, ValueError):
+            recorded = {}
+        self.entries = {}
+        for dirpath, dirnames, _ in os.walk(self.root_dir):
+            if any(name in dirnames for name in WORKSPACE_DIRS):
+                dirnames[:] = []
+                if dirpath in recorded:
+                    self.entries[dirpath] = recorded[dirpath]
+                else:
+                    # Left by a run before the workspaces were tracked
+                    self.entries[dirpath] = {
+                        "size": self.measure(dirpath),
+                        "last_used": max(os.stat(os.path.join(dirpath, name)).st_mtime
+                                         for name in WORKSPACE_DIRS
+                                         if os.path.exists(os.path.join(dirpath, name))),
+                    }
+        self.save()
+
+    @staticmethod
+    def measure(iso_dir):
+        return sum(tree_size(os.path.join(iso_dir, name)) for name in WORKSPACE_DIRS)
+
+    def used(self):
+        """Bytes used by the workspaces plus the space reserved for running builds."""
+        return sum(entry["size"] for entry in self.entries.values()) + sum(self.reserved.values())
+
+    def free(self):
+        return shutil.disk_usage(self.root_dir).free - sum(self.reserved.values())
+
+    def fits(self, need):
+        if self.budget is not None and self.used() + need > self.budget:
+            return False
+        return self.free() - need >= self.min_free
+
+    def make_room(self, iso_dir, need, evict):
+        """
+        Evict idle workspaces until a build needing need more bytes fits, and reserve them.
+
+        Args:
+            iso_dir (str): Directory of the ISO about to be built; its own
+                workspace is never evicted.
+            need (int): Bytes the build is expected to add.
+            evict (callable): Called with the directory of a candidate
+                workspace, least recently used first. Returns True, after
+                recording the eviction, only if the outputs built from the
+                workspace are published and verified; it is then removed.
+
+        Returns:
+            bool: True if the build was admitted, False if it has to wait for
+                running builds to free space.
+        """
+        candidates = sorted(
+            (entry["last_used"], path) for path, entry in self.entries.items()
+            if path != iso_dir and path not in self.reserved and entry["size"] > 0
+        )
+        for _, path in candidates:
+            if self.fits(need):
+                break
+            size = self.entries[path]["size"]
+            if evict(path):
+                self.remove(path)
+                del self.entries[path]
+                metrics.note(f"Evicted workspace {path} ({format_size(size)})")
+                metrics.inc("workspace_evictions_total")
+                metrics.inc("workspace_evicted_bytes_total", size)
+        self.save()
+        if not self.fits(need):
+            return False
+        self.reserve(iso_dir, need)
+        return True
+
+    def reserve(self, iso_dir, need):
+        """Reserve need bytes for the build of one ISO, whether they fit or not."""
+        self.reserved[iso_dir] = need
+        metrics.gauge("workspace_bytes", self.used())
+
+    def release(self, iso_dir):
+        """Drop the reservation of a finished build and record its workspace as just used."""
+        self.reserved.pop(iso_dir, None)
+        size = self.measure(iso_dir)
+        if size:
+            self.entries[iso_dir] = {"size": size, "last_used": time.time()}
+        else:
+            self.entries.pop(iso_dir, None)
+        self.save()
+        metrics.gauge("workspace_bytes", self.used())
+
+    def remove(self, iso_dir):
+        """Delete the workspace directories of one ISO."""
+        for name in WORKSPACE_DIRS:
+            shutil.rmtree(os.path.join(iso_dir, name), ignore_errors=True)
+
+    def summary(self):
+        budget = "unlimited" if self.budget is None else format_size(self.budget)
+        return (f"{len(self.entries)} workspaces, {format_size(self.used())} of {budget}, "
+                f"{format_size(shutil.disk_usage(self.root_dir).free)} free")
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f, indent=4)
+        os.replace(tmp_path, self.path)